@@ -0,0 +1,59 @@
+#!/usr/bin/env python2.7
+
+'''Compare two JSON files written by run_benchmarks.py, printing the ratio of
+the time and peak memory of each stage in the new results to the old, and
+exiting with status 1 if any stage has slowed down or grown by more than the
+given tolerance.'''
+
+import argparse
+import json
+import sys
+
+def load(path):
+    with open(path) as f:
+        results = json.load(f)['results']
+    # results from before stages were timed with several threads used one
+    return dict([((r['generator'], r['tips'], r['stage'], r.get('threads', 1)), r) for r in results])
+
+def main():
+    parser = argparse.ArgumentParser(description='compare two sets of tree2tax benchmark results')
+    parser.add_argument('old', help='JSON results of the baseline version')
+    parser.add_argument('new', help='JSON results of the version to check')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='largest acceptable ratio of new to old time or memory [default: 1.25]')
+    parser.add_argument('--min_seconds', type=float, default=0.05,
+                        help='ignore time differences of stages faster than this in both versions [default: 0.05]')
+    args = parser.parse_args()
+
+    old = load(args.old)
+    new = load(args.new)
+    regressions = 0
+    print "\t".join(['generator','tips','stage','threads','old_seconds','new_seconds','time_ratio','old_peak_rss_kb','new_peak_rss_kb','memory_ratio','status'])
+    for key in sorted(set(old.keys()) & set(new.keys())):
+        o = old[key]
+        n = new[key]
+        if 'error' in o or 'error' in n:
+            status = 'error'
+            fields = ['', '', '', '', '', '']
+        else:
+            time_ratio = n['seconds'] / max(o['seconds'], 1e-9)
+            memory_ratio = float(n['peak_rss_kb']) / max(o['peak_rss_kb'], 1)
+            slower = time_ratio > args.tolerance and max(o['seconds'], n['seconds']) >= args.min_seconds
+            bigger = memory_ratio > args.tolerance
+            if slower or bigger:
+                status = 'REGRESSION'
+                regressions += 1
+            else:
+                status = 'ok'
+            fields = ["%.4f" % o['seconds'], "%.4f" % n['seconds'], "%.2f" % time_ratio,
+                      str(o['peak_rss_kb']), str(n['peak_rss_kb']), "%.2f" % memory_ratio]
+        print "\t".join([key[0], str(key[1]), key[2], str(key[3])] + fields + [status])
+
+    for key in sorted(set(old.keys()) ^ set(new.keys())):
+        sys.stderr.write("Only in %s results: %s\n" % ('old' if key in old else 'new', ' '.join([str(k) for k in key])))
+    if regressions > 0:
+        sys.stderr.write("%i regressions found\n" % regressions)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
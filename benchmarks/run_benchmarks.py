@@ -0,0 +1,194 @@
+#!/usr/bin/env python2.7
+
+'''Time each stage of the tree2tax pipeline on synthetic trees, and write the
+results as JSON so that they can be compared between versions with
+compare_benchmarks.py.
+
+Each stage is run in a forked process after its inputs have been prepared,
+so that the peak resident memory of the process before and after the stage
+can be recorded without being confused with that of other stages.'''
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'..'))
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+import tree2tax
+from tree2tax.newick import NewickReader
+from tree2tax.tree_cache import TreeCache
+from tree2tax.tree2tax import Tree2Tax, TaxonomyIndex
+from tree2tax.threshold_finder import ThresholdFinder, ThresholdInconsistencyException
+from tree2tax.taxonomy_writer import TaxonomyWriter
+from tree2tax.metrics import peak_rss_kb
+import tree_generators
+
+STAGES = ['parse', 'cache_write', 'cache_load', 'merge_heights', 'cluster', 'name', 'find_thresholds', 'write']
+THRESHOLDS = [0.02, 0.05, 0.1, 0.15, 0.2, 0.3, 0.5]
+PREFIXES = 'k p c o f g s'.split()
+
+class StageRunner:
+    '''Prepares the inputs of a stage and then times it'''
+    def __init__(self, tree_path, work_directory, threads=1):
+        self.tree_path = tree_path
+        self.work_directory = work_directory
+        self.threads = threads
+
+    def prepare(self, stage):
+        if stage == 'parse': return
+        tree = NewickReader().read(self.tree_path)
+        self.tree = tree
+        if stage == 'cache_load':
+            self.cache_path = os.path.join(self.work_directory, 'tree.t2t')
+            TreeCache().write(tree, self.cache_path, 'benchmark')
+        elif stage in ('cluster', 'name'):
+            # clustering and naming are timed separately, on the tree with
+            # any multifurcations resolved
+            tree2tax = Tree2Tax()
+            self.tree, _, _, self.merge_heights = tree2tax._resolve_and_merge_heights(tree)
+            if stage == 'name':
+                self.cluster_lcas = [tree2tax.cluster_lcas(self.tree, self.merge_heights, threshold)
+                                     for threshold in THRESHOLDS]
+                self.taxonomy_index = TaxonomyIndex(self.tree)
+                self.tip_keys = tree2tax._tie_break_tip_keys(self.tree)
+        elif stage == 'write':
+            self.threshold_and_clusters = Tree2Tax().named_clusters_for_several_thresholds(tree, THRESHOLDS)
+
+    def run(self, stage):
+        '''run the stage, returning a dict of any counts to record'''
+        if stage == 'parse':
+            tree = NewickReader().read(self.tree_path)
+            return {'nodes': len(tree), 'tips': tree.num_tips()}
+        elif stage == 'cache_write':
+            TreeCache().write(self.tree, os.path.join(self.work_directory, 'written.t2t'), 'benchmark')
+        elif stage == 'cache_load':
+            tree = TreeCache().load(self.cache_path)
+            # touch every page, as the other stages would
+            tree.parent.sum()
+            tree.length.sum()
+        elif stage == 'merge_heights':
+            tree = Tree2Tax()._resolve_and_merge_heights(self.tree, self.threads)[0]
+            return {'multifurcations': int(np.count_nonzero(self.tree.num_children > 2)),
+                    'resolved_nodes': len(tree)}
+        elif stage == 'cluster':
+            tree2tax = Tree2Tax()
+            cluster_lcas = [tree2tax.cluster_lcas(self.tree, self.merge_heights, threshold)
+                            for threshold in THRESHOLDS]
+            return {'clusters': [len(lcas) for lcas in cluster_lcas]}
+        elif stage == 'name':
+            tree2tax = Tree2Tax()
+            for lcas in self.cluster_lcas:
+                tree2tax._named_clusters_from_lcas(self.tree, lcas, self.taxonomy_index, self.tip_keys)
+        elif stage == 'find_thresholds':
+            try:
+                return {'thresholds': ThresholdFinder().find_thresholds(self.tree, PREFIXES)}
+            except ThresholdInconsistencyException:
+                return {'thresholds': None}
+        elif stage == 'write':
+            TaxonomyWriter().write(self.threshold_and_clusters, os.path.join(self.work_directory, 'taxonomy.tsv'))
+        else:
+            raise ValueError("Unknown stage %s" % stage)
+
+
+def _run_stage(tree_path, stage, work_directory, threads, connection):
+    try:
+        runner = StageRunner(tree_path, work_directory, threads)
+        runner.prepare(stage)
+        rss_before = peak_rss_kb()
+        start = time.time()
+        counts = runner.run(stage)
+        seconds = time.time() - start
+        rss_after = peak_rss_kb()
+        result = {'seconds': seconds,
+                  'peak_rss_kb': rss_after,
+                  'peak_rss_increase_kb': rss_after - rss_before}
+        if counts: result['counts'] = counts
+        connection.send(result)
+    except Exception as e:
+        connection.send({'error': "%s: %s" % (type(e).__name__, e)})
+    connection.close()
+
+def run_stage(tree_path, stage, work_directory, threads=1):
+    '''Run a stage in a forked process, returning a dict of its timings'''
+    parent_connection, child_connection = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_run_stage,
+                                      args=(tree_path, stage, work_directory, threads, child_connection))
+    process.start()
+    result = parent_connection.recv()
+    process.join()
+    return result
+
+def stages_for(generator, stages):
+    # only annotated trees have taxonomy to find thresholds from
+    if generator not in tree_generators.ANNOTATED:
+        return [s for s in stages if s != 'find_thresholds']
+    return stages
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark each stage of tree2tax on synthetic trees')
+    parser.add_argument('--generators', nargs='+', choices=tree_generators.GENERATORS, default=tree_generators.GENERATORS)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000],
+                        help='numbers of tips of the trees to generate [default: 1000 10000 100000]')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--repeats', type=int, default=1, help='number of times to run each stage, the fastest is reported')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--threads', nargs='+', type=int, default=[1],
+                        help='numbers of processes to time the merge_heights stage with, e.g. 1 4 [default: 1]')
+    parser.add_argument('--tree_directory', help='keep generated trees in this directory, and reuse them on later runs')
+    parser.add_argument('--output', required=True, help='write JSON results to this file')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    work_directory = tempfile.mkdtemp()
+    tree_directory = args.tree_directory or work_directory
+    try:
+        results = []
+        for generator in args.generators:
+            for size in args.sizes:
+                tree_path = os.path.join(tree_directory, "%s_%i_seed%i.tree" % (generator, size, args.seed))
+                if not os.path.exists(tree_path):
+                    logging.info("Generating %s" % tree_path)
+                    with open(tree_path, 'w') as f:
+                        tree_generators.write_tree(f, generator, size, args.seed)
+                for stage in stages_for(generator, args.stages):
+                    serial_seconds = None
+                    # only merge heights are calculated in parallel
+                    for threads in (args.threads if stage == 'merge_heights' else [1]):
+                        runs = [run_stage(tree_path, stage, work_directory, threads) for _ in range(args.repeats)]
+                        successful = [r for r in runs if 'error' not in r]
+                        if successful:
+                            result = min(successful, key=lambda r: r['seconds'])
+                        else:
+                            result = runs[0]
+                        result.update({'generator': generator, 'tips': size, 'stage': stage, 'threads': threads})
+                        if threads == 1 and 'error' not in result:
+                            serial_seconds = result['seconds']
+                        elif serial_seconds is not None and 'error' not in result:
+                            result['speedup'] = serial_seconds / max(result['seconds'], 1e-9)
+                        logging.info("%s %i %s (%i threads): %s" % (generator, size, stage, threads,
+                            result.get('error') or "%.3fs, peak RSS %i kB%s" % (result['seconds'], result['peak_rss_kb'],
+                                ", %.2fx faster than 1 thread" % result['speedup'] if 'speedup' in result else '')))
+                        results.append(result)
+
+        with open(args.output, 'w') as f:
+            json.dump({'tree2tax_version': tree2tax.__version__,
+                       'python_version': platform.python_version(),
+                       'numpy_version': np.__version__,
+                       'platform': platform.platform(),
+                       'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'seed': args.seed,
+                       'results': results}, f, indent=1, sort_keys=True)
+    finally:
+        shutil.rmtree(work_directory)
+
+if __name__ == '__main__':
+    main()
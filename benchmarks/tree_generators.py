@@ -0,0 +1,143 @@
+'''Seeded generators of synthetic newick trees for benchmarking, written
+straight to a file so that trees of millions of tips can be made without
+holding them in memory. Three shapes are provided:
+
+balanced     perfectly balanced binary trees
+caterpillar  binary trees where every internal node has a tip child, the
+             deepest possible shape
+greengenes   random binary trees with internal nodes annotated with
+             GreenGenes style taxonomy e.g. 'f__Family12; g__Genus40', and
+             numeric tip names like prokMSA IDs
+polytomy     annotated as greengenes, but where each internal node has
+             between 2 and 12 children, as in trees with unresolved clades
+
+Each tree is determined by its shape, number of tips and seed.'''
+
+import math
+import numpy as np
+
+GENERATORS = ['balanced', 'caterpillar', 'greengenes', 'polytomy']
+# generators whose trees are annotated with taxonomy
+ANNOTATED = ['greengenes', 'polytomy']
+
+# fraction of the tips below which a clade is given each rank
+RANK_FRACTIONS = [('k', 0.5), ('p', 1/8.0), ('c', 1/40.0), ('o', 1/150.0),
+                  ('f', 1/600.0), ('g', 1/2500.0), ('s', 1/10000.0)]
+RANK_WORDS = dict(zip('k p c o f g s'.split(),
+                      'Kingdom Phylum Class Order Family Genus Species'.split()))
+
+class _BufferedWriter:
+    def __init__(self, f, buffer_size=1<<20):
+        self.f = f
+        self.buffer_size = buffer_size
+        self.parts = []
+        self.size = 0
+
+    def write(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= self.buffer_size: self.flush()
+
+    def flush(self):
+        self.f.write(''.join(self.parts))
+        self.parts = []
+        self.size = 0
+
+
+def write_tree(f, generator, num_tips, seed=1):
+    '''Write a tree of the given shape and number of tips to the open file f
+    in newick format'''
+    rand = np.random.RandomState(seed)
+    out = _BufferedWriter(f)
+    if generator == 'caterpillar':
+        _write_caterpillar(out, num_tips, rand)
+    elif generator == 'balanced':
+        _write_split_tree(out, num_tips, rand, lambda size: [size/2, size-size/2], False)
+    elif generator == 'greengenes':
+        _write_split_tree(out, num_tips, rand, lambda size: _random_split(size, 2, rand), True)
+    elif generator == 'polytomy':
+        _write_split_tree(out, num_tips, rand, lambda size: _random_split(size, rand.randint(2, 13), rand), True)
+    else:
+        raise ValueError("Unknown tree generator %s" % generator)
+    out.flush()
+
+
+def _write_caterpillar(out, num_tips, rand):
+    out.write('(' * (num_tips-1))
+    out.write("t0:%.5f" % rand.exponential(0.05))
+    for i in range(1, num_tips):
+        out.write(",t%i:%.5f):%.5f" % (i, rand.exponential(0.05), rand.exponential(0.01)))
+    out.write(';\n')
+
+
+def _random_split(size, num_children, rand):
+    '''Split size tips into at most num_children random non-empty parts, at
+    least two'''
+    cuts = np.unique(rand.randint(1, size, num_children-1))
+    return np.diff(np.concatenate(([0], cuts, [size]))).tolist()
+
+
+def _write_split_tree(out, num_tips, rand, split, annotate):
+    '''Write a tree by recursively splitting the tips between the children
+    of each node, split giving the sizes of the children of a clade, using a
+    stack rather than recursion. Internal branch lengths shrink with clade
+    size, so that clades of lower ranks are more closely related.'''
+    counters = dict([(prefix, 0) for prefix, _ in RANK_FRACTIONS])
+    tip_id = [0]
+    # items are (kind, size, size of the parent)
+    stack = [('node', num_tips, None)]
+    while stack:
+        kind, size, parent_size = stack.pop()
+        if kind == 'comma':
+            out.write(',')
+        elif kind == 'close':
+            out.write(')')
+            if annotate:
+                out.write(_taxonomy_label(size, parent_size, num_tips, counters, rand))
+            out.write(_length(size, parent_size, rand))
+        elif size == 1:
+            tip_id[0] += 1
+            if annotate:
+                out.write("%i" % (1000000 + tip_id[0]))
+            else:
+                out.write("t%i" % tip_id[0])
+            out.write(_length(size, parent_size, rand))
+        else:
+            out.write('(')
+            stack.append(('close', size, parent_size))
+            for i, child_size in enumerate(reversed(split(size))):
+                if i > 0: stack.append(('comma', None, None))
+                stack.append(('node', child_size, size))
+    out.write(';\n')
+
+
+def _length(size, parent_size, rand):
+    if parent_size is None: return ''
+    return ":%.5f" % (0.02*math.log(float(parent_size)/size) + rand.exponential(0.01))
+
+
+def _taxonomy_label(size, parent_size, num_tips, counters, rand):
+    '''label a clade with each rank for which it is the largest clade below
+    that rank's size, with some ranks left out, as they are in GreenGenes'''
+    parts = []
+    for prefix, fraction in RANK_FRACTIONS:
+        limit = num_tips * fraction
+        if size <= limit and (parent_size is None or parent_size > limit) and \
+                size > 1 and rand.random_sample() < 0.9:
+            counters[prefix] += 1
+            parts.append("%s__%s%i" % (prefix, RANK_WORDS[prefix], counters[prefix]))
+    if parts:
+        return "'%s'" % '; '.join(parts)
+    else:
+        return ''
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description='write a synthetic newick tree to stdout')
+    parser.add_argument('--generator', choices=GENERATORS, required=True)
+    parser.add_argument('--tips', type=int, required=True)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    write_tree(sys.stdout, args.generator, args.tips, args.seed)
@@ -16,6 +16,7 @@ with open('HISTORY.rst') as history_file:
 
 requirements = [
     'scikit-bio>=0.2.2,<1.0',
+    'numpy',
     'tempdir',
 ]
 
@@ -59,6 +60,7 @@ setup(
     tests_require=test_requirements,
     scripts=[
         'bin/autotaxonomy',
+        'bin/classify_placements',
         'bin/percent_identity_vs_tree_distance',
         'bin/threshold_estimator',
         'bin/tree2tax'
@@ -0,0 +1,38 @@
+from nose.tools import assert_equals, assert_raises
+from tree2tax.autotaxonomy import AutoTaxonomy
+from skbio.tree import TreeNode
+from StringIO import StringIO
+import tempfile
+import shutil
+import os
+
+class TestAutoTaxonomy:
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        
+    def teardown(self):
+        shutil.rmtree(self.directory)
+        
+    def read(self, filename):
+        with open(os.path.join(self.directory, filename)) as f:
+            return f.read()
+        
+    def testRun(self):
+        tree = TreeNode.read(StringIO("((((1:11, 2:12)'g__C':10, 3:9)'f__E':20, 10:20)G:30)root;"))
+        AutoTaxonomy([100, 70, 40, 30, 25, 20, 10]).run(tree, self.directory)
+        assert_equals("10\tk__G; p__G; c__G; o__G; f__G; g__G; s__G\n"
+                      "3\tk__G; p__G; c__fE; o__fE; f__fE; g__fE; s__fE\n"
+                      "2\tk__G; p__G; c__fE; o__gC; f__gC; g__gC.2; s__gC.2\n"
+                      "1\tk__G; p__G; c__fE; o__gC; f__gC; g__gC.1; s__gC.1\n",
+                      self.read('taxonomy.gg.csv'))
+        assert_equals("seqname,tax_id\n10,s__G\n3,s__fE\n2,s__gC.2\n1,s__gC.1\n",
+                      self.read('seqinfo.taxtastic.csv'))
+        taxonomy = self.read('taxonomy.taxtastic.csv').split("\n")
+        assert_equals('tax_id,parent_id,rank,tax_name,root,rank_0,rank_1,rank_2,rank_3,rank_4,rank_5,rank_6', taxonomy[0])
+        assert_equals('Root,Root,root,Root,Root,,,,,,,', taxonomy[1])
+        assert_equals('k__G,Root,rank_0,k__G,Root,k__G,,,,,,', taxonomy[2])
+        assert_equals('p__G,k__G,rank_1,p__G,Root,k__G,p__G,,,,,', taxonomy[3])
+        
+    def testWrongNumberOfThresholds(self):
+        with assert_raises(ValueError):
+            AutoTaxonomy([1, 2])
@@ -0,0 +1,135 @@
+from nose.tools import assert_equals, assert_almost_equals
+from tree2tax.calibration import FastaIndex, PairwiseAligner, Calibration
+from tree2tax.compact_tree import CompactTree
+from skbio.tree import TreeNode
+from StringIO import StringIO
+import numpy as np
+import tempfile
+import shutil
+import os
+
+class TestFastaIndex:
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'seqs.fa')
+        with open(self.path, 'w') as f:
+            f.write(">A desc\nACGTA\nCGTAC\nGT\n>B\nacg\n>C\n\n>D\nACGTA\nCGTAC\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testScan(self):
+        index = FastaIndex(self.path)
+        assert_equals(['A', 'B', 'C', 'D'], sorted(index.names()))
+        assert_equals('ACGTACGTACGT', index.sequence('A'))
+        assert_equals('ACG', index.sequence('B'))
+        assert_equals('', index.sequence('C'))
+        assert_equals('ACGTACGTAC', index.sequence('D'))
+        assert_equals(12, index.sequence_length('A'))
+        assert 'E' not in index
+        index.close()
+
+    def testFai(self):
+        # as written by samtools faidx
+        with open(self.path + '.fai', 'w') as f:
+            f.write("A\t12\t8\t5\t6\nB\t3\t25\t3\t4\n")
+        index = FastaIndex(self.path)
+        assert_equals(['A', 'B'], sorted(index.names()))
+        assert_equals('ACGTACGTACGT', index.sequence('A'))
+        assert_equals('ACG', index.sequence('B'))
+        index.close()
+
+
+class TestPairwiseAligner:
+    def reference_identity(self, first, second, match_score=1, mismatch_score=-1, gap_score=-2):
+        '''A cell at a time, each cell being the (score, identical bases,
+        -columns) of the best alignment ending there'''
+        n, m = len(first), len(second)
+        previous = [(0, 0, 0)]*(m+1)
+        best = (0, 0, 0)
+        for i in range(1, n+1):
+            vertical = [(0, 0, 0)]
+            for j in range(1, m+1):
+                identical = first[i-1] == second[j-1]
+                diagonal = (previous[j-1][0] + (match_score if identical else mismatch_score),
+                            previous[j-1][1] + identical, previous[j-1][2] - 1)
+                up = (previous[j][0] + gap_score, previous[j][1], previous[j][2] - 1)
+                vertical.append(max(diagonal, up))
+            row = [max([(vertical[k][0] + gap_score*(j-k), vertical[k][1], vertical[k][2] - (j-k))
+                        for k in range(j+1)]) for j in range(m+1)]
+            best = max(best, row[m])
+            previous = row
+        best = max([best] + previous)
+        return 100.0 * best[1] / max(-best[2], 1)
+
+    def testIdentities(self):
+        aligner = PairwiseAligner()
+        identities = aligner.percent_identities(
+            ['ACGTACGTAC', 'ACGTACGTAC', 'GGACGTACGTAC', 'ACGTACGTAC', 'ACGT', ''],
+            ['ACGTACGTAC', 'ACGTTCGTAC', 'ACGTACGTACTT', 'ACGTAACGTAC', '', 'ACGT'])
+        # identical, one substitution, overhanging ends are free, one
+        # insertion, and empty sequences
+        assert_equals([100.0, 90.0, 100.0], list(identities[:3]))
+        assert_almost_equals(1000.0/11, identities[3])
+        assert_equals([0.0, 0.0], list(identities[4:]))
+
+    def testMatchesReference(self):
+        import random
+        rand = random.Random(3)
+        firsts = []
+        seconds = []
+        for _ in range(30):
+            first = ''.join([rand.choice('ACGT') for _ in range(rand.randint(0, 25))])
+            # a mutated copy, trimmed at either end
+            second = ''.join([rand.choice('ACGT') if rand.random() < 0.2 else b for b in first
+                              if rand.random() > 0.1])
+            second = second[rand.randint(0, 3):]
+            firsts.append(first)
+            seconds.append(second)
+        identities = PairwiseAligner().percent_identities(firsts, seconds)
+        for first, second, identity in zip(firsts, seconds, identities):
+            assert_almost_equals(self.reference_identity(first, second), identity)
+
+
+class TestCalibration:
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'seqs.fa')
+        with open(self.path, 'w') as f:
+            f.write(">A\nACGTACGTAC\n>B\nACGTTCGTAC\n>C\nACGTACGTAC\n>D\nTTGTACGGAC\n")
+        self.tree = CompactTree.from_tree_node(TreeNode.read(StringIO(
+            "(((A:0.1,B:0.1):0.2,C:0.3):0.5,(D:0.5,E:0.5):0.5)root;")))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testUniformPairs(self):
+        calibration = Calibration(self.tree, FastaIndex(self.path), seed=1)
+        first, second, distances = calibration.uniform_pairs(200)
+        names = dict([(t, self.tree.name(t)) for t in self.tree.tip_ids])
+        # E has no sequence
+        assert_equals(set('ABCD'), set([names[t] for t in first]) | set([names[t] for t in second]))
+        assert (first != second).all()
+        for a, b, distance in zip(first, second, distances):
+            assert_almost_equals(self.tree.distance(a, b), distance)
+
+    def testStratifiedPairs(self):
+        calibration = Calibration(self.tree, FastaIndex(self.path), seed=1)
+        # distances are 0.2, 0.6 and 1.8, so the bin from 1.0 to 1.5 stays
+        # empty while the others have 8 pairs each
+        first, second, distances = calibration.stratified_pairs(30, 4, max_distance=2.0)
+        bins = np.floor(distances / 0.5).astype(int)
+        assert_equals([8, 8, 0, 8], list(np.bincount(bins, minlength=4)))
+
+    def testWrite(self):
+        for threads in [1, 2]:
+            calibration = Calibration(self.tree, FastaIndex(self.path), seed=1)
+            first, second, distances = calibration.uniform_pairs(20)
+            output = StringIO()
+            calibration.write(first, second, distances, output, threads=threads, batch_size=3)
+            lines = [line.split("\t") for line in output.getvalue().splitlines()]
+            assert_equals(20, len(lines))
+            identities = {'AB': '90.00', 'AC': '100.00', 'BC': '90.00'}
+            for first_name, second_name, distance, identity in lines:
+                pair = ''.join(sorted([first_name, second_name]))
+                if pair in identities: assert_equals(identities[pair], identity)
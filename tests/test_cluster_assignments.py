@@ -0,0 +1,63 @@
+from nose.tools import assert_equals, assert_raises
+from tree2tax.tree2tax import Tree2Tax
+from tree2tax.cluster_assignments import ClusterAssignments, _NameIndex
+from skbio.tree import TreeNode
+from StringIO import StringIO
+import numpy as np
+import tempfile
+import os
+
+class TestClusterAssignments:
+    def tree(self):
+        return TreeNode.read(StringIO(
+            "((('A':0.1,'B':0.1)'g__X':0.1,('C':0.1,'D':0.1)'g__X':0.5)'f__Y':0.5,'E':0.1)root;"))
+
+    def testMatchesNamedClusters(self):
+        thresholds = [0.8, 0.1, 0.3]
+        t2t = Tree2Tax()
+        threshold_and_clusters = t2t.named_clusters_for_several_thresholds(self.tree(), thresholds)
+        for assignments in [ClusterAssignments.from_threshold_and_clusters(threshold_and_clusters),
+                            t2t.cluster_assignments(self.tree(), thresholds)]:
+            assert_equals([0.1, 0.3, 0.8], assignments.thresholds)
+            assert_equals(['A','B','C','D','E'], list(assignments.tip_names))
+            assert_equals([[0, 0, 0], [1, 0, 0], [2, 1, 0], [3, 1, 0], [4, 2, 1]], assignments.clusters.tolist())
+            assert_equals(['g__X.1', 'g__X.2', 'Root'], assignments.cluster_names[1])
+            assert_equals([2, 2, 1], list(assignments.cluster_sizes[1]))
+            for i, tc in enumerate(threshold_and_clusters):
+                assert_equals([c.lca_id for c in tc.clusters], list(assignments.cluster_lcas[i]))
+                for tip in 'ABCDE':
+                    cluster_index = assignments.tip_clusters(assignments.tip_index(tip))[i]
+                    assert_equals(tc.tip_name_to_cluster(tip).name(), assignments.cluster_name(i, cluster_index))
+            assert_equals(['g__X.4', 'g__X.2', 'f__Y'], assignments.tip_cluster_names('D'))
+            assert_raises(KeyError, assignments.tip_index, 'F')
+
+    def testSaveAndLoad(self):
+        assignments = Tree2Tax().cluster_assignments(self.tree(), [0.1, 0.3])
+        handle, path = tempfile.mkstemp(suffix='.npz')
+        os.close(handle)
+        try:
+            assignments.save(path)
+            loaded = ClusterAssignments.load(path)
+        finally:
+            os.remove(path)
+        assert_equals(assignments.thresholds, loaded.thresholds)
+        assert_equals(list(assignments.tip_names), list(loaded.tip_names))
+        assert_equals(assignments.clusters.tolist(), loaded.clusters.tolist())
+        assert_equals(assignments.cluster_names, [list(names) for names in loaded.cluster_names])
+        assert_equals(3, loaded.tip_index('D'))
+        for i in range(2):
+            assert_equals(list(assignments.cluster_lcas[i]), list(loaded.cluster_lcas[i]))
+            assert_equals(list(assignments.cluster_sizes[i]), list(loaded.cluster_sizes[i]))
+
+
+class TestNameIndex:
+    def testCollisions(self):
+        names = ["n%i" % i for i in range(1000)] + ['n5']
+        index = _NameIndex(names)
+        for i in range(1000):
+            assert_equals(i, index.index("n%i" % i))
+        assert_raises(KeyError, index.index, 'n1000')
+        assert_raises(KeyError, index.index, '')
+
+    def testEmpty(self):
+        assert_raises(KeyError, _NameIndex([]).index, 'a')
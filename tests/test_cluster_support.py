@@ -0,0 +1,55 @@
+from nose.tools import assert_equals, assert_raises
+from tree2tax.tree2tax import Tree2Tax
+from tree2tax.newick import NewickReader
+from tree2tax.cluster_support import ClusterSupport, ReplicateException
+from StringIO import StringIO
+import numpy as np
+
+class TestClusterSupport:
+    def random_tree(self, rand, num_tips, max_children=2):
+        clades = ["t%i:%f" % (i, rand.random()) for i in range(num_tips)]
+        while len(clades) > 1:
+            children = [clades.pop(rand.randrange(len(clades))) for _ in range(min(rand.randint(2, max_children), len(clades)))]
+            clades.append("(%s):%f" % (",".join(children), rand.random()))
+        return "(%s)root;" % clades[0]
+
+    def testMatchesTipSets(self):
+        import random
+        rand = random.Random(5)
+        thresholds = [0.5, 1.0, 2.0]
+        for threads, max_children in [(1, 2), (2, 2), (1, 4), (2, 4)]:
+            reference = NewickReader().read(StringIO(self.random_tree(rand, 20, max_children)))
+            replicates = "".join([self.random_tree(rand, 20, max_children) for _ in range(10)])
+            cluster_support = ClusterSupport(reference, thresholds, threads=threads)
+            cluster_support.add_replicates(NewickReader().each_tree(StringIO(replicates)), batch_size=3)
+            assert_equals(10, cluster_support.num_replicates)
+
+            # count with sets of tip names instead
+            counts = [np.zeros(len(tc.clusters)) for tc in cluster_support.threshold_and_clusters]
+            for replicate in NewickReader().each_tree(StringIO(replicates)):
+                for i, tc in enumerate(Tree2Tax().named_clusters_for_several_thresholds(replicate, thresholds)):
+                    replicate_sets = set([frozenset(c.tip_names()) for c in tc.clusters])
+                    for j, c in enumerate(cluster_support.threshold_and_clusters[i].clusters):
+                        if frozenset(c.tip_names()) in replicate_sets: counts[i][j] += 1
+            for expected, observed in zip(counts, cluster_support.support()):
+                assert_equals(list(expected / 10), list(observed))
+
+    def testSupport(self):
+        reference = NewickReader().read(StringIO("((A:1,B:1)'g__X':1,(C:1,D:1):3)root;"))
+        cluster_support = ClusterSupport(reference, [2.5])
+        # the same clusters with the children in another order, then C and
+        # D too far apart to be clustered together
+        cluster_support.add_replicates(NewickReader().each_tree(StringIO(
+            "((D:1,C:1):3,(B:1,A:1):1)root;((A:1,B:1):1,(C:1,D:5):3)root;")))
+        assert_equals(['g__X', 'Root'], [c.name() for c in cluster_support.threshold_and_clusters[0].clusters])
+        assert_equals([1.0, 0.5], list(cluster_support.support()[0]))
+        output = StringIO()
+        cluster_support.write(['G'], output)
+        assert_equals("level\tthreshold\tcluster\ttips\tsupport\n"
+                      "G\t2.5\tg__X\t2\t1.0000\n"
+                      "G\t2.5\tRoot\t2\t0.5000\n", output.getvalue())
+
+    def testDifferentTips(self):
+        cluster_support = ClusterSupport(NewickReader().read(StringIO("((A:1,B:1):1,C:1)root;")), [1.0])
+        for replicate in ["((A:1,B:1):1,D:1)root;", "((A:1,B:1):1,A:1)root;", "(A:1,B:1)root;"]:
+            assert_raises(ReplicateException, cluster_support.add_replicates, [NewickReader().read(StringIO(replicate))])
@@ -0,0 +1,106 @@
+from nose.tools import assert_equals, assert_true, assert_almost_equal
+from tree2tax.compact_tree import CompactTree, CompactNode, LCAIndex
+from skbio.tree import TreeNode
+from StringIO import StringIO
+
+class TestCompactTree:
+    def testFromTreeNode(self):
+        tree = TreeNode.read(StringIO('((A:0.11, B:0.12)C:0.1, D:0.2)root;'))
+        compact = CompactTree.from_tree_node(tree)
+        assert_equals(5, len(compact))
+        assert_equals(['root','C','A','B','D'], [compact.name(i) for i in range(5)])
+        assert_equals([-1, 0, 1, 1, 0], list(compact.parent))
+        assert_equals([1, 2, -1, -1, -1], list(compact.first_child))
+        assert_equals([-1, 4, 3, -1, -1], list(compact.next_sibling))
+        assert_equals([0.0, 0.1, 0.11, 0.12, 0.2], list(compact.length))
+        assert_equals([2, 3, 4], list(compact.tip_ids))
+        assert_equals([1, 4], compact.children(0))
+        assert_equals([5, 4, 3, 4, 5], list(compact.subtree_end))
+        
+    def testTipRange(self):
+        tree = TreeNode.read(StringIO('((A:1, B:2)C:3, (D:4, E:5)F:6)root;'))
+        compact = CompactTree.from_tree_node(tree)
+        assert_equals((0, 4), compact.tip_range(0))
+        assert_equals((0, 2), compact.tip_range(1))
+        assert_equals((2, 4), compact.tip_range(4))
+        assert_equals((3, 4), compact.tip_range(6))
+        
+    def testNamesInterned(self):
+        tree = TreeNode.read(StringIO('((A:1, B:2)X:3, (D:4, E:5)X:6);'))
+        compact = CompactTree.from_tree_node(tree)
+        assert_equals(-1, compact.name_id[0])
+        assert_equals(compact.name_id[1], compact.name_id[4])
+        assert_equals(None, compact.name(0))
+        
+    def testNodeReturnsOriginalTreeNode(self):
+        tree = TreeNode.read(StringIO('((A:1, B:2)C:3, D:4)root;'))
+        compact = CompactTree.from_tree_node(tree)
+        assert_true(compact.node(2) is tree.find('A'))
+        
+    def testCompactNode(self):
+        tree = TreeNode.read(StringIO('((A:1, B:2)C:3, D:4)root;'))
+        c = CompactTree.from_tree_node(tree)
+        compact = CompactTree(c.parent, c.first_child, c.next_sibling, c.length, c.name_id, c.names)
+        node = compact.node(1)
+        assert_true(isinstance(node, CompactNode))
+        assert_equals('C', node.name)
+        assert_equals(3.0, node.length)
+        assert_equals('root', node.parent.name)
+        assert_equals(None, node.parent.parent)
+        assert_equals(['A','B'], [n.name for n in node.children])
+        assert_equals(['A','B'], [n.name for n in node.tips()])
+        assert_true(node.children[0].is_tip())
+        assert_equals(compact.node(1), node)
+        
+    def testRootDistances(self):
+        tree = TreeNode.read(StringIO('((A:1, B:2)C:3, D:4)root;'))
+        compact = CompactTree.from_tree_node(tree)
+        assert_equals([0.0, 3.0, 4.0, 5.0, 4.0], list(compact.root_distances()))
+        
+        
+class TestLCAIndex:
+    def testLCA(self):
+        tree = TreeNode.read(StringIO('(((A:1, B:2)C:3, D:4)E:5, F:6)root;'))
+        compact = CompactTree.from_tree_node(tree)
+        index = LCAIndex(compact)
+        names = dict([(compact.name(i), i) for i in range(len(compact))])
+        assert_equals(names['C'], index.lca(names['A'], names['B']))
+        assert_equals(names['E'], index.lca(names['B'], names['D']))
+        assert_equals(names['root'], index.lca(names['F'], names['A']))
+        assert_equals(names['E'], index.lca(names['E'], names['A']))
+        assert_equals(names['A'], index.lca(names['A'], names['A']))
+        assert_equals([names['C'], names['root']],
+                      list(index.lca([names['A'], names['F']], [names['B'], names['D']])))
+        assert_equals(3.0, index.distance(names['A'], names['B']))
+        
+    def testGraft(self):
+        tree = TreeNode.read(StringIO('((A:1, B:2)C:3, (D:4, E:5)F:6)root;'))
+        compact = CompactTree.from_tree_node(tree)
+        a, c, f, e = [list(compact.names).index(n) for n in 'ACFE']
+        a, c, f, e = [list(compact.name_id).index(n) for n in [a, c, f, e]]
+        grafted, old_to_new = compact.graft([a, c, a, f, e], [0.5, 1, 0.2, 0, 5],
+                                            [9, 8, 7, 6, 5], ['n1','n2','n3','n4','n5'])
+        assert_equals("(((((A:0.2,n3:7.0):0.3,n1:9.0):0.5,B:2.0)C:1.0,n2:8.0):2.0,"
+                      "((D:4.0,(E:5.0,n5:5.0):0.0)F:0.0,n4:6.0):6.0)root;\n",
+                      str(grafted.to_tree_node()))
+        assert_equals(['root','C','A','B','F','D','E'], [grafted.name(i) for i in old_to_new])
+        assert_equals([grafted.name(i) for i in range(len(grafted))],
+                      [n.name for n in grafted.to_tree_node().preorder()])
+        
+    def testAllPairsMatchPathDistances(self):
+        tree = TreeNode.read(StringIO(
+            "((((a:1,b:2):0.5,(c:3,(d:1,e:1):2,f:0.1):1):2,g:7):0.3,(h:1,i:2,j:3):4,k:0.2)r;"))
+        compact = CompactTree.from_tree_node(tree)
+        index = LCAIndex(compact)
+        n = len(compact)
+        first = [i for i in range(n) for j in range(n)]
+        second = [j for i in range(n) for j in range(n)]
+        lcas = index.lca(first, second)
+        distances = index.distance(first, second)
+        for i, j, lca, distance in zip(first, second, lcas, distances):
+            ancestors = [i]
+            while ancestors[-1] > 0: ancestors.append(compact.parent[ancestors[-1]])
+            current = j
+            while current not in ancestors: current = compact.parent[current]
+            assert_equals(current, lca)
+            assert_almost_equal(compact.distance(i, j), distance)
@@ -0,0 +1,64 @@
+from nose.tools import assert_equals, assert_true, assert_raises
+from tree2tax.distance_statistics import DistanceStatistics
+import numpy as np
+
+class TestDistanceStatistics:
+    def testExactMedian(self):
+        stats = DistanceStatistics()
+        stats.add([3.0, 1.0])
+        stats.add(np.array([2.0]))
+        assert_equals(2.0, stats.median())
+        stats.add([10.0])
+        assert_equals(2.5, stats.median())
+        assert_equals(4, stats.count)
+        assert_equals(1.0, stats.minimum)
+        assert_equals(10.0, stats.maximum)
+        
+    def testManyBlocks(self):
+        values = np.random.RandomState(0).random_sample(5001)
+        stats = DistanceStatistics()
+        for i in range(0, len(values), 1000):
+            stats.add(values[i:i+1000])
+        assert_equals(np.median(values), stats.median())
+        assert_equals([float(np.percentile(values, 25))], stats.quantiles([0.25]))
+        
+    def testEmpty(self):
+        stats = DistanceStatistics()
+        stats.add([])
+        assert_equals(None, stats.median())
+        assert_equals([None], stats.quantiles([0.5]))
+        assert_equals([], stats.histogram())
+        
+    def testSketch(self):
+        values = np.random.RandomState(0).random_sample(100000)
+        stats = DistanceStatistics(sketch_size=1000)
+        for i in range(0, len(values), 7000):
+            stats.add(values[i:i+7000])
+        assert_equals(100000, stats.count)
+        assert_equals(1000, len(stats.values()))
+        assert_true(abs(stats.median() - 0.5) < 0.05)
+        
+    def testHistogram(self):
+        stats = DistanceStatistics(bin_width=0.5)
+        stats.add([0.1, 0.2, 1.2])
+        stats.add([0.7])
+        assert_equals([(0.0, 0.5, 2), (0.5, 1.0, 1), (1.0, 1.5, 1)], stats.histogram())
+
+    def testHistogramGrows(self):
+        stats = DistanceStatistics(bin_width=0.5, max_bins=4)
+        stats.add([0.1, 1.2])
+        assert_equals([(0.0, 0.5, 1), (0.5, 1.0, 0), (1.0, 1.5, 1)], stats.histogram())
+        # beyond the 4th bin, so the width doubles twice
+        stats.add([7.5, 0.7])
+        assert_equals([(0.0, 2.0, 3), (2.0, 4.0, 0), (4.0, 6.0, 0), (6.0, 8.0, 1)], stats.histogram())
+        assert_equals(4, len(stats._bin_counts))
+        
+    def testNonFinite(self):
+        for bad in [float('inf'), float('nan')]:
+            stats = DistanceStatistics(max_bins=4)
+            stats.add([1.0])
+            assert_raises(ValueError, stats.add, [2.0, bad])
+            # nothing of the rejected block is kept
+            assert_equals(1, stats.count)
+            assert_equals(1.0, stats.maximum)
+            assert_equals(1, sum([count for _, _, count in stats.histogram()]))
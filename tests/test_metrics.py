@@ -0,0 +1,64 @@
+from nose.tools import assert_equals, assert_true
+from tree2tax.metrics import Metrics
+from tree2tax.tree2tax import Tree2Tax
+from skbio.tree import TreeNode
+from StringIO import StringIO
+import tempfile
+import shutil
+import os
+import json
+import pstats
+
+class TestMetrics:
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        
+    def teardown(self):
+        shutil.rmtree(self.directory)
+        
+    def testStages(self):
+        metrics = Metrics()
+        with metrics.stage('parse', source='x') as stage:
+            stage.count('tips', 3)
+        metrics.count('runs', 1)
+        path = os.path.join(self.directory, 'metrics.json')
+        metrics.write(path)
+        with open(path) as f:
+            report = json.load(f)
+        assert_equals({'runs': 1}, report['counters'])
+        assert_equals(1, len(report['stages']))
+        assert_equals('parse', report['stages'][0]['name'])
+        assert_equals({'source': 'x', 'tips': 3}, report['stages'][0]['counters'])
+        assert_true(report['stages'][0]['seconds'] >= 0)
+        assert_true(report['stages'][0]['process_peak_rss_kb'] > 0)
+        assert_true(report['stages'][0]['peak_rss_increase_kb'] >= 0)
+        assert_true(report['process_peak_rss_kb'] >= report['stages'][0]['process_peak_rss_kb'])
+        
+    def testChildren(self):
+        import multiprocessing
+        metrics = Metrics()
+        with metrics.stage('children') as stage:
+            pool = multiprocessing.Pool(1)
+            pool.map(sorted, [range(10)])
+            pool.close()
+            pool.join()
+        report = metrics.report()
+        assert_true(report['stages'][0]['children_peak_rss_kb'] > 0)
+        assert_true(report['children_peak_rss_kb'] > 0)
+        
+    def testClusteringCounters(self):
+        tree = TreeNode.read(StringIO('((A:0.11, B:0.12)C:0.1, D:0.2)root;'))
+        metrics = Metrics()
+        Tree2Tax().named_clusters_for_several_thresholds(tree, [0.25, 0.05], metrics=metrics)
+        clusters = [s.counters for s in metrics.stages if s.name == 'cluster']
+        assert_equals([0.05, 0.25], [c['threshold'] for c in clusters])
+        assert_equals([3, 2], [c['clusters'] for c in clusters])
+        assert_equals([3, 1], [c['singletons'] for c in clusters])
+        assert_equals([0, 1], [c['merges'] for c in clusters])
+        
+    def testProfile(self):
+        path = os.path.join(self.directory, 'profile')
+        metrics = Metrics(profile_path=path)
+        sorted(range(10))
+        metrics.finish()
+        pstats.Stats(path)
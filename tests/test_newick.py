@@ -0,0 +1,65 @@
+from nose.tools import assert_equals, assert_raises
+from tree2tax.newick import NewickReader, NewickFormatException
+from tree2tax.compact_tree import CompactTree
+from skbio.tree import TreeNode
+from StringIO import StringIO
+import tempfile
+import gzip
+import bz2
+import os
+
+class TestNewickReader:
+    trees = ["((A:0.11, B:0.12)C:0.1, D:0.2)root;",
+             "((((A:11, B:12)C:10, D:9)E:20, F:20)G:30)root;",
+             "((F:20, ((A:11, B:12):10, (H:8, D:9):3):20)'0.7:G':30)root;",
+             "(((A:1, B:2)'g__genus1':3, (C:4, D:5)'g__genus2; s__spec':6)'f__family':10)root;",
+             "((A_1:1,'B_2':2)'it''s':3,(C,D)E[a comment],F)0.95;",
+             "(A,B,(C,D));",
+             "A;"]
+    
+    def assertSameAsSkbio(self, newick, observed):
+        expected = CompactTree.from_tree_node(TreeNode.read(StringIO(newick)))
+        for array_name in ['parent','first_child','next_sibling','length']:
+            assert_equals(list(getattr(expected, array_name)), list(getattr(observed, array_name)))
+        assert_equals([expected.name(i) for i in range(len(expected))],
+                      [observed.name(i) for i in range(len(observed))])
+        
+    def testSameAsSkbio(self):
+        for newick in self.trees:
+            self.assertSameAsSkbio(newick, NewickReader().read(StringIO(newick)))
+            
+    def testSmallChunks(self):
+        for newick in self.trees:
+            for chunk_size in [1, 2, 3, 7]:
+                self.assertSameAsSkbio(newick, NewickReader(chunk_size=chunk_size).read(StringIO(newick)))
+                
+    def testReplaceSpacesWithUnderscores(self):
+        tree = NewickReader(replace_spaces_with_underscores=True).read(StringIO("((a__b:1,c:2)g__Foo:3);"))
+        assert_equals(['a  b', 'c', 'g__Foo'], sorted(tree.names))
+        
+    def testMultipleTrees(self):
+        trees = list(NewickReader().each_tree(StringIO("(A:1,B:2);\n(A:3,(B:1,C:1):2);\n")))
+        assert_equals(2, len(trees))
+        assert_equals(3, len(trees[0]))
+        assert_equals(5, len(trees[1]))
+        
+    def testCompressed(self):
+        newick = self.trees[3]
+        for opener in [gzip.open, bz2.BZ2File]:
+            handle, path = tempfile.mkstemp()
+            os.close(handle)
+            try:
+                f = opener(path, 'wb')
+                f.write(newick)
+                f.close()
+                self.assertSameAsSkbio(newick, NewickReader(chunk_size=5).read(path))
+            finally:
+                os.remove(path)
+                
+    def testUnbalanced(self):
+        with assert_raises(NewickFormatException):
+            NewickReader().read(StringIO("((A:1,B:2);"))
+        with assert_raises(NewickFormatException):
+            NewickReader().read(StringIO("(A:1,B:2)"))
+        with assert_raises(NewickFormatException):
+            NewickReader().read(StringIO("('A:1,B:2);"))
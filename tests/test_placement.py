@@ -0,0 +1,144 @@
+from nose.tools import assert_equals
+from tree2tax.tree2tax import Tree2Tax
+from tree2tax.compact_tree import CompactTree
+from tree2tax.taxonomy_writer import TaxonomyWriter
+from tree2tax.placement import PlacementIndex, JplaceReader, _sibling_distances
+from skbio.tree import TreeNode
+from StringIO import StringIO
+import numpy as np
+import tempfile
+import json
+import os
+
+class TestPlacementIndex:
+    def tree(self):
+        return TreeNode.read(StringIO(
+            "((('A':0.1,'B':0.1)'g__X':0.1,('C':0.1,'D':0.1)'g__X':0.5)'f__Y':0.5,'E':0.1)root;"))
+
+    def testPlacedOnTipHasItsLineage(self):
+        thresholds = [0.3, 0.5, 2.0]
+        threshold_and_clusters = Tree2Tax().named_clusters_for_several_thresholds(self.tree(), thresholds)
+        index = PlacementIndex.build(threshold_and_clusters, ['A', 'B', 'C'])
+        compact = index.tree
+        tips = compact.tip_ids
+        lineages = index.lineages(index.classify(tips, np.zeros(len(tips)), np.zeros(len(tips))))
+        expected = {}
+        for tip_names, lineage in TaxonomyWriter(['A', 'B', 'C']).each_lineage(threshold_and_clusters):
+            for name in tip_names: expected[name] = lineage
+        assert_equals([expected[compact.name(t)] for t in tips], lineages)
+
+    def testClassify(self):
+        index = PlacementIndex.build(Tree2Tax().named_clusters_for_several_thresholds(self.tree(), [0.3]))
+        names = list(index.tree.names)
+        a, c, x = [list(index.tree.name_id).index(names.index(n)) for n in ['A', 'C', 'g__X']]
+        # near A joins A and B, but too far does not, nor does a placement
+        # above the clusters
+        assignments = index.classify([a, a, c, 1], [0.05, 0.05, 0, 0.1], [0.01, 0.5, 0.05, 0])
+        assert_equals([0, -1, 1, -1], list(assignments[:, 0]))
+        assert_equals(['g__X.1', 'g__X.2', 'Root'], index.cluster_names[0])
+
+    def testMatchesGrafting(self):
+        import random
+        rand = random.Random(7)
+        thresholds = [0.3, 0.8, 1.5]
+        t2t = Tree2Tax()
+        for max_children in [2, 4]:
+            for _ in range(10):
+                tree = TreeNode.read(StringIO(self.random_tree(rand, rand.randint(2, 30), max_children)))
+                threshold_and_clusters = t2t.named_clusters_for_several_thresholds(tree, thresholds)
+                index = PlacementIndex.build(threshold_and_clusters)
+                compact = index.tree
+                state = t2t.clustering_state(compact, thresholds)
+                for _ in range(5):
+                    edge = rand.randrange(1, len(compact))
+                    self.assert_matches_grafting(index, threshold_and_clusters, state, edge,
+                                                 rand.random()*compact.length[edge], rand.random()*0.5)
+
+    def testMultifurcation(self):
+        tree = TreeNode.read(StringIO("((a:0.1,b:0.1,c:0.4)'f__F':0.5,(d:0.1,e:0.1):0.5);"))
+        t2t = Tree2Tax()
+        threshold_and_clusters = t2t.named_clusters_for_several_thresholds(tree, [1.0])
+        index = PlacementIndex.build(threshold_and_clusters, ['G'])
+        state = t2t.clustering_state(tree, [1.0])
+        a = [t for t in index.tree.tip_ids if index.tree.name(t) == 'a'][0]
+        # b is near, but c is not
+        assert_equals([[-1], [0]], index.classify([a, a], [0, 0], [0.55, 0.3]).tolist())
+        assert_equals(['G__fF'], index.lineages(index.classify([a], [0], [0.3])))
+        for pendant in [0.55, 0.3]:
+            self.assert_matches_grafting(index, threshold_and_clusters, state, a, 0, pendant)
+
+    def testSiblingDistances(self):
+        compact = CompactTree.from_tree_node(TreeNode.read(StringIO(
+            "((a:0.1,b:0.1,c:0.4)'f__F':0.5,(d:0.1,e:0.1):0.5);")))
+        heights = Tree2Tax()._heights_and_merge_heights(compact)[0]
+        # the farthest via any sibling, not just the next one
+        assert_equals([-np.inf, 0.6, 0.4, 0.4, 0.1, 0.9, 0.1, 0.1],
+                      [round(d, 6) for d in _sibling_distances(compact, heights)])
+
+    def assert_matches_grafting(self, index, threshold_and_clusters, state, edge, distal, pendant):
+        '''assert that a placement is classified into the cluster it is in
+        after grafting it into the clustered tree'''
+        t2t = Tree2Tax()
+        thresholds = [tc.threshold for tc in threshold_and_clusters]
+        assignments = index.classify([edge], [distal], [pendant])[0]
+        # the tree of the state has its multifurcations resolved
+        if state.tree.resolved_from is not None: edge = state.tree.resolved_node_ids[edge]
+        grafted_state, _ = t2t.recluster_with_grafts(state, ['Q'], [edge], [distal], [pendant])
+        grafted = grafted_state.tree
+        query = [t for t in grafted.tip_ids if grafted.name(t) == 'Q'][0]
+        for level, threshold in enumerate(index.thresholds):
+            lcas = grafted_state.cluster_lcas[grafted_state.thresholds.index(threshold)]
+            lca = lcas[np.searchsorted(lcas, query, side='right')-1]
+            start, end = grafted.tip_range(lca)
+            with_query = set([grafted.name(t) for t in grafted.tip_ids[start:end]]) - set(['Q'])
+            clusters = threshold_and_clusters[thresholds.index(threshold)].clusters
+            old = [set([t.name for t in c.tips]) for c in clusters]
+            if assignments[level] >= 0:
+                assert_equals(old[assignments[level]], with_query)
+            else:
+                assert with_query not in old
+
+    def random_tree(self, rand, num_tips, max_children=2):
+        clades = ["t%i:%f" % (i, rand.random()) for i in range(num_tips)]
+        while len(clades) > 1:
+            children = [clades.pop(rand.randrange(len(clades))) for _ in range(min(rand.randint(2, max_children), len(clades)))]
+            clades.append("(%s):%f" % (",".join(children), rand.random()))
+        return "(%s)root;" % clades[0]
+
+    def testSaveAndLoad(self):
+        index = PlacementIndex.build(Tree2Tax().named_clusters_for_several_thresholds(self.tree(), [0.3, 0.8]))
+        handle, path = tempfile.mkstemp(suffix='.npz')
+        os.close(handle)
+        try:
+            index.save(path)
+            loaded = PlacementIndex.load(path)
+        finally:
+            os.remove(path)
+        assert_equals(index.thresholds, loaded.thresholds)
+        assert_equals(index.level_names, loaded.level_names)
+        assert_equals(index.cluster_names, loaded.cluster_names)
+        assert_equals(index.lineage_parts, loaded.lineage_parts)
+        edges = np.arange(1, len(index.tree))
+        assert_equals(index.classify(edges, edges*0.0, edges*0.0+0.01).tolist(),
+                      loaded.classify(edges, edges*0.0, edges*0.0+0.01).tolist())
+
+
+class TestJplaceReader:
+    def testRead(self):
+        compact = CompactTree.from_tree_node(TreeNode.read(StringIO("((A:1,B:2)C:3,D:4)root;")))
+        jplace = {'tree': "((A:1{0},B:2{1})C:3{2},D:4{3}):0{4};",
+                  'fields': ['edge_num', 'likelihood', 'like_weight_ratio', 'distal_length', 'pendant_length'],
+                  'placements': [{'p': [[1, -10, 0.2, 0.5, 0.1], [3, -5, 0.8, 1.5, 0.2]], 'n': ['q1']},
+                                 {'p': [[2, -10, 1.0, 0.25, 0.3]], 'nm': [['q2', 1], ['q3', 2]]}],
+                  'version': 3}
+        handle, path = tempfile.mkstemp(suffix='.jplace')
+        with os.fdopen(handle, 'w') as f:
+            json.dump(jplace, f)
+        try:
+            names, edges, distal_lengths, pendant_lengths = JplaceReader().read(path, compact)
+        finally:
+            os.remove(path)
+        assert_equals(['q1', 'q2', 'q3'], names)
+        assert_equals(['D', 'C', 'C'], [compact.name(e) for e in edges])
+        assert_equals([1.5, 0.25, 0.25], list(distal_lengths))
+        assert_equals([0.2, 0.3, 0.3], list(pendant_lengths))
@@ -0,0 +1,164 @@
+from nose.tools import assert_equals, assert_raises
+from tree2tax.tree2tax import Tree2Tax
+from tree2tax.compact_tree import CompactTree
+from tree2tax.taxonomy_writer import TaxonomyWriter
+from tree2tax.server import TreeService, TreeServiceException, TreeServiceUnixServer
+from skbio.tree import TreeNode
+from StringIO import StringIO
+import httplib
+import socket
+import tempfile
+import threading
+import shutil
+import json
+import os
+
+TREE = "((('A':0.1,'B':0.1)'g__X':0.1,('C':0.1,'D':0.1)'g__X':0.5)'f__Y':0.5,'E':0.1)root;"
+
+class TestTreeService:
+    def service(self):
+        return TreeService(CompactTree.from_tree_node(TreeNode.read(StringIO(TREE))), cache_size=2)
+
+    def expected_lineages(self, thresholds):
+        threshold_and_clusters = Tree2Tax().named_clusters_for_several_thresholds(TreeNode.read(StringIO(TREE)), thresholds)
+        expected = {}
+        for tip_names, lineage in TaxonomyWriter('K P C O F G S'.split()).each_lineage(threshold_and_clusters):
+            for name in tip_names: expected[name] = lineage
+        return expected
+
+    def testLineages(self):
+        service = self.service()
+        for thresholds in [[0.3, 0.1], [0.8], [0.1, 0.3]]:
+            assert_equals(self.expected_lineages(thresholds), service.lineages(thresholds))
+        assert_equals(self.expected_lineages([0.1])['C'], service.lineage('C', [0.1]))
+        assert_equals(['A', 'D'], sorted(service.lineages([0.1], ['D', 'A']).keys()))
+        assert_raises(KeyError, service.lineage, 'F', [0.1])
+        assert_raises(TreeServiceException, service.lineages, [])
+
+    def testCache(self):
+        service = self.service()
+        service.lineages([0.1, 0.3])
+        misses = service.misses
+        # the same set in a different order, and a threshold of it alone
+        # are not clustered again
+        service.lineages([0.3, 0.1])
+        service.threshold_and_clusters(0.3)
+        assert_equals(misses, service.misses)
+        # only 2 of each are kept
+        service.threshold_and_clusters(0.5)
+        service.threshold_and_clusters(0.8)
+        service.threshold_and_clusters(0.1)
+        assert_equals(misses+3, service.misses)
+        assert_equals([0.8, 0.1], service._threshold_cache.keys())
+
+    def testClassify(self):
+        service = self.service()
+        jplace = {'tree': "(((A:0.1{0},B:0.1{1})g__X:0.1{2},(C:0.1{3},D:0.1{4})g__X:0.5{5})f__Y:0.5{6},E:0.1{7}):0{8};",
+                  'fields': ['edge_num', 'distal_length', 'pendant_length'],
+                  'placements': [{'p': [[0, 0.05, 0.01]], 'n': ['q1']}, {'p': [[7, 0.05, 0.01]], 'n': ['q2']}],
+                  'version': 3}
+        lineages = service.classify(jplace, [0.3])
+        assert_equals(self.expected_lineages([0.3])['A'], lineages['q1'])
+        assert_equals(self.expected_lineages([0.3])['E'], lineages['q2'])
+
+    def testMultifurcation(self):
+        tree = "((A:1,B:2,C:3)'g__D':1,(E:1,F:1,G:1,H:4)'g__I':1)root;"
+        service = TreeService(CompactTree.from_tree_node(TreeNode.read(StringIO(tree))))
+        threshold_and_clusters = Tree2Tax().named_clusters_for_several_thresholds(TreeNode.read(StringIO(tree)), [3, 5])
+        expected = {}
+        for tip_names, lineage in TaxonomyWriter('K P C O F G S'.split()).each_lineage(threshold_and_clusters):
+            for name in tip_names: expected[name] = lineage
+        assert_equals(expected, service.lineages([3, 5]))
+
+        # placements are on the edges of the tree as given, A being edge 0
+        jplace = {'tree': "((A:1{0},B:2{1},C:3{2})g__D:1{3},(E:1{4},F:1{5},G:1{6},H:4{7})g__I:1{8}):0{9};",
+                  'fields': ['edge_num', 'distal_length', 'pendant_length'],
+                  'placements': [{'p': [[0, 0, 0]], 'n': ['q1']}, {'p': [[0, 0, 0.5]], 'n': ['q2']},
+                                 {'p': [[0, 0, 1.5]], 'n': ['q3']}],
+                  'version': 3}
+        lineages = service.classify(jplace, [3, 5])
+        # within 3 of A and B, then within 5 of A, B and C, then of none
+        assert_equals(expected['A'], lineages['q1'])
+        assert_equals(expected['A'].split('; ')[0], lineages['q2'])
+        assert_equals('', lineages['q3'])
+
+
+class _UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, path):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+class TestTreeServiceUnixServer:
+    def testRequests(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'tree2tax.sock')
+        service = TreeService(CompactTree.from_tree_node(TreeNode.read(StringIO(TREE))))
+        server = TreeServiceUnixServer(path, service)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            def request(method, url, body=None):
+                connection = _UnixHTTPConnection(path)
+                connection.request(method, url, None if body is None else json.dumps(body))
+                response = connection.getresponse()
+                result = response.status, json.loads(response.read())
+                connection.close()
+                return result
+            status, response = request('POST', '/lineage', {'tip': 'C', 'thresholds': [0.1, 0.3]})
+            assert_equals(200, status)
+            assert_equals(service.lineage('C', [0.1, 0.3]), response['lineage'])
+            status, response = request('POST', '/cluster', {'thresholds': [0.3], 'tips': ['A', 'E']})
+            assert_equals(200, status)
+            assert_equals(['A', 'E'], sorted(response['lineages'].keys()))
+            assert_equals(400, request('POST', '/lineage', {'tip': 'F', 'thresholds': [0.1]})[0])
+            assert_equals(400, request('POST', '/cluster', {})[0])
+            assert_equals(404, request('POST', '/other', {})[0])
+            # the tree has no ranks from which to find thresholds
+            status, response = request('POST', '/find_thresholds', {'prefixes': 'k p c'})
+            assert_equals(400, status)
+            assert 'error' in response
+            for url, body in [('/lineage', {'tip': 5, 'thresholds': [0.1]}),
+                              ('/lineage', {'tip': 'C', 'thresholds': 0.1}),
+                              ('/cluster', {'thresholds': [0.1], 'tips': 'A'}),
+                              ('/cluster', {'thresholds': [0.1], 'level_names': [1]}),
+                              ('/classify', {'jplace': [], 'thresholds': [0.1]}),
+                              ('/find_thresholds', {'prefixes': 'g', 'sketch_size': 'big'})]:
+                status, response = request('POST', url, body)
+                assert_equals(400, status)
+                assert 'error' in response
+            # unexpected errors are reported too
+            def fail(*args): raise RuntimeError("unexpected")
+            service.find_thresholds = fail
+            assert_equals((500, {'error': 'unexpected'}), request('POST', '/find_thresholds', {'prefixes': 'g'}))
+            status, response = request('GET', '/info')
+            assert_equals(5, response['tips'])
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(directory)
+
+    def testOnlySocketsRemoved(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'tree2tax.sock')
+        service = TreeService(CompactTree.from_tree_node(TreeNode.read(StringIO(TREE))))
+        try:
+            with open(path, 'w') as f: f.write('data')
+            assert_raises(TreeServiceException, TreeServiceUnixServer, path, service)
+            assert_equals('data', open(path).read())
+            os.remove(path)
+
+            # a socket left behind is replaced
+            stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            stale.bind(path)
+            stale.close()
+            server = TreeServiceUnixServer(path, service)
+            server.server_close()
+            assert not os.path.exists(path)
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,39 @@
+from nose.tools import assert_equals
+from tree2tax.tree2tax import Tree2Tax
+from tree2tax.taxonomy_writer import TaxonomyWriter
+from skbio.tree import TreeNode
+from StringIO import StringIO
+
+class TestTaxonomyWriter:
+    def write(self, newick, thresholds, **kwargs):
+        tree = TreeNode.read(StringIO(newick))
+        clusters = Tree2Tax().named_clusters_for_several_thresholds(tree, thresholds)
+        output = StringIO()
+        TaxonomyWriter(**kwargs).write(clusters, output)
+        return output.getvalue()
+    
+    def testSimple(self):
+        assert_equals("A\tK__Root; P__C; C__C.1\n"
+                      "B\tK__Root; P__C; C__C.2\n"
+                      "D\tK__Root; P__Root; C__Root\n",
+                      self.write('((A:0.11, B:0.12)C:0.1, D:0.2)root;', [0.25, 0.5, 0.05]))
+        
+    def testMissingTaxonomy(self):
+        assert_equals("A\tK__fE; P__gC\n"
+                      "B\tK__fE; P__gC\n"
+                      "D\tK__fE; P__fE\n"
+                      "F\tK__G; P__G\n",
+                      self.write("((((A:11, B:12)'g__C':10, D:9)'f__E':20, F:20)G:30)root;", [40, 25]))
+        assert_equals("A\tK__G; P__fE..gC\n"
+                      "B\tK__G; P__fE..gC\n"
+                      "D\tK__G; P__fE..fE\n"
+                      "F\tK__G; P__G\n",
+                      self.write("((((A:11, B:12)'g__C':10, D:9)'f__E':20, F:20)G:30)root;", [70, 25]))
+        
+    def testSmallBuffer(self):
+        newick = "((F:20, ((A:11, B:12):10, (H:8, D:9):3):20)G:30)root;"
+        assert_equals(self.write(newick, [25, 40]), self.write(newick, [25, 40], buffer_size=1))
+        
+    def testLevelNames(self):
+        assert_equals("A\tx__C; y__C.1\nB\tx__C; y__C.2\nD\tx__Root; y__Root\n",
+                      self.write('((A:0.11, B:0.12)C:0.1, D:0.2)root;', [0.25, 0.05], level_names=['x','y']))
@@ -3,10 +3,13 @@ from StringIO import StringIO
 import sys
 import os
 import unittest
+import numpy
 
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'..'))
 from tree2tax.threshold_finder import ThresholdFinder,\
     ThresholdInconsistencyException
+from tree2tax.newick import NewickReader
+from tree2tax.distance_statistics import DistanceStatistics
 
 class Tests(unittest.TestCase):
     def assertSameCladeDistanceSet(self, expected, observed):
@@ -48,6 +51,82 @@ class Tests(unittest.TestCase):
         self.assertSameCladeDistanceSet([],
                                          examples)
         
+    def testCompactTree(self):
+        tree = NewickReader().read(StringIO("(((A:1, B:2)'g__genus1':3, (C:4, D:5)'g__genus2':6, E:1)'f__family':10)root;"))
+        examples = ThresholdFinder().find_examples(tree, 'f', 'g')
+        self.assertSameCladeDistanceSet([['f__family','g__genus2','g__genus1',16.0]],
+                                         examples)
+        
+    def testDistanceBlocks(self):
+        tree = NewickReader().read(StringIO("(((A:1, B:2)'g__1':3, (C:4, D:5)'g__2':6, (E:1, F:1)'g__3':1, (G:1, H:1)'g__4':1)'f__family':10)root;"))
+        finder = ThresholdFinder()
+        compact, lca_index, rank_table = finder._indexed_tree(tree)
+        whole = list(finder._each_distance_block(compact, lca_index, rank_table, 'f', 'g'))
+        split = list(finder._each_distance_block(compact, lca_index, rank_table, 'f', 'g', max_pairs=2))
+        self.assertEqual(1, len(whole))
+        self.assertEqual(3, len(split))
+        self.assertEqual(list(whole[0][4]), list(numpy.concatenate([b[4] for b in split])))
+        self.assertEqual(list(whole[0][2]), list(numpy.concatenate([b[2] for b in split])))
+        self.assertEqual(list(whole[0][3]), list(numpy.concatenate([b[3] for b in split])))
+        
+    def testRankDistanceStatistics(self):
+        tree = TreeNode.read(StringIO("(((A:1, B:2)'g__genus1':3, (C:4, D:5)'g__genus2':6)'f__family':10)root;"))
+        statistics = ThresholdFinder().rank_distance_statistics(tree, ['f','g','s'])
+        self.assertEqual(2, len(statistics))
+        self.assertEqual(16.0, statistics[0].median())
+        self.assertEqual(0, statistics[1].count)
+        
+    def testParallelMatchesSerial(self):
+        newick = "((((A:1, B:2)'g__1':3, (C:4, D:5)'g__2':6, (E:1, F:1)'g__3':1)'f__1':2, ((G:1, H:1)'g__4':1, (I:1, J:3)'g__5':2)'f__2':1)'o__1':1, ((K:1, L:1)'g__6':1, (M:2, N:2)'g__7':1)'f__3; o__2':1)root;"
+        tree = NewickReader().read(StringIO(newick))
+        finder = ThresholdFinder()
+        serial = finder.rank_distance_statistics(tree, ['o','f','g'], sketch_size=2)
+        compact, lca_index, rank_table = finder._indexed_tree(tree)
+        parallel = [DistanceStatistics(sketch_size=2) for _ in range(2)]
+        # tiny tasks, so that there are several per level
+        finder._parallel_rank_distances(compact, lca_index, rank_table, ['o','f','g'], parallel, 2, max_pairs=1)
+        for s, p in zip(serial, parallel):
+            self.assertEqual(s.count, p.count)
+            self.assertEqual(list(s.values()), list(p.values()))
+            self.assertEqual(s.histogram(), p.histogram())
+        self.assertEqual(finder.find_thresholds(tree, ['o','f','g']),
+                         finder.find_thresholds(tree, ['o','f','g'], threads=2))
+        
+    def testParallelTaskSize(self):
+        '''each task gives at most max_pairs distances, however large the clades'''
+        import tree2tax.threshold_finder as threshold_finder
+        newick = "(((A:1, B:2)'g__1':3, (C:4, D:5)'g__2':6, (E:1, F:1)'g__3':1, (G:1, H:1)'g__4':1, (I:1, J:1)'g__5':1)'f__1':1, ((K:1, L:1)'g__6':1, (M:2, N:2)'g__7':1)'f__2':1)root;"
+        tree = NewickReader().read(StringIO(newick))
+        finder = ThresholdFinder()
+        compact, lca_index, rank_table = finder._indexed_tree(tree)
+        serial = [distances for _, _, _, _, distances in finder._each_distance_block(compact, lca_index, rank_table, 'f', 'g')]
+        clades, task_levels, tasks = finder._parallel_tasks(compact, rank_table, ['f','g'], max_pairs=4)
+        self.assertEqual(4, len(tasks))
+        threshold_finder._shared_lca_index = lca_index
+        threshold_finder._shared_clades = clades
+        try:
+            results = [threshold_finder._clade_distances(task) for task in tasks]
+        finally:
+            threshold_finder._shared_lca_index = None
+            threshold_finder._shared_clades = None
+        for block_distances in results:
+            self.assertTrue(sum([len(d) for d in block_distances]) <= 4)
+        self.assertEqual(list(numpy.concatenate(serial)),
+                         list(numpy.concatenate([d for block_distances in results for d in block_distances])))
+        
+    def testUniqueBestDistance(self):
+        tree = NewickReader().read(StringIO("((((A:1, B:52)'g__genus1':3, D:50, (E:1)F:2)'g__genus2':6)'f__family':10)root;"))
+        annotated = [tree.name(i) in ('g__genus1','g__genus2') for i in range(len(tree))]
+        distances = ThresholdFinder()._unique_best_distances(tree, numpy.array(annotated))
+        self.assertEqual([0.0, 0.0, 50.0, 52.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+                         list(distances))
+        
+    def testUniqueBestDistanceOfTreeNodes(self):
+        tree = TreeNode.read(StringIO("((((A:1, B:52)'g__genus1':3, D:50, (E:1)F:2)'g__genus2':6)'f__family':10)root;"))
+        nodes = [tree.find('g__genus2'), tree.find('g__genus1')]
+        self.assertEqual([50.0, 52.0], ThresholdFinder().unique_best_distance(nodes))
+        self.assertEqual([], ThresholdFinder().unique_best_distance([]))
+        
     def test_find_thresholds_from_example_distances(self):
         finder = ThresholdFinder()
         self.assertEqual([2.5,1.5], finder._find_thresholds_from_example_distances([3,2,1]))
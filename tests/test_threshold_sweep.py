@@ -0,0 +1,77 @@
+from nose.tools import assert_equals
+from tree2tax.tree2tax import Tree2Tax, RankTable
+from tree2tax.compact_tree import CompactTree
+from tree2tax.threshold_sweep import ThresholdSweep
+from skbio.tree import TreeNode
+from StringIO import StringIO
+import numpy as np
+
+class TestThresholdSweep:
+    def random_tree(self, rand, num_tips):
+        clades = ["t%i:%f" % (i, rand.random()) for i in range(num_tips)]
+        while len(clades) > 1:
+            first = clades.pop(rand.randrange(len(clades)))
+            second = clades.pop(rand.randrange(len(clades)))
+            label = rand.choice(['', '', "'g__A'", "'f__B; g__C'"])
+            clades.append("(%s,%s)%s:%f" % (first, second, label, rand.random()))
+        return TreeNode.read(StringIO("(%s)root;" % clades[0]))
+
+    def testMatchesClustering(self):
+        import random
+        rand = random.Random(11)
+        t2t = Tree2Tax()
+        for _ in range(10):
+            compact = CompactTree.from_tree_node(self.random_tree(rand, rand.randint(1, 40)))
+            merge_heights = t2t.merge_heights(compact)
+            threshold_sweep = ThresholdSweep(compact, merge_heights)
+            breakpoints = threshold_sweep.breakpoints()
+            # either side of, and exactly on, each breakpoint
+            thresholds = sorted(list(breakpoints) + list(breakpoints - 1e-9) + [0.0, 100.0])
+            num_clusters = threshold_sweep.num_clusters(thresholds)
+            num_singletons = threshold_sweep.num_singletons(thresholds)
+            agreement = dict([(rank, threshold_sweep.rank_agreement(rank, thresholds)) for rank in 'fg'])
+            rank_table = RankTable(compact)
+            for i, threshold in enumerate(thresholds):
+                lcas = t2t.cluster_lcas(compact, merge_heights, threshold)
+                assert_equals(len(lcas), num_clusters[i])
+                assert_equals(np.count_nonzero(compact.is_tip[lcas]), num_singletons[i])
+                for rank in 'fg':
+                    nodes = rank_table.nodes_with_rank(rank)
+                    recovered = len(set(nodes) & set(lcas))
+                    split = np.count_nonzero(merge_heights[nodes] > threshold)
+                    num_taxa, observed_recovered, observed_split, observed_lumped = agreement[rank]
+                    assert_equals(len(nodes), num_taxa)
+                    assert_equals(recovered, observed_recovered[i])
+                    assert_equals(split, observed_split[i])
+                    assert_equals(len(nodes) - recovered - split, observed_lumped[i])
+
+    def testBreakpoints(self):
+        tree = TreeNode.read(StringIO('((A:0.125, B:0.25)C:0.125, D:0.375)root;'))
+        threshold_sweep = ThresholdSweep(CompactTree.from_tree_node(tree))
+        assert_equals([0.375, 0.75], list(threshold_sweep.breakpoints()))
+        assert_equals([0.75], list(threshold_sweep.breakpoints(0.5)))
+        assert_equals([3, 2, 1], list(threshold_sweep.num_clusters([0.125, 0.375, 0.75])))
+        assert_equals([3, 1, 0], list(threshold_sweep.num_singletons([0.125, 0.375, 0.75])))
+
+    def testWrite(self):
+        tree = TreeNode.read(StringIO("(('A':0.125, 'B':0.25)'g__C':0.125, 'D':0.375)root;"))
+        threshold_sweep = ThresholdSweep(CompactTree.from_tree_node(tree))
+        output = StringIO()
+        threshold_sweep.write([0.125, 0.375, 0.75], ['g'], output)
+        assert_equals("threshold\tclusters\tsingletons\tg_recovered\tg_split\tg_lumped\n"
+                      "0.125\t3\t3\t0.0000\t1.0000\t0.0000\n"
+                      "0.375\t2\t1\t1.0000\t0.0000\t0.0000\n"
+                      "0.75\t1\t0\t0.0000\t0.0000\t1.0000\n", output.getvalue())
+
+    def testMultifurcation(self):
+        compact = CompactTree.from_tree_node(TreeNode.read(StringIO(
+            "((A:1,B:2,C:3)'g__D':1,(E:1,F:1,G:1,H:4)'g__I':1)root;")))
+        for rank_table in [None, RankTable(compact)]:
+            threshold_sweep = ThresholdSweep(compact, rank_table=rank_table)
+            assert_equals([2, 3, 5, 9], list(threshold_sweep.breakpoints()))
+            assert_equals([7, 5, 4, 2, 1], list(threshold_sweep.num_clusters([1, 2, 3, 5, 9])))
+            assert_equals([7, 4, 2, 0, 0], list(threshold_sweep.num_singletons([1, 2, 3, 5, 9])))
+            num_taxa, recovered, split, lumped = threshold_sweep.rank_agreement('g', [3, 5, 9])
+            assert_equals(2, num_taxa)
+            assert_equals([[0, 2, 0], [2, 0, 0], [0, 0, 2]], [list(recovered), list(split), list(lumped)])
+        assert_equals([7], list(ThresholdSweep(compact, binary_only=True).num_clusters([100])))
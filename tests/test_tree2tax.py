@@ -1,5 +1,6 @@
 from nose.tools import assert_equals, assert_true
-from tree2tax.tree2tax import Tree2Tax, NamedCluster, TaxonomyFunctions
+from tree2tax.tree2tax import Tree2Tax, NamedCluster, TaxonomyFunctions, TaxonomyIndex, RankTable
+from tree2tax.compact_tree import CompactTree
 from skbio.tree import TreeNode
 from StringIO import StringIO
 from string import split as _
@@ -9,6 +10,14 @@ class TestTaxonomyFunctions:
         assert_equals('C', TaxonomyFunctions().taxonomy_from_node_name('C'))
         assert_equals('C', TaxonomyFunctions().taxonomy_from_node_name('0.997:C'))
         assert_equals(None, TaxonomyFunctions().taxonomy_from_node_name('0.1'))
+
+    def test_parse_node_name(self):
+        assert_equals((None, 'C'), TaxonomyFunctions.parse_node_name('C'))
+        assert_equals((0.997, 'C'), TaxonomyFunctions.parse_node_name('0.997:C'))
+        assert_equals((0.1, None), TaxonomyFunctions.parse_node_name('0.1'))
+        assert_equals((100.0, None), TaxonomyFunctions.parse_node_name('1e2'))
+        assert_equals((None, 'f__1e2x'), TaxonomyFunctions.parse_node_name('f__1e2x'))
+        assert_equals((None, None), TaxonomyFunctions.parse_node_name(None))
         
     def test_missing_taxonomy(self):
         tree = TreeNode.read(StringIO('((((A:11, B:12)C:10, D:9)E:20, F:20)G:30)root;'))
@@ -16,6 +25,66 @@ class TestTaxonomyFunctions:
         assert_equals([], TaxonomyFunctions().missing_taxonomy(tree, tree.find('A'), tree.find('A')))
         assert_equals(['E','C'], TaxonomyFunctions().missing_taxonomy(tree, tree.find('A'), tree.find('G')))
 
+class TestRankTable:
+    def testRanks(self):
+        tree = TreeNode.read(StringIO("((((A:11, B:12)'0.9:f__Fam; g__Gen':10, D:9)0.5:20, F:20)'c__Cl':30, 'g__Other':1)root;"))
+        compact = CompactTree.from_tree_node(tree)
+        table = RankTable(compact)
+        assert_equals(['c','f','g'], table.ranks())
+        assert_equals([3], list(table.nodes_with_rank('f')))
+        assert_equals([3], list(table.nodes_with_rank('g')))
+        assert_equals([1], list(table.nodes_with_rank('c')))
+        assert_equals([], list(table.nodes_with_rank('s')))
+        assert_equals('Gen', table.rank_name(3, 'g'))
+        assert_equals(None, table.rank_name(3, 'c'))
+        assert_equals(None, table.rank_name(0, 'c'))
+        assert_equals('f__Fam; g__Gen', table.taxonomy(3))
+        assert_equals('fFam.gGen', table.condensed_taxonomy(3))
+        assert_equals(None, table.taxonomy(2))
+
+    def testDistinctTaxonomies(self):
+        tree = TreeNode.read(StringIO("((('A':1,'B':1)'0.9:g__X':1,('C':1,'D':1)'g__X':1)0.5:1,'E':1)root;"))
+        compact = CompactTree.from_tree_node(tree)
+        table = RankTable(compact)
+        names = [compact.name(i) for i in range(len(compact))]
+        assert_equals(0.9, table.bootstraps[compact.name_id[names.index('0.9:g__X')]])
+        assert_equals(0.5, table.bootstraps[compact.name_id[names.index('0.5')]])
+        assert_equals(None, table.bootstraps[compact.name_id[names.index('g__X')]])
+        # both g__X nodes share a taxonomy id, and Root has one too
+        ids = [table.name_taxonomy_ids[compact.name_id[names.index(n)]] for n in ['0.9:g__X', 'g__X', '0.5']]
+        assert_equals(ids[0], ids[1])
+        assert_equals(-1, ids[2])
+        assert_equals('g__X', table.distinct_taxonomies[ids[0]])
+        assert_equals('gX', table.distinct_condensed_taxonomies[ids[0]])
+        assert_equals('Root', table.distinct_taxonomies[table.root_taxonomy_id])
+        assert_equals(len(set(table.distinct_taxonomies)), len(table.distinct_taxonomies))
+        
+class TestTaxonomyIndex:
+    def test_cluster_taxonomy(self):
+        tree = TreeNode.read(StringIO("((((A:11, B:12)'0.9:C':10, D:9)0.5:20, F:20)G:30)root;"))
+        compact = CompactTree.from_tree_node(tree)
+        index = TaxonomyIndex(compact)
+        names = [compact.name(i) for i in range(len(compact))]
+        assert_equals('C', index.cluster_taxonomy(names.index('A')))
+        assert_equals('C', index.cluster_taxonomy(names.index('0.9:C')))
+        assert_equals('G', index.cluster_taxonomy(names.index('D')))
+        assert_equals('G', index.cluster_taxonomy(names.index('0.5')))
+        assert_equals('Root', index.cluster_taxonomy(names.index('root')))
+        assert_equals(None, index.taxonomy(names.index('0.5')))
+        table = index.rank_table
+        assert_equals(['C', 'C', 'G', 'G', 'Root'],
+                      [table.distinct_taxonomies[i] for i in index.cluster_taxonomy_ids(
+                          [names.index(n) for n in ['A', '0.9:C', 'D', '0.5', 'root']])])
+        
+    def test_missing_taxonomy(self):
+        tree = TreeNode.read(StringIO('((((A:11, B:12)C:10, D:9)E:20, F:20)G:30)root;'))
+        compact = CompactTree.from_tree_node(tree)
+        index = TaxonomyIndex(compact)
+        names = [compact.name(i) for i in range(len(compact))]
+        for desc, anc in [('A','E'), ('A','A'), ('A','G'), ('A','root'), ('D','G'), ('C','root')]:
+            assert_equals(TaxonomyFunctions().missing_taxonomy(tree, tree.find(desc), tree.find(anc)),
+                          index.missing_taxonomy(names.index(desc), names.index(anc)))
+
 class TestTree2TaxNamedClusters:
     def assertSameClusters(self, expected, observed):
         name_clusters = [sorted([n.name for n in named_cluster.tips]) for named_cluster in observed]
@@ -86,6 +155,15 @@ class TestTree2TaxNamedClusters:
         assert_equals(['G.1', 'G.2', 'G.3', 'G.4'], [c.name() for c in clusters])
  
          
+    def testEqualSizedClustersNumberedByAssignIds(self):
+        tree = TreeNode.read(StringIO('(((A:1, (B:1, C:1):1):1, (D:1, (E:1, F:1):1):1)G:30)root;'))
+        clusters = Tree2Tax().named_clusters(tree, 0.5)
+        tree.assign_ids()
+        expected = [t.name for t in sorted(tree.tips(), key = lambda t: t.id)]
+        assert_equals(expected, [c.tips[0].name for c in sorted(clusters, key = lambda c: c.cluster_number)])
+        assert_equals(['B','C','A','E','F','D'], expected)
+ 
+         
 class TestTree2TaxNamedClusterSets:
     def assertSameClusterSets(self, expected, observed):
         assert_equals(len(expected), len(observed))
@@ -143,6 +221,199 @@ class TestTree2TaxNamedClusterSets:
         assert_equals('G.2', clusters[0].tip_to_cluster(tip).name())
         assert_equals('G.1', clusters[1].tip_to_cluster(tip).name())
  
+class TestMergeHeights:
+    def testMergeHeights(self):
+        tree = TreeNode.read(StringIO('((((A:11, B:12)C:10, D:9)E:20, F:20)G:30)root;'))
+        compact = CompactTree.from_tree_node(tree)
+        heights = Tree2Tax().merge_heights(compact)
+        # root is unary, so never collapses
+        assert_equals(float('inf'), heights[0])
+        assert_equals([62.0, 31.0, 23.0], list(heights[1:4]))
+        assert_equals(float('-inf'), heights[compact.tip_ids[0]])
+        
+    def testMultifurcation(self):
+        tree = TreeNode.read(StringIO("((A:1,B:2,C:3)'g__D':1,(E:1,F:1,G:1,H:4)'g__I':1)root;"))
+        # A and B merge at 3 and then C at 5, while E, F and G merge at 2
+        # and then H at 5
+        for threshold, expected in [(1, 7), (2, 5), (3, 4), (5, 2), (9, 1)]:
+            assert_equals(expected, len(Tree2Tax().named_clusters(tree, threshold)))
+        clusters = Tree2Tax().named_clusters(tree, 3)
+        assert_equals([('g__D.1', ['A', 'B']), ('g__D.2', ['C']), ('g__I.1', ['E', 'F', 'G']), ('g__I.2', ['H'])],
+                      [(c.name(), c.tip_names()) for c in clusters if c.num_tips() > 0][:4])
+        assert_equals(['A', 'B', 'C', 'E', 'F', 'G', 'H'], [t.name for c in clusters for t in c.tips])
+        
+        compact = CompactTree.from_tree_node(tree)
+        resolved, old_to_new = Tree2Tax().resolve_multifurcations(compact)
+        assert_equals(len(compact)+3, len(resolved))
+        assert_equals(compact.names, resolved.names)
+        assert_equals([compact.name(i) for i in range(len(compact))], [resolved.name(i) for i in old_to_new])
+        heights = Tree2Tax().merge_heights(resolved)
+        assert_equals([9.0, 5.0, 5.0], [heights[old_to_new[i]] for i in range(len(compact)) if not compact.is_tip[i]])
+        
+        heights = Tree2Tax(binary_only=True).merge_heights(compact)
+        assert_equals([float('inf')]*3, [heights[i] for i in range(len(compact)) if not compact.is_tip[i]])
+        assert_true(Tree2Tax(binary_only=True).resolve_multifurcations(compact)[0] is compact)
+        assert_equals(7, len(Tree2Tax(binary_only=True).named_clusters(tree, 100)))
+        
+    def greedy_clusters(self, tree, threshold):
+        '''The clusters of a tree by the definition of greedy complete
+        linkage, comparing every pair of groups and measuring their
+        diameters from the distances between tips'''
+        distances = tree.tip_tip_distances()
+        tip_index = dict([(name, i) for i, name in enumerate(distances.ids)])
+        data = distances.data
+        def diameter(names):
+            indices = [tip_index[n] for n in names]
+            return max([data[i][j] for i in indices for j in indices])
+        
+        def visit(node):
+            '''return the clusters below node which can merge no further,
+            and (merge height, tip names) of those that may'''
+            if node.is_tip():
+                return [], [(float('-inf'), [node.name])]
+            final = []
+            groups = []
+            for child in node.children:
+                child_final, child_groups = visit(child)
+                if len(child_final) == 0 and len(child_groups) == 1:
+                    groups.extend(child_groups)
+                else:
+                    final.extend(child_final + [names for _, names in child_groups])
+            if len(node.children) == 1:
+                return final + [names for _, names in groups], []
+            while len(groups) > 1:
+                cost, i, j = min([(max(groups[i][0], groups[j][0], diameter(groups[i][1] + groups[j][1])), i, j)
+                                  for i in range(len(groups)) for j in range(i+1, len(groups))])
+                if cost > threshold: break
+                merged = (cost, groups[i][1] + groups[j][1])
+                groups = [g for k, g in enumerate(groups) if k not in (i, j)] + [merged]
+            if len(final) == 0 and len(groups) == 1:
+                return [], groups
+            return final + [names for _, names in groups], []
+        
+        final, groups = visit(tree)
+        return sorted([sorted(names) for names in final + [names for _, names in groups]])
+        
+    def testMatchesGreedyDefinition(self):
+        import random
+        rand = random.Random(7)
+        for _ in range(30):
+            clades = ["t%i:%f" % (i, rand.random()) for i in range(rand.randint(3, 40))]
+            while len(clades) > 1:
+                children = [clades.pop(rand.randrange(len(clades))) for _ in range(min(rand.randint(2, 6), len(clades)))]
+                clades.append("(%s):%f" % (",".join(children), rand.random()))
+            tree = TreeNode.read(StringIO("(%s)root;" % clades[0]))
+            thresholds = [0.3, 0.8, 1.5, 2.5, 4.0]
+            observed = Tree2Tax().named_clusters_for_several_thresholds(tree, thresholds)
+            for threshold, tc in zip(thresholds, observed):
+                assert_equals(self.greedy_clusters(tree, threshold),
+                              sorted([sorted(c.tip_names()) for c in tc.clusters]))
+        
+    def testClusterLcas(self):
+        tree = TreeNode.read(StringIO('((A:0.11, B:0.12)C:0.1, D:0.2)root;'))
+        compact = CompactTree.from_tree_node(tree)
+        t2t = Tree2Tax()
+        heights = t2t.merge_heights(compact)
+        assert_equals([2, 3, 4], list(t2t.cluster_lcas(compact, heights, 0.05)))
+        assert_equals([1, 4], list(t2t.cluster_lcas(compact, heights, 0.25)))
+        assert_equals([0], list(t2t.cluster_lcas(compact, heights, 0.5)))
+        
+    def testParallelMatchesSerial(self):
+        import random
+        rand = random.Random(1)
+        for num_tips in [1, 2, 5, 300]:
+            tree = TestCompactClusteringMatchesDestructive().random_binary_tree(rand, num_tips)
+            compact = CompactTree.from_tree_node(tree)
+            t2t = Tree2Tax()
+            serial = t2t.merge_heights(compact)
+            assert_equals(list(serial), list(t2t.merge_heights(compact, threads=2)))
+            assert_equals(list(serial), list(t2t._parallel_merge_heights(compact, 3, tasks_per_thread=7)[1]))
+        
+        # and with multifurcations
+        for num_tips in [5, 300]:
+            clades = ["t%i:%f" % (i, rand.random()) for i in range(num_tips)]
+            while len(clades) > 1:
+                children = [clades.pop(rand.randrange(len(clades))) for _ in range(min(rand.randint(2, 5), len(clades)))]
+                clades.append("(%s):%f" % (",".join(children), rand.random()))
+            compact = CompactTree.from_tree_node(TreeNode.read(StringIO("(%s)root;" % clades[0])))
+            t2t = Tree2Tax()
+            resolved, old_to_new, heights, merge_heights = t2t._resolve_and_merge_heights(compact)
+            # merge heights found while resolving are those of the resolved tree
+            assert_equals(list(t2t.merge_heights(resolved)), list(merge_heights))
+            assert_equals(list(merge_heights), list(t2t._parallel_merge_heights(resolved, 3, tasks_per_thread=7)[1]))
+            for threads in [2, 3]:
+                parallel = t2t._resolve_and_merge_heights(compact, threads=threads)
+                assert_equals(list(resolved.parent), list(parallel[0].parent))
+                assert_equals(list(old_to_new), list(parallel[1]))
+                assert_equals(list(heights), list(parallel[2]))
+                assert_equals(list(merge_heights), list(parallel[3]))
+
+class TestReclusterWithGrafts:
+    def testMatchesFullClustering(self):
+        import random
+        import numpy as np
+        rand = random.Random(3)
+        thresholds = [0.3, 0.8, 1.5, 2.5]
+        t2t = Tree2Tax()
+        for _ in range(10):
+            tree = TestCompactClusteringMatchesDestructive().random_binary_tree(rand, rand.randint(2, 40))
+            # name some clades, some the same, so clusters are numbered
+            for node in tree.non_tips():
+                if rand.random() < 0.3: node.name = rand.choice(['g__A', 'g__B', 'f__C; g__D'])
+            compact = CompactTree.from_tree_node(tree)
+            state = t2t.clustering_state(compact, thresholds)
+            num_grafts = rand.randint(1, 8)
+            edges = [rand.randrange(1, len(compact)) for _ in range(num_grafts)]
+            distal_lengths = [rand.random()*compact.length[e] for e in edges]
+            pendant_lengths = [rand.random() for _ in edges]
+            new_state, changes = t2t.recluster_with_grafts(
+                state, ["new%i" % i for i in range(num_grafts)], edges, distal_lengths, pendant_lengths)
+            
+            expected = t2t.named_clusters_for_several_thresholds(new_state.tree, thresholds)
+            for i, threshold_clusters in enumerate(expected):
+                assert_equals([c.name() for c in threshold_clusters.clusters], new_state.cluster_names(i))
+                assert_equals([c.lca_id for c in threshold_clusters.clusters], list(new_state.cluster_lcas[i]))
+            assert_equals(list(t2t.merge_heights(new_state.tree)), list(new_state.merge_heights))
+            assert_equals(num_grafts*len(thresholds), sum([c.new_tips for c in changes]))
+            
+    def testChanges(self):
+        tree = TreeNode.read(StringIO("(((A:0.1, B:0.1)'g__X':0.1, (C:0.1, D:0.1)'g__X':0.5)'f__Y':0.5, E:0.1)root;"))
+        t2t = Tree2Tax()
+        state = t2t.clustering_state(tree, [0.3])
+        assert_equals(['g__X.1', 'g__X.2', 'Root'], state.cluster_names(0))
+        # a long branch to a new tip next to A splits its cluster, and one
+        # joining C and D's cluster makes it the biggest
+        a = list(state.tree.name_id).index(list(state.tree.names).index('A'))
+        c = list(state.tree.name_id).index(list(state.tree.names).index('C'))
+        new_state, changes = t2t.recluster_with_grafts(state, ['N1', 'N2'], [a, c], [0.05, 0.05], [0.5, 0.01])
+        assert_equals(['g__X.2', 'g__X.3', 'g__X.4', 'g__X.1', 'Root'], new_state.cluster_names(0))
+        assert_equals([(['g__X.1'], 'g__X.2', 0), (['g__X.1'], 'g__X.3', 1), (['g__X.1'], 'g__X.4', 0),
+                       (['g__X.2'], 'g__X.1', 1)],
+                      [(c.old_names, c.new_name, c.new_tips) for c in changes])
+        
+    def testSaveAndLoad(self):
+        import tempfile
+        import os
+        from tree2tax.clustering_state import ClusteringState
+        tree = TreeNode.read(StringIO("(((A:0.1, B:0.1)'g__X':0.1, (C:0.1, D:0.1)'g__X':0.5)'f__Y':0.5, E:0.1)root;"))
+        t2t = Tree2Tax()
+        state = t2t.clustering_state(tree, [0.3, 0.1])
+        handle, path = tempfile.mkstemp(suffix='.npz')
+        os.close(handle)
+        try:
+            state.save(path)
+            loaded = ClusteringState.load(path)
+        finally:
+            os.remove(path)
+        assert_equals([0.1, 0.3], loaded.thresholds)
+        assert_equals(list(state.tree.names), list(loaded.tree.names))
+        for i in range(2):
+            assert_equals(state.cluster_names(i), loaded.cluster_names(i))
+            assert_equals(list(state.tip_clusters(i)), list(loaded.tip_clusters(i)))
+        assert_equals([0, 0, 1, 1, 2], list(loaded.tip_clusters(1)))
+        new_state, _ = t2t.recluster_with_grafts(loaded, ['N'], [1], [0.2], [0.1])
+        assert_equals(['g__X.1', 'g__X.2', 'Root.1', 'Root.2'], new_state.cluster_names(1))
+
 class TestNamedCluster:
     def testCondensedName(self):
         nc = NamedCluster('c__Halo; o__fu', ['notips'], None)
@@ -153,4 +424,79 @@ class TestNamedCluster:
          
         nc.taxonomy = 'c__Halo'
         assert_equals('cHalo.6', nc.condensed_name())
-     
\ No newline at end of file
+     
+    def testTipRange(self):
+        tree = TreeNode.read(StringIO("((('A':0.1,'B':0.1)'g__X':0.1,'C':0.6)'f__Y':0.5,'E':0.1)root;"))
+        clusters = Tree2Tax().named_clusters(tree, 0.3)
+        assert_equals(['g__X', 'f__Y', 'Root'], [c.name() for c in clusters])
+        x = clusters[0]
+        compact = x.tree
+        assert_equals((0, 2), (x.tip_start, x.tip_end))
+        assert_equals(2, x.num_tips())
+        assert_equals(['A', 'B'], x.tip_names())
+        assert_equals(['A', 'B'], [t.name for t in x.tips])
+        assert_equals('g__X', x.lca_node.name)
+        names = [compact.name(i) for i in range(len(compact))]
+        assert_equals([True, True, False, False], [x.contains(names.index(n)) for n in ['A', 'B', 'C', 'g__X']])
+        assert_equals([1, 1], [c.num_tips() for c in clusters[1:]])
+     
+class TestCompactClusteringMatchesDestructive:
+    def random_binary_tree(self, rand, num_tips):
+        clades = ["t%i:%f" % (i, rand.random()) for i in range(num_tips)]
+        while len(clades) > 1:
+            first = clades.pop(rand.randrange(len(clades)))
+            second = clades.pop(rand.randrange(len(clades)))
+            clades.append("(%s,%s):%f" % (first, second, rand.random()))
+        return TreeNode.read(StringIO("(%s)root;" % clades[0]))
+    
+    def destructive_clusters(self, tree, thresholds):
+        tree.assign_ids()
+        copy = tree.copy()
+        clades_to_distances = {}
+        to_return = []
+        for threshold in sorted(thresholds):
+            clades_to_distances = Tree2Tax().destructively_cluster_tree(copy, threshold, clades_to_distances)
+            clusters = []
+            for lca in copy.tips():
+                orig = tree.find_by_id(lca.id)
+                if orig.is_tip():
+                    clusters.append([orig.name])
+                else:
+                    clusters.append(sorted([t.name for t in orig.tips()]))
+            to_return.append(clusters)
+        return to_return
+        
+    def testTies(self):
+        # 0.165 + 0.12 + 0.185 is just above 0.47 as summed by the original
+        # algorithm, but (0.185 + 0.165) + 0.12 is 0.47 exactly
+        newick = "(((A:0.185,B:0.12):0.165,C:0.12):0.07)root;"
+        tree = TreeNode.read(StringIO(newick))
+        assert_equals([[['A', 'B'], ['C']]], self.destructive_clusters(tree, [0.47]))
+        assert_equals([['A', 'B'], ['C']], [c.tip_names() for c in Tree2Tax().named_clusters(TreeNode.read(StringIO(newick)), 0.47)])
+        
+        # branch lengths of few decimal places make many distances exactly
+        # at the thresholds
+        import random
+        rand = random.Random(4)
+        lengths = [0.05, 0.07, 0.1, 0.12, 0.165, 0.185, 0.2, 0.35]
+        thresholds = [0.27, 0.3, 0.35, 0.37, 0.4, 0.42, 0.47, 0.52, 0.7]
+        for _ in range(50):
+            clades = ["t%i:%r" % (i, rand.choice(lengths)) for i in range(rand.randint(2, 12))]
+            while len(clades) > 1:
+                first = clades.pop(rand.randrange(len(clades)))
+                second = clades.pop(rand.randrange(len(clades)))
+                clades.append("(%s,%s):%r" % (first, second, rand.choice(lengths)))
+            newick = "(%s)root;" % clades[0]
+            expected = self.destructive_clusters(TreeNode.read(StringIO(newick)), thresholds)
+            observed = Tree2Tax().named_clusters_for_several_thresholds(TreeNode.read(StringIO(newick)), thresholds)
+            assert_equals(expected, [[sorted([t.name for t in c.tips]) for c in tc.clusters] for tc in observed])
+        
+    def testRandomTrees(self):
+        import random
+        rand = random.Random(42)
+        thresholds = [0.3, 0.8, 1.5, 2.5, 4.0]
+        for _ in range(20):
+            tree = self.random_binary_tree(rand, rand.randint(2, 60))
+            expected = self.destructive_clusters(tree, thresholds)
+            observed = Tree2Tax().named_clusters_for_several_thresholds(tree, thresholds)
+            assert_equals(expected, [[sorted([t.name for t in c.tips]) for c in tc.clusters] for tc in observed])
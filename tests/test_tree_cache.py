@@ -0,0 +1,96 @@
+from nose.tools import assert_equals, assert_true, assert_false, assert_raises
+from tree2tax.tree_cache import TreeCache, TreeCacheException, StringTable
+from tree2tax.newick import NewickReader
+from tree2tax.tree2tax import Tree2Tax
+import tempfile
+import shutil
+import os
+
+class TestTreeCache:
+    newick = "((((A:11, B:12)'g__C':10, D:9)'0.9:f__E':20, F_1:20)G:30)root;"
+    
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.tree_path = os.path.join(self.directory, 'test.tree')
+        with open(self.tree_path, 'w') as f: f.write(self.newick)
+        
+    def teardown(self):
+        shutil.rmtree(self.directory)
+        
+    def assertSameTree(self, expected, observed):
+        for array_name in ['parent','first_child','next_sibling','length','name_id','subtree_end','depth']:
+            assert_equals(list(getattr(expected, array_name)), list(getattr(observed, array_name)))
+        assert_equals(list(expected.names), list(observed.names))
+        
+    def testRoundTrip(self):
+        cache = TreeCache()
+        parsed = cache.read(self.tree_path, NewickReader())
+        assert_true(os.path.exists(cache.cache_path(self.tree_path, cache.options_key(NewickReader()))))
+        cached = cache.read(self.tree_path, NewickReader())
+        self.assertSameTree(parsed, cached)
+        assert_equals([[c.name() for c in tc.clusters] for tc in Tree2Tax().named_clusters_for_several_thresholds(parsed, [25, 40])],
+                      [[c.name() for c in tc.clusters] for tc in Tree2Tax().named_clusters_for_several_thresholds(cached, [25, 40])])
+        
+    def testCacheDirectory(self):
+        cache_directory = os.path.join(self.directory, 'cache')
+        cache = TreeCache(cache_directory=cache_directory)
+        cache.read(self.tree_path, NewickReader())
+        assert_equals(['cache', 'test.tree'], sorted(os.listdir(self.directory)))
+        assert_equals(1, len(os.listdir(cache_directory)))
+        # different parse options are cached separately
+        cache.read(self.tree_path, NewickReader(replace_spaces_with_underscores=True))
+        assert_equals(2, len(os.listdir(cache_directory)))
+        
+    def testKeyMismatch(self):
+        cache = TreeCache()
+        cache.read(self.tree_path, NewickReader())
+        key = cache.key(self.tree_path, NewickReader(convert_underscores=False))
+        with assert_raises(TreeCacheException):
+            cache.load(cache.cache_path(self.tree_path, cache.options_key(NewickReader())), key)
+        tree = cache.read(self.tree_path, NewickReader(convert_underscores=False))
+        assert_true('F_1' in list(tree.names))
+        
+    def testOptionsAlongsideTreeFile(self):
+        cache = TreeCache()
+        cache.read(self.tree_path, NewickReader())
+        cache.read(self.tree_path, NewickReader(replace_spaces_with_underscores=True))
+        # different parse options are cached separately
+        paths = [cache.cache_path(self.tree_path, cache.options_key(NewickReader())),
+                 cache.cache_path(self.tree_path, cache.options_key(NewickReader(replace_spaces_with_underscores=True)))]
+        assert_equals(sorted(['test.tree'] + [os.path.basename(p) for p in paths]), sorted(os.listdir(self.directory)))
+        assert_true(paths[0] != paths[1])
+        
+    def testChangedTreeFile(self):
+        cache = TreeCache()
+        cache.read(self.tree_path, NewickReader())
+        with open(self.tree_path, 'w') as f: f.write("(A:1,B:2)root;")
+        assert_equals(3, len(cache.read(self.tree_path, NewickReader())))
+
+    def testUnchangedTreeFileNotHashed(self):
+        TreeCache().read(self.tree_path, NewickReader())
+        cache = TreeCache()
+        hashed = []
+        key = cache.key
+        cache.key = lambda *args: hashed.append(1) or key(*args)
+        parsed = NewickReader().read(self.tree_path)
+        self.assertSameTree(parsed, cache.read(self.tree_path, NewickReader()))
+        assert_equals(0, len(hashed))
+        
+        # touched but not changed, so hashed once and then not again
+        os.utime(self.tree_path, (0, 1000))
+        self.assertSameTree(parsed, cache.read(self.tree_path, NewickReader()))
+        self.assertSameTree(parsed, cache.read(self.tree_path, NewickReader()))
+        assert_equals(1, len(hashed))
+        
+        # changed to another tree of the same size
+        with open(self.tree_path, 'w') as f: f.write(self.newick.replace('A:11', 'H:11'))
+        os.utime(self.tree_path, (0, 2000))
+        assert_true('H' in list(cache.read(self.tree_path, NewickReader()).names))
+        assert_equals(2, len(hashed))
+
+class TestStringTable:
+    def testStringTable(self):
+        table = StringTable.from_strings(['abc', '', 'g__Foo; s__bar'])
+        assert_equals(3, len(table))
+        assert_equals(['abc', '', 'g__Foo; s__bar'], list(table))
+        assert_equals('g__Foo; s__bar', table[2])
@@ -0,0 +1,183 @@
+import os
+import re
+import csv
+import logging
+
+import numpy as np
+
+from .tree2tax import Tree2Tax
+from .metrics import Metrics
+
+class AutoTaxonomy:
+    '''Creates a new taxonomy from a tree by clustering it at one threshold
+    per taxonomic rank, writing it as a GreenGenes style taxonomy file and
+    as the seqinfo and taxonomy CSV files used by taxtastic.
+
+    Each rank is named as if tree2tax had been run with that threshold
+    alone, e.g. k__gHalococcus.1, and tips are written in the order of
+    `sort -rn` on their names.'''
+
+    PREFIXES = 'k p c o f g s'.split()
+    GREENGENES_TAXONOMY_FILE = 'taxonomy.gg.csv'
+    TAXTASTIC_SEQINFO_FILE = 'seqinfo.taxtastic.csv'
+    TAXTASTIC_TAXONOMY_FILE = 'taxonomy.taxtastic.csv'
+
+    def __init__(self, thresholds, threads=1, binary_only=False):
+        '''
+        Parameters
+        ----------
+        thresholds: list of float
+            one tree distance threshold per rank, from kingdom to species
+        threads: int
+            number of processes to cluster with
+        binary_only: bool
+            only collapse nodes with exactly two children, as in Tree2Tax
+        '''
+        if len(thresholds) != len(self.PREFIXES):
+            raise ValueError("Expected %i thresholds, found %i" % (len(self.PREFIXES), len(thresholds)))
+        self.thresholds = thresholds
+        self.threads = threads
+        self.binary_only = binary_only
+
+    def run(self, tree, output_directory, metrics=None):
+        '''Cluster the tree (a CompactTree or TreeNode) and write the
+        taxonomy files into output_directory, recording the time taken by
+        each stage in metrics if it is given'''
+        if metrics is None: metrics = Metrics()
+        logging.info("Clustering at %i thresholds.." % len(self.thresholds))
+        threshold_and_clusters = Tree2Tax(self.binary_only).named_clusters_for_several_thresholds(
+            tree, self.thresholds, threads=self.threads, metrics=metrics)
+        taxonomy_index = threshold_and_clusters[0].taxonomy_index
+        compact = taxonomy_index.tree
+
+        with metrics.stage('name_taxa') as stage:
+            chains, tip_chains = self._taxon_chains(threshold_and_clusters)
+            tip_names = [compact.name(t) for t in compact.tip_ids]
+            order = self._sort_rn_order(tip_names)
+            stage.count('lineages', len(chains))
+        logging.info("Found %i tips in the tree" % len(order))
+
+        gg_path = os.path.join(output_directory, self.GREENGENES_TAXONOMY_FILE)
+        logging.info("Writing %s" % gg_path)
+        with metrics.stage('write_greengenes', lines=len(order)):
+            with open(gg_path, 'w') as f:
+                self.write_greengenes_taxonomy(f, chains, tip_chains, tip_names, order)
+
+        seqinfo_path = os.path.join(output_directory, self.TAXTASTIC_SEQINFO_FILE)
+        taxonomy_path = os.path.join(output_directory, self.TAXTASTIC_TAXONOMY_FILE)
+        logging.info("Writing %s and %s" % (seqinfo_path, taxonomy_path))
+        with metrics.stage('write_taxtastic', lines=len(order)):
+            with open(seqinfo_path, 'w') as seqinfo, open(taxonomy_path, 'w') as taxonomy:
+                self.write_taxtastic(seqinfo, taxonomy, chains, tip_chains, tip_names, order)
+
+    def _taxon_chains(self, threshold_and_clusters):
+        '''Return a list of the distinct lists of taxa (one per rank) that
+        tips are assigned, and an array giving the index into that list
+        for each tip, left to right. Since clusters nest, each is
+        determined by the tip's cluster at the smallest threshold.'''
+        # clusters are returned in order of increasing threshold, but the
+        # thresholds were given from kingdom down
+        ranks = sorted(range(len(self.thresholds)), key=lambda i: self.thresholds[i])
+        levels = [None]*len(ranks)
+        for rank, tc in zip(ranks, threshold_and_clusters):
+            levels[rank] = tc
+
+        level_taxa = []
+        tip_to_cluster_index = []
+        for prefix, tc in zip(self.PREFIXES, levels):
+            # equivalent to passing single threshold tree2tax output through
+            # sed 's/.__//g' |sed 's/; /./g', and then adding the prefix
+            level_taxa.append(["%s__%s" % (prefix, re.sub(r'.__', '', 'K__' + c.condensed_name()).replace('; ','.'))
+                               for c in tc.clusters])
+            sizes = [c.num_tips() for c in tc.clusters]
+            tip_to_cluster_index.append(np.repeat(np.arange(len(sizes)), sizes))
+
+        finest_sizes = [c.num_tips() for c in threshold_and_clusters[0].clusters]
+        finest_starts = np.concatenate([[0], np.cumsum(finest_sizes)[:-1]]).astype(np.int64)
+        chains = []
+        for start in finest_starts:
+            chains.append([taxa[cluster_indices[start]] for taxa, cluster_indices in zip(level_taxa, tip_to_cluster_index)])
+        return chains, np.repeat(np.arange(len(finest_sizes)), finest_sizes)
+
+    def _sort_rn_order(self, tip_names):
+        '''Return tip indices in the order that `sort -rn` would sort lines
+        starting with their names, i.e. by decreasing leading number, with
+        ties broken by reverse comparison of the names'''
+        number_regex = re.compile(r'\s*(-?(?:\d+\.?\d*|\.\d+))')
+        keys = []
+        for name in tip_names:
+            match = number_regex.match(name)
+            keys.append((float(match.group(1)) if match else 0.0, name))
+        return sorted(range(len(tip_names)), key=lambda i: keys[i], reverse=True)
+
+    def write_greengenes_taxonomy(self, f, chains, tip_chains, tip_names, order):
+        '''Write lines of tip name, tab, then the taxa joined by '; ' '''
+        lineages = ['; '.join(chain) for chain in chains]
+        buf = []
+        for i in order:
+            buf.append("%s\t%s\n" % (tip_names[i], lineages[tip_chains[i]]))
+            if len(buf) >= 10000:
+                f.write(''.join(buf))
+                buf = []
+        f.write(''.join(buf))
+
+    def write_taxtastic(self, seqinfo_file, taxonomy_file, chains, tip_chains, tip_names, order):
+        '''Write taxtastic seqinfo and taxonomy CSV files, in the format of
+        Getaxnseq's get_tax_n_seq2.py. Where a taxon is found with more than
+        one parent, later occurrences are renamed by appending e1, e2 etc.'''
+        # Taxtastic does not allow whitespace in taxon names
+        chains = [[re.sub(r'\s+', '_', taxon.strip()) for taxon in chain] for chain in chains]
+
+        parents = {}
+        known_duplicates = set()
+        fixed_chains = {}
+        # chain indices in the order they are first seen
+        chain_order = []
+        for i in order:
+            chain_index = tip_chains[i]
+            if chain_index in fixed_chains: continue
+            chain_order.append(chain_index)
+            taxonomy = list(chains[chain_index])
+            for j in range(1, len(taxonomy)):
+                tax = taxonomy[j]
+                ancestry = taxonomy[j-1]
+                if tax in parents:
+                    if parents[tax] != ancestry:
+                        dup = "%s%s" % (parents[tax], tax)
+                        # don't report the same problem several times
+                        if dup not in known_duplicates:
+                            logging.warn("%s '%s' with multiple parents %s and %s" % (tip_names[i], tax, parents[tax], ancestry))
+                            known_duplicates.add(dup)
+                        new_name_id = 1
+                        new_name = "%se%s" % (tax, new_name_id)
+                        while new_name in parents and parents[new_name] != ancestry:
+                            new_name_id += 1
+                            new_name = "%se%s" % (tax, new_name_id)
+                        taxonomy[j] = new_name
+                        parents[new_name] = ancestry
+                else:
+                    parents[tax] = ancestry
+            fixed_chains[chain_index] = taxonomy
+
+        seqinfo = csv.writer(seqinfo_file, lineterminator='\n')
+        seqinfo.writerow(['seqname', 'tax_id'])
+        for i in order:
+            seqinfo.writerow([tip_names[i], fixed_chains[tip_chains[i]][-1]])
+
+        level_names = ["rank_%i" % rank for rank in range(len(self.PREFIXES))]
+        taxonomy = csv.writer(taxonomy_file, lineterminator='\n')
+        taxonomy.writerow(['tax_id','parent_id','rank','tax_name','root'] + level_names)
+        taxonomy.writerow(['Root','Root','root','Root','Root'] + ['']*len(level_names))
+        noted_taxonomies = set()
+        for chain_index in chain_order:
+            taxons = fixed_chains[chain_index]
+            for level, tax in enumerate(taxons):
+                if level == 0:
+                    parent = 'Root'
+                else:
+                    parent = taxons[level-1]
+                row = tuple([tax, parent, level_names[level], tax, 'Root'] + \
+                    taxons[:level+1] + ['']*(len(level_names)-level-1))
+                if row not in noted_taxonomies:
+                    taxonomy.writerow(row)
+                    noted_taxonomies.add(row)
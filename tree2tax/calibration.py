@@ -0,0 +1,368 @@
+import logging
+import mmap
+import os
+import multiprocessing
+import numpy as np
+
+from .compact_tree import LCAIndex
+
+class FastaIndexException(Exception): pass
+
+class FastaIndex:
+    '''Random access to the sequences of a FASTA file, which is memory
+    mapped rather than read, so that only the pages holding the sequences
+    asked for are read from disk.
+
+    Sequences are located through a samtools style .fai index (name, length,
+    offset, bases per line, bytes per line) next to the FASTA file if there
+    is one, otherwise the index is built in memory by scanning the file
+    once. As for samtools, each sequence must have lines of equal length
+    except the last.'''
+
+    def __init__(self, path, fai_path=None):
+        self.path = path
+        self._file = open(path, 'rb')
+        if os.fstat(self._file.fileno()).st_size == 0:
+            self._mmap = ''
+        else:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if fai_path is None: fai_path = path + '.fai'
+        if os.path.exists(fai_path):
+            self._entries = self._read_fai(fai_path)
+        else:
+            logging.info("No index found at %s, indexing %s.." % (fai_path, path))
+            self._entries = self._scan()
+
+    def _read_fai(self, fai_path):
+        entries = {}
+        with open(fai_path) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 5:
+                    raise FastaIndexException("Unexpected line in FASTA index %s: %s" % (fai_path, line))
+                entries[fields[0]] = tuple([int(field) for field in fields[1:5]])
+        return entries
+
+    def _scan(self):
+        entries = {}
+        data = self._mmap
+        position = data.find('>') if len(data) > 0 else -1
+        while position >= 0:
+            header_end = data.find('\n', position)
+            if header_end < 0: header_end = len(data)
+            # the name is the first word of the header, as for samtools
+            name = data[position+1:header_end].split(None, 1)[0] if header_end > position+1 else ''
+            offset = header_end + 1
+            next_record = data.find('\n>', header_end)
+            end = len(data) if next_record < 0 else next_record + 1
+            block = data[offset:end]
+            first_line_end = block.find('\n')
+            if first_line_end < 0:
+                line_bytes = len(block)
+            else:
+                line_bytes = first_line_end + 1
+            line_bases = len(block[:line_bytes].rstrip('\r\n'))
+            length = len(block.translate(None, '\r\n'))
+            entries[name] = (length, offset, line_bases, line_bytes)
+            position = next_record + 1 if next_record >= 0 else -1
+        return entries
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def names(self):
+        return self._entries.keys()
+
+    def sequence_length(self, name):
+        return self._entries[name][0]
+
+    def sequence(self, name):
+        '''return the sequence with the given name, in upper case, raising
+        KeyError if there is none'''
+        length, offset, line_bases, line_bytes = self._entries[name]
+        if line_bases == 0:
+            return ''
+        full_lines, remainder = divmod(length, line_bases)
+        end = offset + full_lines*line_bytes + remainder
+        return self._mmap[offset:end].translate(None, '\r\n').upper()
+
+    def close(self):
+        if not isinstance(self._mmap, str): self._mmap.close()
+        self._file.close()
+
+
+class PairwiseAligner:
+    '''Percent identity of pairs of nucleotide sequences, from an alignment
+    with linear gap scores in which gaps at the ends of either sequence are
+    free (an overlap alignment), so that sequences trimmed differently are
+    not penalised. Identity is the number of identical aligned bases as a
+    percentage of the alignment columns, not counting end gaps. Of
+    alignments with the best score, the one with the most identical bases,
+    then the fewest columns, is taken.
+
+    Pairs are aligned in batches, one row of the dynamic programming matrix
+    at a time across every pair of the batch, in numpy. The score, identical
+    bases and columns of the alignment ending at each cell are packed into
+    one int64, ordered as alignments are preferred, so that choosing between
+    alignments is a maximum. A gap changes the packed value by a constant,
+    so the best horizontal gap into each cell of a row is a running maximum
+    along the row, and a row takes a fixed number of numpy operations however
+    long it is.'''
+
+    # bits of the packed value holding each of the number of identical
+    # bases and _FIELD_MASK less the number of columns, the score being above
+    _FIELD_BITS = 21
+    _FIELD_MASK = (1 << _FIELD_BITS) - 1
+
+    # padding values, which never match a base or each other
+    _FIRST_PADDING = 0
+    _SECOND_PADDING = 1
+
+    def __init__(self, match_score=1, mismatch_score=-1, gap_score=-2):
+        self.match_score = match_score
+        self.mismatch_score = mismatch_score
+        self.gap_score = gap_score
+
+    def _step(self, score, matches, columns):
+        '''return the change in packed value of adding the given score,
+        identical bases and columns to an alignment'''
+        return (score << (2*self._FIELD_BITS)) + (matches << self._FIELD_BITS) - columns
+
+    def percent_identities(self, first_sequences, second_sequences):
+        '''return an array of the percent identity of each pair of
+        sequences, aligned as a single batch. Pairs where either sequence is
+        empty have an identity of 0.'''
+        num_pairs = len(first_sequences)
+        if num_pairs == 0: return np.zeros(0, dtype=np.float64)
+        first, first_lengths = self._encode(first_sequences, self._FIRST_PADDING)
+        second, second_lengths = self._encode(second_sequences, self._SECOND_PADDING)
+        if first.shape[1] + second.shape[1] > self._FIELD_MASK:
+            raise ValueError("Sequences are too long to align, their lengths must add to less than %i" % self._FIELD_MASK)
+        num_columns = second.shape[1] + 1
+        columns = np.arange(num_columns, dtype=np.int64)
+
+        # change in packed value of each kind of step
+        match_step = self._step(self.match_score, 1, 1)
+        mismatch_step = self._step(self.mismatch_score, 0, 1)
+        gap_step = self._step(self.gap_score, 0, 1)
+        empty = self._FIELD_MASK
+        column_gaps = gap_step * columns
+
+        # best alignment ending at each cell of the previous row, the first
+        # row and column being free end gaps
+        previous = np.empty((num_pairs, num_columns), dtype=np.int64)
+        previous.fill(empty)
+        vertical = previous.copy()
+        # buffers reused for each row, rather than allocating arrays
+        identical = np.empty(second.shape, dtype=bool)
+        diagonal = np.empty(second.shape, dtype=np.int64)
+        up = np.empty(second.shape, dtype=np.int64)
+        shifted = np.empty(previous.shape, dtype=np.int64)
+        # best alignment ending in the last column of each pair so far,
+        # then also in its last row
+        best = np.empty(num_pairs, dtype=np.int64)
+        best.fill(empty)
+        pairs = np.arange(num_pairs)
+
+        for row in range(first.shape[1]):
+            # best alignment into each cell from the row above
+            np.equal(second, first[:, row:row+1], out=identical)
+            np.multiply(identical, match_step - mismatch_step, out=diagonal)
+            diagonal += previous[:, :-1]
+            diagonal += mismatch_step
+            np.add(previous[:, 1:], gap_step, out=up)
+            np.maximum(diagonal, up, out=vertical[:, 1:])
+            # then the best of it and the horizontal gaps into it from the
+            # cells to its left
+            np.subtract(vertical, column_gaps, out=shifted)
+            np.maximum.accumulate(shifted, axis=1, out=previous)
+            previous += column_gaps
+
+            in_first = row < first_lengths
+            best[in_first] = np.maximum(best[in_first], previous[pairs[in_first], second_lengths[in_first]])
+            last = first_lengths == row+1
+            if last.any():
+                row_cells = np.where(columns <= second_lengths[last, None], previous[last], empty)
+                best[last] = np.maximum(best[last], row_cells.max(axis=1))
+
+        matches = (best >> self._FIELD_BITS) & self._FIELD_MASK
+        aligned = self._FIELD_MASK - (best & self._FIELD_MASK)
+        return 100.0 * matches / np.maximum(aligned, 1)
+
+    def _encode(self, sequences, padding):
+        lengths = np.array([len(s) for s in sequences], dtype=np.int64)
+        encoded = np.empty((len(sequences), max(lengths.max(), 1)), dtype=np.uint8)
+        encoded.fill(padding)
+        for i, sequence in enumerate(sequences):
+            encoded[i, :len(sequence)] = np.frombuffer(sequence, dtype=np.uint8)
+        return encoded, lengths
+
+
+class CalibrationException(Exception): pass
+
+# The FastaIndex and aligner shared with worker processes, set before the
+# pool is created so that forked workers inherit them
+_shared_fasta_index = None
+_shared_aligner = None
+
+def _align_batch(batch):
+    '''Return the percent identities of a list of (name, name) pairs of
+    sequences in the shared FastaIndex'''
+    firsts = [_shared_fasta_index.sequence(first) for first, _ in batch]
+    seconds = [_shared_fasta_index.sequence(second) for _, second in batch]
+    return _shared_aligner.percent_identities(firsts, seconds)
+
+
+class Calibration:
+    '''Compares the tree distance of pairs of tips with the percent identity
+    of their sequences, for relating tree distance thresholds to sequence
+    identity.
+
+    Pairs are sampled either uniformly from all pairs of tips that have a
+    sequence, or stratified by tree distance, so that the rarer short and
+    long distances are as well represented as the common ones. Tree
+    distances are found in bulk from an LCAIndex, and sequences aligned in
+    batches across a pool of processes, the results being written as each
+    batch is finished.'''
+
+    def __init__(self, tree, fasta_index, aligner=None, seed=None):
+        '''
+        Parameters
+        ----------
+        tree: CompactTree
+            tree whose tips are named as the sequences
+        fasta_index: FastaIndex
+            the sequences
+        aligner: PairwiseAligner or None
+            aligner, or a default one if None
+        seed: int or None
+            seed of the random number generator used for sampling
+        '''
+        self.tree = tree
+        self.fasta_index = fasta_index
+        self.aligner = aligner if aligner is not None else PairwiseAligner()
+        self.lca_index = LCAIndex(tree)
+        self._random = np.random.RandomState(seed)
+
+        tips = tree.tip_ids
+        has_sequence = np.array([tree.name(t) in fasta_index for t in tips], dtype=bool)
+        self.tips = tips[has_sequence]
+        num_missing = len(tips) - len(self.tips)
+        if num_missing > 0:
+            logging.warn("%i of %i tips have no sequence, so are not sampled" % (num_missing, len(tips)))
+        if len(self.tips) < 2:
+            raise CalibrationException("Fewer than 2 tips of the tree have a sequence, cannot calibrate")
+
+    def _random_pairs(self, num_pairs):
+        '''return arrays of the first and second tip ids and the tree
+        distance of num_pairs random pairs of distinct tips'''
+        first = self._random.randint(0, len(self.tips), num_pairs)
+        # never the same tip twice
+        second = (first + self._random.randint(1, len(self.tips), num_pairs)) % len(self.tips)
+        first = self.tips[first]
+        second = self.tips[second]
+        return first, second, self.lca_index.distance(first, second)
+
+    def uniform_pairs(self, num_pairs):
+        '''return arrays of the first and second tip ids and the tree
+        distance of num_pairs pairs sampled uniformly'''
+        return self._random_pairs(num_pairs)
+
+    def stratified_pairs(self, num_pairs, num_bins, max_distance=None, max_draws=None):
+        '''Return arrays of the first and second tip ids and the tree
+        distance of about num_pairs pairs, an equal number from each of
+        num_bins equal width bins of tree distance from 0 to max_distance.
+        Pairs are drawn uniformly and kept until their bin is full, so bins
+        of distances that are too rare to fill within max_draws draws
+        (default 100 times num_pairs) have fewer pairs. If max_distance is
+        None, it is the largest distance of an initial uniform sample.'''
+        if max_draws is None: max_draws = 100 * num_pairs
+        block_size = max(1000, min(num_pairs, 1<<20))
+        first, second, distances = self._random_pairs(block_size)
+        draws = block_size
+        if max_distance is None: max_distance = distances.max()
+        if max_distance <= 0:
+            raise CalibrationException("Cannot stratify distances up to %s" % max_distance)
+        bin_width = float(max_distance) / num_bins
+        quota = int(np.ceil(float(num_pairs) / num_bins))
+        counts = np.zeros(num_bins, dtype=np.int64)
+        kept = []
+        while True:
+            bins = np.floor(distances / bin_width).astype(np.int64)
+            in_range = distances <= max_distance
+            bins[bins >= num_bins] = num_bins - 1
+            # take each pair while its bin has room, in the order drawn
+            order = np.argsort(np.where(in_range, bins, num_bins), kind='mergesort')
+            sorted_bins = np.where(in_range, bins, num_bins)[order]
+            starts = np.searchsorted(sorted_bins, np.arange(num_bins+1))
+            for b in range(num_bins):
+                take = min(quota - counts[b], starts[b+1] - starts[b])
+                if take > 0:
+                    chosen = order[starts[b]:starts[b]+take]
+                    kept.append((first[chosen], second[chosen], distances[chosen]))
+                    counts[b] += take
+            if (counts >= quota).all() or draws >= max_draws: break
+            first, second, distances = self._random_pairs(block_size)
+            draws += block_size
+
+        underfilled = np.flatnonzero(counts < quota)
+        if len(underfilled) > 0:
+            logging.warn("Only found %s pairs in distance bins starting %s after %i draws" % (
+                counts[underfilled].tolist(), (underfilled * bin_width).tolist(), draws))
+        if len(kept) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        return tuple([np.concatenate(parts) for parts in zip(*kept)])
+
+    def each_result(self, first, second, distances, threads=1, batch_size=64):
+        '''Align the sequences of each pair of tips, yielding (first name,
+        second name, tree distance, percent identity) for each, in order of
+        sequence length as they are aligned. Pairs are aligned in batches of batch_size pairs of similar
+        sequence length, using threads processes.'''
+        tree = self.tree
+        names = [(tree.name(a), tree.name(b)) for a, b in zip(first.tolist(), second.tolist())]
+        distances = distances.tolist()
+        # batch pairs of similar lengths together, so that little of each
+        # batch is padding
+        lengths = [(self.fasta_index.sequence_length(a), self.fasta_index.sequence_length(b)) for a, b in names]
+        order = sorted(range(len(names)), key=lambda i: lengths[i])
+        batches = [order[start:start+batch_size] for start in range(0, len(names), batch_size)]
+
+        global _shared_fasta_index, _shared_aligner
+        _shared_fasta_index = self.fasta_index
+        _shared_aligner = self.aligner
+        try:
+            if threads > 1:
+                pool = multiprocessing.Pool(threads)
+                try:
+                    # imap returns results in batch order, as they are done
+                    for batch, identities in zip(batches, pool.imap(
+                            _align_batch, [[names[i] for i in batch] for batch in batches])):
+                        for i, identity in zip(batch, identities.tolist()):
+                            yield names[i][0], names[i][1], distances[i], identity
+                except:
+                    pool.terminate()
+                    raise
+                else:
+                    pool.close()
+                    pool.join()
+            else:
+                for batch in batches:
+                    identities = _align_batch([names[i] for i in batch])
+                    for i, identity in zip(batch, identities.tolist()):
+                        yield names[i][0], names[i][1], distances[i], identity
+        finally:
+            _shared_fasta_index = None
+            _shared_aligner = None
+
+    def write(self, first, second, distances, f, threads=1, batch_size=64):
+        '''Write each pair of tips, their tree distance and the percent
+        identity of their sequences as tab separated lines to the open file
+        f, flushing after each batch'''
+        for i, (first_name, second_name, distance, identity) in enumerate(
+                self.each_result(first, second, distances, threads, batch_size)):
+            f.write("%s\t%s\t%r\t%.2f\n" % (first_name, second_name, distance, identity))
+            if (i+1) % batch_size == 0: f.flush()
+        f.flush()
@@ -0,0 +1,153 @@
+import numpy as np
+
+from .tree_cache import StringTable
+
+class ClusterAssignments:
+    '''The clusters of every tip at several thresholds, held as an int32
+    matrix of tips x thresholds giving the index of each tip's cluster in
+    the cluster table of that threshold, which holds the name, LCA node id
+    and number of tips of each cluster. Tips are numbered left to right as
+    in CompactTree#tip_ids, and thresholds are in increasing order.
+
+    Tips can be looked up by name in constant time through a hash table of
+    their names, which is built when first needed.'''
+
+    def __init__(self, thresholds, tip_names, clusters, cluster_names, cluster_lcas, cluster_sizes):
+        '''
+        Parameters
+        ----------
+        thresholds: list of float
+            in increasing order
+        tip_names: list or StringTable of str
+            name of each tip
+        clusters: numpy int32 array
+            tips x thresholds matrix of cluster indices
+        cluster_names: list of lists or StringTables of str
+            name of each cluster at each threshold
+        cluster_lcas, cluster_sizes: lists of numpy int64 arrays
+            LCA node id and number of tips of each cluster at each threshold
+        '''
+        self.thresholds = thresholds
+        self.tip_names = tip_names
+        self.clusters = clusters
+        self.cluster_names = cluster_names
+        self.cluster_lcas = cluster_lcas
+        self.cluster_sizes = cluster_sizes
+        self._name_index = None
+
+    @staticmethod
+    def from_threshold_and_clusters(threshold_and_clusters):
+        '''Build from the result of
+        Tree2Tax#named_clusters_for_several_thresholds'''
+        levels = sorted(threshold_and_clusters, key=lambda tc: tc.threshold)
+        tree = levels[0].taxonomy_index.tree
+        clusters = np.empty((tree.num_tips(), len(levels)), dtype=np.int32)
+        cluster_sizes = []
+        for i, tc in enumerate(levels):
+            sizes = np.array([c.num_tips() for c in tc.clusters], dtype=np.int64)
+            clusters[:, i] = np.repeat(np.arange(len(sizes)), sizes)
+            cluster_sizes.append(sizes)
+        return ClusterAssignments([tc.threshold for tc in levels],
+                                  [tree.name(t) for t in tree.tip_ids],
+                                  clusters,
+                                  [[c.name() for c in tc.clusters] for tc in levels],
+                                  [np.array([c.lca_id for c in tc.clusters], dtype=np.int64) for tc in levels],
+                                  cluster_sizes)
+
+    def num_tips(self):
+        return len(self.clusters)
+
+    def tip_index(self, tip_name):
+        '''return the index of the tip with the given name, raising KeyError
+        if there is none'''
+        if self._name_index is None: self._name_index = _NameIndex(self.tip_names)
+        return self._name_index.index(tip_name)
+
+    def tip_clusters(self, tip_index):
+        '''return an array of the index of the cluster of the given tip at
+        each threshold'''
+        return self.clusters[tip_index]
+
+    def tip_cluster_names(self, tip_name):
+        '''return a list of the name of the cluster of the named tip at each
+        threshold'''
+        row = self.clusters[self.tip_index(tip_name)]
+        return [self.cluster_names[i][c] for i, c in enumerate(row.tolist())]
+
+    def cluster_name(self, threshold_index, cluster_index):
+        return self.cluster_names[threshold_index][cluster_index]
+
+    def save(self, path):
+        '''Save to path, in numpy's npz format'''
+        tip_names = StringTable.from_strings(list(self.tip_names))
+        arrays = {'thresholds': np.array(self.thresholds, dtype=np.float64),
+                  'tip_name_offsets': tip_names.offsets, 'tip_name_data': tip_names.data,
+                  'clusters': self.clusters}
+        for i in range(len(self.thresholds)):
+            names = StringTable.from_strings(self.cluster_names[i])
+            arrays.update({'cluster_name_offsets_%i' % i: names.offsets,
+                           'cluster_name_data_%i' % i: names.data,
+                           'cluster_lcas_%i' % i: self.cluster_lcas[i],
+                           'cluster_sizes_%i' % i: self.cluster_sizes[i]})
+        with open(path, 'wb') as f:
+            np.savez(f, **arrays)
+
+    @staticmethod
+    def load(path):
+        '''Load assignments saved with save. Tip and cluster names are kept
+        packed in StringTables rather than as lists of strings.'''
+        arrays = np.load(path)
+        thresholds = arrays['thresholds'].tolist()
+        levels = range(len(thresholds))
+        return ClusterAssignments(
+            thresholds,
+            StringTable(arrays['tip_name_offsets'], arrays['tip_name_data']),
+            arrays['clusters'],
+            [StringTable(arrays['cluster_name_offsets_%i' % i], arrays['cluster_name_data_%i' % i])
+             for i in levels],
+            [arrays['cluster_lcas_%i' % i] for i in levels],
+            [arrays['cluster_sizes_%i' % i] for i in levels])
+
+
+class _NameIndex:
+    '''An open addressing hash table from name to index in a list of names,
+    held in a numpy array of about twice as many slots as names, so that
+    looking up a name is constant time without a dict of every name. Slots
+    hold the index of a name, or -1 if empty, and collisions are resolved
+    by linear probing, the hash of each name being kept so that names are
+    only compared when their hashes match. Where a name occurs more than
+    once, the first is found.'''
+    def __init__(self, names):
+        self.names = names
+        num_slots = 1
+        while num_slots < 2*len(names): num_slots *= 2
+        self.mask = num_slots - 1
+        self.slots = np.empty(num_slots, dtype=np.int32)
+        self.slots.fill(-1)
+
+        hashes = np.array([hash(name) for name in names], dtype=np.int64)
+        self.hashes = hashes
+        pending = np.arange(len(names))
+        probe = 0
+        while len(pending) > 0:
+            # place each name whose current slot is free, the first of any
+            # names wanting the same slot winning it
+            slots = (hashes[pending] + probe) & self.mask
+            free = self.slots[slots] < 0
+            unique_slots, first = np.unique(slots[free], return_index=True)
+            self.slots[unique_slots] = pending[free][first]
+            placed = np.zeros(len(pending), dtype=bool)
+            placed[np.flatnonzero(free)[first]] = True
+            pending = pending[~placed]
+            probe += 1
+
+    def index(self, name):
+        name_hash = hash(name)
+        slot = name_hash & self.mask
+        while True:
+            i = self.slots[slot]
+            if i < 0:
+                raise KeyError(name)
+            elif self.hashes[i] == name_hash and self.names[i] == name:
+                return int(i)
+            slot = (slot + 1) & self.mask
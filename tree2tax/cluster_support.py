@@ -0,0 +1,152 @@
+import logging
+import multiprocessing
+import numpy as np
+
+from .tree2tax import Tree2Tax
+
+class ReplicateException(Exception): pass
+
+def _cluster_hashes(tree, tip_keys, cluster_lcas):
+    '''Return the hash of the set of tips of each cluster, the exclusive or
+    of the keys of its tips, given the key of each tip of the tree in
+    tip_ids order. The tips of a cluster are a contiguous range of tip_ids,
+    so each hash is the exclusive or of two prefixes.'''
+    prefixes = np.zeros(len(tip_keys)+1, dtype=np.uint64)
+    np.bitwise_xor.accumulate(tip_keys, out=prefixes[1:])
+    starts = tree._tips_before[cluster_lcas]
+    ends = tree._tips_before[tree.subtree_end[cluster_lcas]]
+    return prefixes[starts] ^ prefixes[ends]
+
+def _replicate_hashes(task):
+    '''Return a sorted array of the cluster hashes of a replicate tree at
+    each threshold, given (tree, tip keys, thresholds, binary_only)'''
+    tree, tip_keys, thresholds, binary_only = task
+    tree2tax = Tree2Tax(binary_only)
+    resolved, old_to_new, _, merge_heights = tree2tax._resolve_and_merge_heights(tree)
+    if resolved is not tree:
+        # the tips of the resolved tree are in a different order
+        node_keys = np.zeros(len(resolved), dtype=np.uint64)
+        node_keys[old_to_new[tree.tip_ids]] = tip_keys
+        tree = resolved
+        tip_keys = node_keys[tree.tip_ids]
+    return [np.sort(_cluster_hashes(tree, tip_keys, tree2tax.cluster_lcas(tree, merge_heights, threshold)))
+            for threshold in thresholds]
+
+
+class ClusterSupport:
+    '''The support of each cluster of a reference tree across replicate
+    trees (e.g. bootstrap or posterior samples) clustered at the same
+    thresholds: the fraction of replicates in which exactly the same set of
+    tips forms a cluster at that threshold.
+
+    Tip sets are compared by hashing rather than as sets of names. Each tip
+    of the reference tree is given a random 64 bit key, and a set of tips
+    hashes to the exclusive or of their keys (Zobrist hashing), so the
+    hashes of every cluster of a tree are found from one running exclusive
+    or over its tips, and two clusters are taken to be the same if their
+    hashes are, which for different sets happens with probability 2^-64.'''
+
+    def __init__(self, reference_tree, thresholds, threads=1, seed=1, binary_only=False):
+        '''
+        Parameters
+        ----------
+        reference_tree: CompactTree
+            the tree whose clusters are scored
+        thresholds: list of float
+            thresholds to cluster at
+        threads: int
+            number of processes to cluster replicates with
+        seed: int
+            seed of the random tip keys
+        binary_only: bool
+            only collapse nodes with exactly two children, as in Tree2Tax
+        '''
+        self.tree = reference_tree
+        self.threads = threads
+        self.binary_only = binary_only
+        self.threshold_and_clusters = Tree2Tax(binary_only).named_clusters_for_several_thresholds(reference_tree, thresholds, threads=threads)
+        # the clusters are of the tree with any multifurcations resolved,
+        # which has the tips of the reference tree in another order
+        tree = self.threshold_and_clusters[0].taxonomy_index.tree
+        tip_names = [tree.name(t) for t in tree.tip_ids]
+        self._tip_index = dict([(name, i) for i, name in enumerate(tip_names)])
+        if len(self._tip_index) != len(tip_names):
+            raise ReplicateException("Tip names of the reference tree are not unique")
+        self._keys = np.frombuffer(np.random.RandomState(seed).bytes(8*len(tip_names)), dtype=np.uint64)
+
+        self.thresholds = [tc.threshold for tc in self.threshold_and_clusters]
+        self.reference_hashes = [_cluster_hashes(tree, self._keys, np.array([c.lca_id for c in tc.clusters], dtype=np.int64))
+                                 for tc in self.threshold_and_clusters]
+        self.support_counts = [np.zeros(len(hashes), dtype=np.int64) for hashes in self.reference_hashes]
+        self.num_replicates = 0
+
+    def _tip_keys(self, replicate):
+        '''return the keys of the tips of a replicate tree, in its tip_ids
+        order, raising ReplicateException unless it has exactly the tips of
+        the reference tree'''
+        names = replicate.names
+        try:
+            indices = np.array([self._tip_index[names[i]] for i in replicate.name_id[replicate.tip_ids]], dtype=np.int64)
+        except (KeyError, IndexError):
+            raise ReplicateException("Replicate tree %i has a tip not in the reference tree" % (self.num_replicates+1))
+        if len(indices) != len(self._keys) or (np.bincount(indices, minlength=len(self._keys)) != 1).any():
+            raise ReplicateException("Replicate tree %i does not have exactly the tips of the reference tree" % (self.num_replicates+1))
+        return self._keys[indices]
+
+    def add_replicates(self, replicates, batch_size=None):
+        '''Cluster each of an iterable of replicate CompactTrees, counting
+        the reference clusters found in each. Replicates are clustered in
+        batches of batch_size (default twice the number of threads), so that
+        only a batch of them is held in memory at once.'''
+        if batch_size is None: batch_size = 2*self.threads
+        pool = multiprocessing.Pool(self.threads) if self.threads > 1 else None
+        try:
+            batch = []
+            for replicate in replicates:
+                batch.append((replicate, self._tip_keys(replicate), self.thresholds, self.binary_only))
+                if len(batch) >= batch_size:
+                    self._add_batch(batch, pool)
+                    batch = []
+            if batch: self._add_batch(batch, pool)
+        except:
+            if pool is not None: pool.terminate()
+            raise
+        else:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def _add_batch(self, batch, pool):
+        if pool is None:
+            results = [_replicate_hashes(task) for task in batch]
+        else:
+            results = pool.map(_replicate_hashes, batch)
+        for replicate_hashes in results:
+            for counts, reference_hashes, hashes in zip(self.support_counts, self.reference_hashes, replicate_hashes):
+                found = np.searchsorted(hashes, reference_hashes)
+                # every tree has at least one cluster
+                found[found == len(hashes)] = 0
+                counts += hashes[found] == reference_hashes
+            self.num_replicates += 1
+        if logging.getLogger().isEnabledFor(logging.INFO): logging.info("Clustered %i replicates" % self.num_replicates)
+
+    def support(self):
+        '''return a list, for each threshold in increasing order, of an
+        array of the support of each reference cluster'''
+        return [counts / float(max(self.num_replicates, 1)) for counts in self.support_counts]
+
+    def write(self, level_names, f):
+        '''Write a tab separated table of the level, threshold, name, number
+        of tips and support of each reference cluster to the open file f.
+        Levels are named from the largest threshold down, as in the taxonomy
+        output.'''
+        if len(self.thresholds) > len(level_names):
+            raise ValueError("Only %i level names were given, but there are %i thresholds" % (
+                len(level_names), len(self.thresholds)))
+        f.write("level\tthreshold\tcluster\ttips\tsupport\n")
+        supports = self.support()
+        for level, i in enumerate(reversed(range(len(self.thresholds)))):
+            tc = self.threshold_and_clusters[i]
+            for cluster, support in zip(tc.clusters, supports[i].tolist()):
+                f.write("%s\t%r\t%s\t%i\t%.4f\n" % (level_names[level], tc.threshold, cluster.name(),
+                                                     cluster.num_tips(), support))
@@ -0,0 +1,104 @@
+import numpy as np
+
+from .tree_cache import StringTable, tree_arrays, tree_from_arrays
+from .cluster_assignments import ClusterAssignments
+
+class ClusteringState:
+    '''The clustering of a tree at several thresholds, kept so that the tree
+    can later be reclustered incrementally after new tips are grafted into
+    it (see Tree2Tax#recluster_with_grafts). Alongside the tree are the
+    height and merge height of each node, and for each threshold the LCA
+    node ids of the clusters in preorder, their taxonomy as an index into
+    the taxonomies list and their cluster number (0 meaning unnumbered).
+    The RankTable of the tree is kept when the state is in memory, but not
+    saved, so a loaded state parses the names of its tree once when first
+    reclustered.'''
+
+    def __init__(self, tree, thresholds, heights, merge_heights,
+                 cluster_lcas, cluster_taxonomy_ids, cluster_numbers, taxonomies):
+        self.tree = tree
+        self.thresholds = thresholds
+        self.heights = heights
+        self.merge_heights = merge_heights
+        self.cluster_lcas = cluster_lcas
+        self.cluster_taxonomy_ids = cluster_taxonomy_ids
+        self.cluster_numbers = cluster_numbers
+        self.taxonomies = taxonomies
+        self.rank_table = None
+
+    def cluster_name(self, threshold_index, cluster_index):
+        '''return the name of a cluster, as given by NamedCluster#name'''
+        taxonomy = self.taxonomies[self.cluster_taxonomy_ids[threshold_index][cluster_index]]
+        number = self.cluster_numbers[threshold_index][cluster_index]
+        if number > 0:
+            return "%s.%s" % (taxonomy, number)
+        else:
+            return taxonomy
+
+    def cluster_names(self, threshold_index):
+        '''return the names of the clusters of a threshold, in preorder'''
+        return [self.cluster_name(threshold_index, i) for i in range(len(self.cluster_lcas[threshold_index]))]
+
+    def tip_clusters(self, threshold_index):
+        '''return an array giving the index of the cluster of each tip, tips
+        being numbered left to right as in CompactTree#tip_ids'''
+        starts = self.tree._tips_before[self.cluster_lcas[threshold_index]]
+        return np.searchsorted(starts, np.arange(self.tree.num_tips()), side='right') - 1
+
+    def cluster_assignments(self):
+        '''return the clusters of every tip as a ClusterAssignments'''
+        tree = self.tree
+        clusters = np.empty((tree.num_tips(), len(self.thresholds)), dtype=np.int32)
+        cluster_sizes = []
+        for i in range(len(self.thresholds)):
+            clusters[:, i] = self.tip_clusters(i)
+            starts = tree._tips_before[self.cluster_lcas[i]]
+            cluster_sizes.append(np.diff(np.append(starts, tree.num_tips())))
+        return ClusterAssignments(list(self.thresholds),
+                                  [tree.name(t) for t in tree.tip_ids],
+                                  clusters,
+                                  [self.cluster_names(i) for i in range(len(self.thresholds))],
+                                  list(self.cluster_lcas),
+                                  cluster_sizes)
+
+    def save(self, path):
+        '''Save the state to path, in numpy's npz format'''
+        taxonomies = StringTable.from_strings(self.taxonomies)
+        arrays = tree_arrays(self.tree)
+        arrays.update({'taxonomy_offsets': taxonomies.offsets, 'taxonomy_data': taxonomies.data,
+                       'thresholds': np.array(self.thresholds, dtype=np.float64),
+                       'heights': self.heights, 'merge_heights': self.merge_heights})
+        for i in range(len(self.thresholds)):
+            arrays['cluster_lcas_%i' % i] = self.cluster_lcas[i]
+            arrays['cluster_taxonomy_ids_%i' % i] = self.cluster_taxonomy_ids[i]
+            arrays['cluster_numbers_%i' % i] = self.cluster_numbers[i]
+        with open(path, 'wb') as f:
+            np.savez(f, **arrays)
+
+    @staticmethod
+    def load(path):
+        '''Load a state saved with save'''
+        arrays = np.load(path)
+        tree = tree_from_arrays(arrays)
+        thresholds = arrays['thresholds'].tolist()
+        return ClusteringState(tree, thresholds, arrays['heights'], arrays['merge_heights'],
+                               [arrays['cluster_lcas_%i' % i] for i in range(len(thresholds))],
+                               [arrays['cluster_taxonomy_ids_%i' % i] for i in range(len(thresholds))],
+                               [arrays['cluster_numbers_%i' % i] for i in range(len(thresholds))],
+                               list(StringTable(arrays['taxonomy_offsets'], arrays['taxonomy_data'])))
+
+
+class ClusterChange:
+    '''A cluster whose name or tips changed when a tree was reclustered
+    after grafting. old_names are the names of the clusters its tips were in
+    before (none if it contains only new tips), and new_tips the number of
+    grafted tips it contains.'''
+    def __init__(self, threshold, new_name, old_names, new_tips, lca_id):
+        self.threshold = threshold
+        self.new_name = new_name
+        self.old_names = old_names
+        self.new_tips = new_tips
+        self.lca_id = lca_id
+
+    def __str__(self):
+        return "%s: %s -> %s (%i new tips)" % (self.threshold, ', '.join(self.old_names), self.new_name, self.new_tips)
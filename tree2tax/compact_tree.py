@@ -0,0 +1,523 @@
+import numpy as np
+
+
+class CompactTree:
+    '''A read-only tree held in flat numpy arrays. Nodes are numbered in
+    preorder, so node 0 is the root and the descendants of node i are exactly
+    the nodes i+1 .. subtree_end[i]-1. The topology is stored as parent, first
+    child and next sibling indices (-1 meaning there is none), alongside
+    branch lengths and an index into a table of distinct node names.
+
+    Missing branch lengths are stored as 0.0, and nodes without a name
+    have a name_id of -1.
+
+    A tree made by resolve keeps the tree it was made from as resolved_from,
+    and the id in it of each node of that tree as resolved_node_ids. Both
+    are None for other trees.'''
+
+    def __init__(self, parent, first_child, next_sibling, length, name_id, names,
+                 tree_nodes=None, subtree_end=None, depth=None):
+        '''
+        Parameters
+        ----------
+        parent, first_child, next_sibling: numpy int32 arrays
+            topology of the tree, nodes numbered in preorder
+        length: numpy float64 array
+            length of the branch above each node
+        name_id: numpy int32 array
+            index of each node's name in names, or -1 if unnamed
+        names: list of str
+            table of distinct node names
+        tree_nodes: list of TreeNode or None
+            when the tree was built from a TreeNode, the original nodes
+            in preorder, so results can be reported in terms of them
+        subtree_end, depth: numpy arrays or None
+            previously calculated values of these attributes, otherwise
+            they are calculated from the topology
+        '''
+        self.parent = parent
+        self.first_child = first_child
+        self.next_sibling = next_sibling
+        self.length = length
+        self.name_id = name_id
+        self.names = names
+        self._tree_nodes = tree_nodes
+        self.subtree_end = subtree_end
+        self.depth = depth
+        self.resolved_from = None
+        self.resolved_node_ids = None
+        self._index_topology()
+
+    def _index_topology(self):
+        num_nodes = len(self.parent)
+        self.is_tip = self.first_child < 0
+
+        self.num_children = np.bincount(self.parent[1:], minlength=num_nodes).astype(np.int32)
+
+        if self.subtree_end is None or self.depth is None:
+            # children have higher preorder indices than their parents, so a
+            # single reverse pass accumulates subtree sizes bottom up, and a
+            # forward pass depths top down
+            parents = self.parent.tolist()
+            sizes = [1]*num_nodes
+            for i in range(num_nodes-1, 0, -1):
+                sizes[parents[i]] += sizes[i]
+            self.subtree_end = np.arange(num_nodes, dtype=np.int64) + np.array(sizes, dtype=np.int64)
+
+            depths = [0]*num_nodes
+            for i in range(1, num_nodes):
+                depths[i] = depths[parents[i]] + 1
+            self.depth = np.array(depths, dtype=np.int32)
+
+        # tips numbered left to right, so each clade is a contiguous range
+        # of tip indices
+        self.tip_ids = np.flatnonzero(self.is_tip)
+        self._tips_before = np.zeros(num_nodes+1, dtype=np.int64)
+        np.cumsum(self.is_tip, out=self._tips_before[1:])
+
+    @staticmethod
+    def from_tree_node(tree):
+        '''Build a CompactTree from a scikit-bio TreeNode, without modifying
+        it'''
+        nodes = list(tree.preorder(include_self=True))
+        num_nodes = len(nodes)
+        node_to_index = {}
+        for i, node in enumerate(nodes):
+            node_to_index[id(node)] = i
+
+        parent = np.empty(num_nodes, dtype=np.int32)
+        first_child = np.empty(num_nodes, dtype=np.int32)
+        next_sibling = np.empty(num_nodes, dtype=np.int32)
+        length = np.empty(num_nodes, dtype=np.float64)
+        name_id = np.empty(num_nodes, dtype=np.int32)
+        names = []
+        name_to_id = {}
+
+        parent[0] = -1
+        next_sibling[0] = -1
+        for i, node in enumerate(nodes):
+            length[i] = node.length if node.length is not None else 0.0
+
+            if node.name is None:
+                name_id[i] = -1
+            else:
+                try:
+                    name_id[i] = name_to_id[node.name]
+                except KeyError:
+                    name_to_id[node.name] = len(names)
+                    name_id[i] = len(names)
+                    names.append(node.name)
+
+            if node.children:
+                child_indices = [node_to_index[id(c)] for c in node.children]
+                first_child[i] = child_indices[0]
+                for j, c in enumerate(child_indices):
+                    parent[c] = i
+                    if j+1 < len(child_indices):
+                        next_sibling[c] = child_indices[j+1]
+                    else:
+                        next_sibling[c] = -1
+            else:
+                first_child[i] = -1
+
+        return CompactTree(parent, first_child, next_sibling, length, name_id, names, nodes)
+
+    @staticmethod
+    def from_parents(parent, length, name_id, names, tree_nodes=None):
+        '''Build a CompactTree from the parent of each node, the nodes being
+        numbered in preorder so that children are ordered by their ids'''
+        num_nodes = len(parent)
+        first_child = np.empty(num_nodes, dtype=np.int32)
+        first_child.fill(-1)
+        next_sibling = np.empty(num_nodes, dtype=np.int32)
+        next_sibling.fill(-1)
+        if num_nodes > 1:
+            children = np.arange(1, num_nodes)
+            parents = parent[1:]
+            # assign in reverse so the smallest child of each parent is set last
+            first_child[parents[::-1]] = children[::-1]
+            # children are in id order within each parent
+            order = np.lexsort((children, parents))
+            same_parent = parents[order[1:]] == parents[order[:-1]]
+            next_sibling[children[order[:-1]][same_parent]] = children[order[1:]][same_parent]
+        return CompactTree(np.asarray(parent, dtype=np.int32), first_child, next_sibling,
+                           np.asarray(length, dtype=np.float64), np.asarray(name_id, dtype=np.int32),
+                           names, tree_nodes)
+
+    def graft(self, edges, distal_lengths, pendant_lengths, tip_names):
+        '''Return a new CompactTree with tips attached to the given edges,
+        and an array giving the id in the new tree of each node of this one.
+
+        Each new tip is attached via a new internal node which splits the edge
+        above the node given in edges, distal_lengths from its lower end, as
+        in pplacer placements. The tip hangs off the new node on a branch of
+        the given pendant length, as its second child. Several tips may be
+        grafted onto the same edge.
+
+        Parameters
+        ----------
+        edges: array of int
+            id of the node below the edge each tip is grafted onto
+        distal_lengths: array of float
+            distance along the edge from the node below to the graft
+        pendant_lengths: array of float
+            length of the branch to each new tip
+        tip_names: list of str
+            names of the new tips
+        '''
+        edges = np.asarray(edges, dtype=np.int64)
+        distal_lengths = np.asarray(distal_lengths, dtype=np.float64)
+        pendant_lengths = np.asarray(pendant_lengths, dtype=np.float64)
+        num_grafts = len(edges)
+        if np.any(edges <= 0) or np.any(edges >= len(self)):
+            raise ValueError("Tips can only be grafted onto edges above non-root nodes of the tree")
+        if np.any(distal_lengths < 0) or np.any(distal_lengths > self.length[edges]):
+            raise ValueError("Graft positions must lie within their edges")
+
+        # grafts on the same edge are stacked, the nearest the lower node
+        # lowest
+        by_edge = np.lexsort((np.arange(num_grafts), distal_lengths, edges))
+        edges = edges[by_edge]
+        distal_lengths = distal_lengths[by_edge]
+        pendant_lengths = pendant_lengths[by_edge]
+        tip_names = [tip_names[i] for i in by_edge]
+        starts_edge = np.ones(num_grafts, dtype=bool)
+        starts_edge[1:] = edges[1:] != edges[:-1]
+        edge_start = np.maximum.accumulate(np.where(starts_edge, np.arange(num_grafts), 0))
+        ends_edge = np.ones(num_grafts, dtype=bool)
+        ends_edge[:-1] = starts_edge[1:]
+
+        # In preorder the new internal nodes of an edge come before its
+        # lower node, topmost first, and the new tips come after the
+        # subtree of the lower node, lowest first. Insertions are ordered
+        # by the old node they are inserted before, with tips closing inner
+        # subtrees before those of outer ones, and before internal nodes
+        # starting the next subtree.
+        internal_positions = edges
+        tip_positions = self.subtree_end[edges]
+        positions = np.concatenate([internal_positions, tip_positions])
+        kinds = np.concatenate([np.ones(num_grafts, dtype=np.int64), np.zeros(num_grafts, dtype=np.int64)])
+        # internal nodes topmost first, tips of inner edges first then lowest first
+        within = np.concatenate([-np.arange(num_grafts), -edges*num_grafts + np.arange(num_grafts)])
+        insertion_order = np.lexsort((within, kinds, positions))
+        new_ids = np.empty(2*num_grafts, dtype=np.int64)
+        new_ids[insertion_order] = positions[insertion_order] + np.arange(2*num_grafts)
+        internal_ids = new_ids[:num_grafts]
+        tip_ids = new_ids[num_grafts:]
+
+        num_nodes = len(self) + 2*num_grafts
+        old_to_new = np.arange(len(self)) + np.searchsorted(np.sort(positions), np.arange(len(self)), side='right')
+
+        parent = np.empty(num_nodes, dtype=np.int32)
+        length = np.empty(num_nodes, dtype=np.float64)
+        name_id = np.empty(num_nodes, dtype=np.int32)
+        parent[old_to_new[1:]] = old_to_new[self.parent[1:]]
+        parent[0] = -1
+        length[old_to_new] = self.length
+        name_id[old_to_new] = self.name_id
+
+        # the lowest new node of each edge is the parent of the old node,
+        # each new node the parent of the one below, and the topmost the
+        # child of the old parent
+        lowest = starts_edge
+        parent[old_to_new[edges[lowest]]] = internal_ids[lowest]
+        length[old_to_new[edges[lowest]]] = distal_lengths[lowest]
+        below = ~starts_edge
+        parent[internal_ids[np.flatnonzero(below)-1]] = internal_ids[below]
+        topmost = ends_edge
+        parent[internal_ids[topmost]] = old_to_new[self.parent[edges[topmost]]]
+        next_distal = np.where(ends_edge, self.length[edges], np.roll(distal_lengths, -1))
+        length[internal_ids] = next_distal - distal_lengths
+        name_id[internal_ids] = -1
+
+        parent[tip_ids] = internal_ids
+        length[tip_ids] = pendant_lengths
+        names = list(self.names)
+        name_id[tip_ids] = np.arange(len(names), len(names)+num_grafts)
+        names.extend(tip_names)
+
+        return CompactTree.from_parents(parent, length, name_id, names), old_to_new
+
+    def resolve(self, merges):
+        '''Return a new CompactTree in which the children of some nodes are
+        joined two at a time under new nodes, and an array giving the id in
+        the new tree of each node of this one.
+
+        merges is a dict of node id to a list of (first, second) pairs, as
+        given by _greedy_merges. The children of the node are numbered from 0
+        in order, and each pair is joined under a new node numbered
+        len(children)+i for the ith pair, except that when all the children
+        are joined the last pair become the children of the node itself.
+        New nodes are unnamed, with branches of length zero. The children of
+        each node, new or old, are ordered by the first of the original
+        children below them, so a node without merges keeps its order.'''
+        parent = []
+        length = []
+        name_id = []
+        tree_nodes = [] if self._tree_nodes is not None else None
+        old_to_new = np.empty(len(self), dtype=np.int64)
+        old_length = self.length.tolist()
+        old_name_id = self.name_id.tolist()
+        first_children = self.first_child.tolist()
+        next_siblings = self.next_sibling.tolist()
+
+        # a depth first traversal, each stack entry being the old node id,
+        # or -1 and the list of old children below a new node, and the id of
+        # the parent in the new tree
+        stack = [(0, None, -1)]
+        while stack:
+            node, new_node_children, new_parent = stack.pop()
+            new_id = len(parent)
+            parent.append(new_parent)
+            if node >= 0:
+                old_to_new[node] = new_id
+                length.append(old_length[node])
+                name_id.append(old_name_id[node])
+                if tree_nodes is not None: tree_nodes.append(self._tree_nodes[node])
+                children = []
+                child = first_children[node]
+                while child >= 0:
+                    children.append(child)
+                    child = next_siblings[child]
+                if node not in merges:
+                    for child in reversed(children):
+                        stack.append((child, None, new_id))
+                    continue
+                # each group is (position of its first child, the child id
+                # or a list of the two groups joined)
+                groups = [(i, child) for i, child in enumerate(children)]
+                joined = set()
+                for first, second in merges[node]:
+                    joined.update((first, second))
+                    pair = sorted([groups[first], groups[second]])
+                    groups.append((pair[0][0], pair))
+                top = sorted([group for i, group in enumerate(groups) if i not in joined])
+                if len(top) == 1: top = top[0][1]
+            else:
+                length.append(0.0)
+                name_id.append(-1)
+                if tree_nodes is not None: tree_nodes.append(None)
+                top = new_node_children
+            for _, content in reversed(top):
+                if isinstance(content, list):
+                    stack.append((-1, content, new_id))
+                else:
+                    stack.append((content, None, new_id))
+
+        resolved = CompactTree.from_parents(np.array(parent, dtype=np.int32), length, name_id,
+                                            self.names, tree_nodes)
+        resolved.resolved_from = self
+        resolved.resolved_node_ids = old_to_new
+        return resolved, old_to_new
+
+    def __len__(self):
+        return len(self.parent)
+
+    def num_tips(self):
+        return len(self.tip_ids)
+
+    def name(self, node_id):
+        '''return the name of the given node, or None'''
+        i = self.name_id[node_id]
+        if i < 0:
+            return None
+        else:
+            return self.names[i]
+
+    def children(self, node_id):
+        '''return a list of the ids of the children of the given node'''
+        to_return = []
+        child = self.first_child[node_id]
+        while child >= 0:
+            to_return.append(int(child))
+            child = self.next_sibling[child]
+        return to_return
+
+    def tip_range(self, node_id):
+        '''return (start, end) such that tip_ids[start:end] are the tips
+        descended from the given node (or the node itself if it is a tip)'''
+        return (int(self._tips_before[node_id]),
+                int(self._tips_before[self.subtree_end[node_id]]))
+
+    def distance(self, first, second):
+        '''return the sum of branch lengths on the path between two nodes'''
+        ancestor_distances = {}
+        current = first
+        distance = 0.0
+        while current >= 0:
+            ancestor_distances[current] = distance
+            distance += self.length[current]
+            current = self.parent[current]
+        
+        current = second
+        distance = 0.0
+        while current not in ancestor_distances:
+            distance += self.length[current]
+            current = self.parent[current]
+        return distance + ancestor_distances[current]
+
+    def to_tree_node(self):
+        '''Return a scikit-bio TreeNode representation of this tree'''
+        from skbio.tree import TreeNode
+        nodes = []
+        for i in range(len(self)):
+            node = TreeNode(name=self.name(i), length=float(self.length[i]))
+            nodes.append(node)
+            if i > 0:
+                nodes[self.parent[i]].append(node)
+        nodes[0].length = None
+        return nodes[0]
+
+    def postorder_index(self):
+        '''return an array giving the position of each node in a postorder
+        traversal'''
+        # in preorder, the nodes before i are its ancestors and nodes whose
+        # subtrees are complete, so only the ancestors come after it in postorder
+        return self.subtree_end - 1 - self.depth
+
+    def depth_levels(self):
+        '''return a list of arrays of the nodes at each depth, from the root
+        downwards, for processing a level of the tree at a time'''
+        order = np.argsort(self.depth, kind='mergesort')
+        level_starts = np.searchsorted(self.depth[order], np.arange(0, self.depth.max()+2))
+        return [order[start:end] for start, end in zip(level_starts[:-1], level_starts[1:])]
+
+    def root_distances(self):
+        '''return an array of the sum of branch lengths from the root to each
+        node'''
+        distances = self.length.astype(np.float64)
+        distances[0] = 0.0
+        # add on the distances of each depth's parents in turn, shallowest
+        # first
+        for nodes in self.depth_levels()[1:]:
+            distances[nodes] += distances[self.parent[nodes]]
+        return distances
+
+    def node(self, node_id):
+        '''return an object representing the given node. If this tree was
+        built from a TreeNode then the original TreeNode is returned, otherwise
+        a CompactNode view onto this tree.'''
+        if self._tree_nodes is not None and self._tree_nodes[node_id] is not None:
+            return self._tree_nodes[node_id]
+        else:
+            return CompactNode(self, int(node_id))
+
+
+class LCAIndex:
+    '''Answers lowest common ancestor queries on a CompactTree in constant
+    time, after O(n log n) preprocessing.
+
+    In preorder, the nodes after u up to and including a later node v
+    include the child of lca(u, v) on the path to v, and nothing shallower,
+    so lca(u, v) is the parent of the shallowest of them. This is the usual
+    Euler tour reduction to a range minimum query, using the preorder
+    numbering in place of the tour, and the minima are found from a sparse
+    table of the shallowest node in each power of two sized range.'''
+    def __init__(self, tree):
+        self.tree = tree
+        self.depth = np.asarray(tree.depth)
+        num_nodes = len(tree)
+
+        self.sparse_table = [np.arange(num_nodes, dtype=np.int32)]
+        width = 1
+        while 2*width <= num_nodes:
+            previous = self.sparse_table[-1]
+            left = previous[:num_nodes-2*width+1]
+            right = previous[width:num_nodes-width+1]
+            self.sparse_table.append(np.where(self.depth[right] < self.depth[left], right, left))
+            width *= 2
+
+        self.root_distances = tree.root_distances()
+
+    def lca(self, first, second):
+        '''return the lowest common ancestor of each pair of nodes, given as
+        ints or as equal length arrays'''
+        first = np.asarray(first)
+        second = np.asarray(second)
+        start = np.minimum(first, second) + 1
+        end = np.maximum(first, second)
+        same = start > end
+        # any valid range for identical nodes, the result is replaced below
+        start = np.where(same, end, start)
+
+        level = np.floor(np.log2(end - start + 1)).astype(np.int64)
+        width = np.left_shift(1, level)
+        lca = np.empty(np.shape(start), dtype=np.int64)
+        # table rows have different lengths, so look up each level separately
+        for k in np.unique(level):
+            in_level = level == k
+            left = self.sparse_table[k][start[in_level]]
+            right = self.sparse_table[k][end[in_level] - width[in_level] + 1]
+            shallowest = np.where(self.depth[right] < self.depth[left], right, left)
+            lca[in_level] = self.tree.parent[shallowest]
+        lca = np.where(same, first, lca)
+        if lca.ndim == 0:
+            return int(lca)
+        else:
+            return lca
+
+    def distance(self, first, second):
+        '''return the path length between each pair of nodes, given as ints
+        or as equal length arrays'''
+        lca = self.lca(first, second)
+        return self.root_distances[first] + self.root_distances[second] - \
+            2*self.root_distances[lca]
+
+
+class CompactNode(object):
+    '''A lightweight view of a single node in a CompactTree, providing the
+    parts of the TreeNode interface used by tree2tax'''
+    __slots__ = ('tree', 'id')
+
+    def __init__(self, tree, node_id):
+        self.tree = tree
+        self.id = node_id
+
+    @property
+    def name(self):
+        return self.tree.name(self.id)
+
+    @property
+    def length(self):
+        return float(self.tree.length[self.id])
+
+    @property
+    def parent(self):
+        p = self.tree.parent[self.id]
+        if p < 0:
+            return None
+        else:
+            return CompactNode(self.tree, int(p))
+
+    @property
+    def children(self):
+        return [CompactNode(self.tree, c) for c in self.tree.children(self.id)]
+
+    def distance(self, other):
+        return self.tree.distance(self.id, other.id)
+
+    def is_tip(self):
+        return bool(self.tree.is_tip[self.id])
+
+    def is_root(self):
+        return self.id == 0
+
+    def tips(self):
+        start, end = self.tree.tip_range(self.id)
+        if self.is_tip():
+            return
+        for i in self.tree.tip_ids[start:end]:
+            yield CompactNode(self.tree, int(i))
+
+    def __eq__(self, other):
+        return isinstance(other, CompactNode) and \
+            self.tree is other.tree and self.id == other.id
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((id(self.tree), self.id))
+
+    def __repr__(self):
+        return "<CompactNode %s: %s>" % (self.id, self.name)
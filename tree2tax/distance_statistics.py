@@ -0,0 +1,135 @@
+import numpy as np
+
+
+class DistanceStatistics:
+    '''Summary statistics of a stream of distances, added a block at a time
+    as numpy arrays.
+
+    By default every distance is kept in a growing numpy buffer, so that the
+    median is exact, being found by selection rather than a full sort. If a
+    sketch_size is given, then instead a uniform random sample of at most
+    that many distances is kept (reservoir sampling), and the median and
+    quantiles are approximations from it, so memory use does not depend on
+    the number of distances. Only then is the memory used bounded, since
+    without a sketch_size every distance is kept.
+
+    In both modes a histogram of all the distances is counted exactly, in
+    at most max_bins bins of equal width starting at 0. Whenever a distance
+    falls beyond the last bin, the width is doubled by merging each pair of
+    neighbouring bins, so the histogram stays the same size however large
+    the distances are.'''
+
+    def __init__(self, sketch_size=None, bin_width=0.01, seed=1, max_bins=1000):
+        '''
+        Parameters
+        ----------
+        sketch_size: int or None
+            number of distances to sample for approximate statistics, or None
+            to keep them all
+        bin_width: float
+            initial width of the histogram bins, the first of which starts
+            at 0
+        seed: int
+            seed of the random number generator used for sampling
+        max_bins: int
+            number of histogram bins, which must be even
+        '''
+        if max_bins < 2 or max_bins % 2:
+            raise ValueError("The number of histogram bins must be even, not %i" % max_bins)
+        self.sketch_size = sketch_size
+        self.bin_width = bin_width
+        self.max_bins = max_bins
+        self.count = 0
+        self.minimum = None
+        self.maximum = None
+        self._values = np.zeros(sketch_size if sketch_size is not None else 1024, dtype=np.float64)
+        self._num_values = 0
+        self._bin_counts = np.zeros(max_bins, dtype=np.int64)
+        self._random = np.random.RandomState(seed)
+
+    def add(self, distances):
+        '''Add an array of distances, which must all be finite'''
+        distances = np.asarray(distances, dtype=np.float64).ravel()
+        if len(distances) == 0: return
+        if not np.isfinite(distances).all():
+            raise ValueError("Distances must be finite, but %i of those added are infinite or NaN, "
+                             "perhaps because of missing branch lengths" % np.count_nonzero(~np.isfinite(distances)))
+
+        if self.count == 0:
+            self.minimum = distances.min()
+            self.maximum = distances.max()
+        else:
+            self.minimum = min(self.minimum, distances.min())
+            self.maximum = max(self.maximum, distances.max())
+
+        while self.maximum >= self.max_bins * self.bin_width:
+            self._bin_counts = np.concatenate((self._bin_counts.reshape(-1, 2).sum(axis=1),
+                                               np.zeros(self.max_bins/2, dtype=np.int64)))
+            self.bin_width *= 2
+        bins = np.floor(np.maximum(distances, 0.0) / self.bin_width).astype(np.int64)
+        # guard against rounding up past the last bin
+        np.minimum(bins, self.max_bins-1, out=bins)
+        self._bin_counts += np.bincount(bins, minlength=self.max_bins)
+
+        if self.sketch_size is None:
+            self._append(distances)
+        else:
+            self._sample(distances)
+        self.count += len(distances)
+
+    def _append(self, distances):
+        needed = self._num_values + len(distances)
+        if needed > len(self._values):
+            grown = np.zeros(max(needed, 2*len(self._values)), dtype=np.float64)
+            grown[:self._num_values] = self._values[:self._num_values]
+            self._values = grown
+        self._values[self._num_values:needed] = distances
+        self._num_values = needed
+
+    def _sample(self, distances):
+        # fill the reservoir first
+        space = min(self.sketch_size - self._num_values, len(distances))
+        if space > 0:
+            self._values[self._num_values:self._num_values+space] = distances[:space]
+            self._num_values += space
+            distances = distances[space:]
+        if len(distances) == 0: return
+
+        # then the kth distance seen replaces a random sample with
+        # probability sketch_size/k. Later distances in the block overwrite
+        # earlier ones, as if they had been added one at a time.
+        seen = self.count + space + np.arange(1, len(distances)+1)
+        slots = (self._random.random_sample(len(distances)) * seen).astype(np.int64)
+        replace = slots < self.sketch_size
+        self._values[slots[replace]] = distances[replace]
+
+    def values(self):
+        '''return the distances kept, all of them unless sampling'''
+        return self._values[:self._num_values]
+
+    def median(self):
+        '''return the median of the distances, or None if there are none. If
+        there are an even number, the mean of the two middle values.'''
+        values = self.values()
+        if len(values) == 0: return None
+        half = (len(values) - 1) / 2
+        if len(values) % 2:
+            return float(np.partition(values, half)[half])
+        else:
+            middle = np.partition(values, [half, half+1])[half:half+2]
+            return (middle[0] + middle[1]) / 2.0
+
+    def quantiles(self, fractions):
+        '''return the given quantiles of the distances, each between 0 and 1,
+        linearly interpolated'''
+        values = self.values()
+        if len(values) == 0: return [None for _ in fractions]
+        return [float(q) for q in np.percentile(values, [100.0*f for f in fractions])]
+
+    def histogram(self):
+        '''return a list of (bin start, bin end, count), for each bin from 0
+        up to the largest distance'''
+        used = np.flatnonzero(self._bin_counts)
+        if len(used) == 0: return []
+        return [(i*self.bin_width, (i+1)*self.bin_width, int(c))
+                for i, c in enumerate(self._bin_counts[:used[-1]+1])]
@@ -0,0 +1,123 @@
+import json
+import time
+import resource
+import cProfile
+
+class Metrics:
+    '''Records the wall time and peak resident memory of each stage of a
+    run, along with counters describing the work done, and writes them as a
+    JSON report. Optionally the whole run is also profiled with cProfile.
+
+    The operating system only reports the peak memory of a process since it
+    started, so process_peak_rss_kb of a stage is the peak of the run up to
+    the end of that stage, not of the stage alone. peak_rss_increase_kb is
+    how far the stage raised it, which is 0 for a stage that never used more
+    than an earlier one. Child processes, e.g. those calculating merge
+    heights with several threads, are reported separately as the peak of
+    the largest child that has finished, in children_peak_rss_kb and
+    children_peak_rss_increase_kb.
+
+    Stages are timed with the stage method, e.g.
+
+    with metrics.stage('parse') as stage:
+        tree = reader.read(path)
+        stage.count('tips', tree.num_tips())
+    '''
+
+    def __init__(self, profile_path=None):
+        '''
+        Parameters
+        ----------
+        profile_path: str or None
+            if given, profile the run with cProfile from now until finish is
+            called, and dump the statistics to this file
+        '''
+        self.start_time = time.time()
+        self.stages = []
+        self.counters = {}
+        self.profile_path = profile_path
+        if profile_path is None:
+            self.profiler = None
+        else:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stage(self, name, **counters):
+        '''Return a context manager which times a stage of the run. Any given
+        counters are recorded against the stage.'''
+        stage = _Stage(name, counters)
+        self.stages.append(stage)
+        return stage
+
+    def count(self, name, value):
+        '''Record a counter for the run as a whole'''
+        self.counters[name] = value
+
+    def finish(self):
+        '''Stop profiling, dumping the statistics if requested'''
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile_path)
+            self.profiler = None
+
+    def report(self):
+        '''return the metrics as a dict'''
+        return {'wall_seconds': time.time() - self.start_time,
+                'process_peak_rss_kb': peak_rss_kb(),
+                'children_peak_rss_kb': children_peak_rss_kb(),
+                'counters': self.counters,
+                'stages': [s.report() for s in self.stages]}
+
+    def write(self, path):
+        '''Write the report to path as JSON'''
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=1, sort_keys=True)
+            f.write("\n")
+
+
+class _Stage:
+    def __init__(self, name, counters):
+        self.name = name
+        self.counters = counters
+        self.seconds = None
+        self.process_peak_rss_kb = None
+        self.peak_rss_increase_kb = None
+        self.children_peak_rss_kb = None
+        self.children_peak_rss_increase_kb = None
+
+    def count(self, name, value):
+        self.counters[name] = value
+
+    def __enter__(self):
+        self._start_rss = peak_rss_kb()
+        self._start_children_rss = children_peak_rss_kb()
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.seconds = time.time() - self._start
+        self.process_peak_rss_kb = peak_rss_kb()
+        self.peak_rss_increase_kb = self.process_peak_rss_kb - self._start_rss
+        self.children_peak_rss_kb = children_peak_rss_kb()
+        self.children_peak_rss_increase_kb = self.children_peak_rss_kb - self._start_children_rss
+
+    def report(self):
+        return {'name': self.name,
+                'seconds': self.seconds,
+                'process_peak_rss_kb': self.process_peak_rss_kb,
+                'peak_rss_increase_kb': self.peak_rss_increase_kb,
+                'children_peak_rss_kb': self.children_peak_rss_kb,
+                'children_peak_rss_increase_kb': self.children_peak_rss_increase_kb,
+                'counters': self.counters}
+
+
+def peak_rss_kb():
+    '''return the peak resident memory of this process so far, in kilobytes
+    (as reported by Linux)'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def children_peak_rss_kb():
+    '''return the peak resident memory of the largest child process of this
+    one that has finished and been waited for, in kilobytes, or 0 if there
+    were none'''
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
@@ -0,0 +1,262 @@
+import re
+import sys
+import zlib
+import bz2
+from array import array
+
+import numpy as np
+
+from .compact_tree import CompactTree
+
+class NewickFormatException(Exception): pass
+
+# Tokens of a newick file. Labels and branch lengths may be split into
+# several quoted and unquoted parts, which are joined together.
+_TOKEN_REGEX = re.compile(r"""
+    (?P<structure>[(),;:])
+  | '(?P<quoted>[^']*(?:''[^']*)*)'
+  | (?P<unquoted>[^\s(),;:\[\]']+)
+  | \[[^\]]*\]
+  | \s+
+  | (?P<incomplete>['\[])
+  | (?P<other>.)
+""", re.VERBOSE | re.DOTALL)
+
+class NewickReader:
+    '''A streaming reader of newick format trees, which builds CompactTree
+    objects directly rather than a TreeNode per node. Names are read as
+    scikit-bio does, so quoted labels are taken literally (with '' meaning a
+    single quote) and underscores in unquoted labels are converted to
+    spaces. Input may be plain, gzip or bzip2 compressed, and is read in
+    chunks.'''
+
+    def __init__(self, replace_spaces_with_underscores=False,
+                 convert_underscores=True, chunk_size=1<<20):
+        '''
+        Parameters
+        ----------
+        replace_spaces_with_underscores: boolean
+            run replace('  ','__') on the names of all non-tip nodes, so
+            unquoted taxonomy like g__Foo keeps its underscores
+        convert_underscores: boolean
+            convert underscores in unquoted labels to spaces
+        chunk_size: int
+            number of bytes to read at a time
+        '''
+        self.replace_spaces_with_underscores = replace_spaces_with_underscores
+        self.convert_underscores = convert_underscores
+        self.chunk_size = chunk_size
+
+    def read(self, source):
+        '''Return the first tree in source as a CompactTree. source may be a
+        path, '-' for stdin, or an open file.'''
+        for tree in self.each_tree(source):
+            return tree
+        raise NewickFormatException("No tree found in newick input")
+
+    def each_tree(self, source):
+        '''Iterate over the trees in source, yielding a CompactTree for each'''
+        if source == '-':
+            fh = sys.stdin
+            close = False
+        elif isinstance(source, basestring):
+            fh = open(source, 'rb')
+            close = True
+        else:
+            fh = source
+            close = False
+        try:
+            for tree in self._parse(self._decompressed_chunks(fh)):
+                yield tree
+        finally:
+            if close: fh.close()
+
+    def _decompressed_chunks(self, fh):
+        '''Iterate over chunks of the file, decompressing it when the first
+        bytes show it to be gzip or bzip2 compressed'''
+        chunk = fh.read(self.chunk_size)
+        if chunk.startswith('\x1f\x8b'):
+            new_decompressor = lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif chunk.startswith('BZh'):
+            new_decompressor = bz2.BZ2Decompressor
+        else:
+            while chunk:
+                yield chunk
+                chunk = fh.read(self.chunk_size)
+            return
+
+        decompressor = new_decompressor()
+        while chunk:
+            while chunk:
+                yield decompressor.decompress(chunk)
+                # concatenated streams are read one after the other
+                chunk = decompressor.unused_data
+                if chunk: decompressor = new_decompressor()
+            chunk = fh.read(self.chunk_size)
+
+    def _parse(self, chunks):
+        tree = _TreeBuilder()
+
+        leftover = ''
+        eof = False
+        chunks = iter(chunks)
+        while not eof:
+            try:
+                buf = leftover + chunks.next()
+            except StopIteration:
+                buf = leftover
+                eof = True
+
+            label_parts = []
+            # index in buf where the label currently being read started, so
+            # that a label split across chunks can be re-read whole
+            label_start = None
+            leftover = ''
+            for match in _TOKEN_REGEX.finditer(buf):
+                kind = match.lastgroup
+                if kind == 'structure':
+                    if label_parts:
+                        tree.label(''.join(label_parts), self.replace_spaces_with_underscores)
+                        label_parts = []
+                        label_start = None
+
+                    character = match.group(kind)
+                    if character == '(':
+                        tree.open_parenthesis()
+                    elif character == ',':
+                        tree.comma()
+                    elif character == ')':
+                        tree.close_parenthesis()
+                    elif character == ':':
+                        tree.colon()
+                    else:
+                        yield tree.finish()
+                        tree = _TreeBuilder()
+
+                elif kind == 'unquoted':
+                    if label_start is None: label_start = match.start()
+                    if self.convert_underscores:
+                        label_parts.append(match.group(kind).replace('_',' '))
+                    else:
+                        label_parts.append(match.group(kind))
+                elif kind == 'quoted':
+                    if label_start is None: label_start = match.start()
+                    label_parts.append(match.group(kind).replace("''","'"))
+                elif kind == 'incomplete':
+                    if eof:
+                        raise NewickFormatException("Unbalanced quotes or comments in newick input")
+                    if label_start is None: label_start = match.start()
+                    break
+                elif kind == 'other':
+                    raise NewickFormatException("Unexpected character in newick input: %s" % match.group(kind))
+
+            if label_start is not None and not eof:
+                # the label may continue in the next chunk
+                leftover = buf[label_start:]
+
+        if label_parts or not tree.is_empty():
+            raise NewickFormatException("Newick input ended before the tree was terminated with a semicolon")
+
+
+class _TreeBuilder:
+    '''Accumulates the nodes of a single tree in preorder as it is parsed'''
+    def __init__(self):
+        self.parent = array('i')
+        self.first_child = array('i')
+        self.next_sibling = array('i')
+        self.length = array('d')
+        self.name_id = array('i')
+        self.names = []
+        self.name_to_id = {}
+
+        # currently open internal nodes, and the last child added to each
+        self.stack = []
+        self.last_child = []
+        # node that the next label or branch length applies to
+        self.current = -1
+        # True when the next label or '(' starts a new node
+        self.expecting_node = True
+        self.expecting_length = False
+
+    def is_empty(self):
+        return len(self.parent) == 0
+
+    def new_node(self):
+        index = len(self.parent)
+        if self.stack:
+            parent = self.stack[-1]
+            previous = self.last_child[-1]
+            if previous < 0:
+                self.first_child[parent] = index
+            else:
+                self.next_sibling[previous] = index
+            self.last_child[-1] = index
+        elif index > 0:
+            raise NewickFormatException("Newick tree has more than one root, or is missing a semicolon")
+        else:
+            parent = -1
+        self.parent.append(parent)
+        self.first_child.append(-1)
+        self.next_sibling.append(-1)
+        self.length.append(0.0)
+        self.name_id.append(-1)
+        self.current = index
+        self.expecting_node = False
+        return index
+
+    def label(self, text, replace_spaces_with_underscores):
+        if self.expecting_length:
+            try:
+                self.length[self.current] = float(text)
+            except ValueError:
+                raise NewickFormatException("Could not read length as numeric type: %s" % text)
+            self.expecting_length = False
+            return
+
+        if self.expecting_node:
+            self.new_node()
+        elif replace_spaces_with_underscores:
+            # an internal node, since it has been closed
+            text = text.replace('  ','__')
+
+        try:
+            self.name_id[self.current] = self.name_to_id[text]
+        except KeyError:
+            self.name_to_id[text] = len(self.names)
+            self.name_id[self.current] = len(self.names)
+            self.names.append(text)
+
+    def open_parenthesis(self):
+        if not self.expecting_node:
+            raise NewickFormatException("Could not parse file as newick. Contains unnested children.")
+        self.stack.append(self.new_node())
+        self.last_child.append(-1)
+        self.expecting_node = True
+
+    def comma(self):
+        if self.expecting_node: self.new_node()
+        if not self.stack:
+            raise NewickFormatException("Could not parse file as newick. Parenthesis are unbalanced.")
+        self.expecting_node = True
+
+    def close_parenthesis(self):
+        if self.expecting_node: self.new_node()
+        if not self.stack:
+            raise NewickFormatException("Could not parse file as newick. Parenthesis are unbalanced.")
+        self.current = self.stack.pop()
+        self.last_child.pop()
+
+    def colon(self):
+        if self.expecting_node: self.new_node()
+        self.expecting_length = True
+
+    def finish(self):
+        if self.stack:
+            raise NewickFormatException("Could not parse file as newick. Parenthesis are unbalanced.")
+        if self.expecting_node: self.new_node()
+        return CompactTree(np.frombuffer(self.parent, dtype=np.intc).astype(np.int32),
+                           np.frombuffer(self.first_child, dtype=np.intc).astype(np.int32),
+                           np.frombuffer(self.next_sibling, dtype=np.intc).astype(np.int32),
+                           np.frombuffer(self.length, dtype=np.float64).copy(),
+                           np.frombuffer(self.name_id, dtype=np.intc).astype(np.int32),
+                           self.names)
@@ -0,0 +1,312 @@
+import re
+import json
+import logging
+from StringIO import StringIO
+
+import numpy as np
+
+from .tree2tax import Tree2Tax
+from .newick import NewickReader
+from .tree_cache import StringTable, tree_arrays, tree_from_arrays
+from .taxonomy_writer import TaxonomyWriter
+
+class PlacementException(Exception): pass
+
+class PlacementIndex:
+    '''Classifies query sequences placed onto the edges of a clustered
+    reference tree, e.g. by pplacer, without reclustering it.
+
+    A query placed on an edge joins the reference cluster containing the
+    node below that edge if grafting it there would not split that cluster,
+    i.e. if the query is within the threshold of every tip of the cluster,
+    since clustering is complete linkage. Its distance to the farthest of
+    those tips is the larger of the farthest tip below the edge and the
+    farthest tip of the cluster reached by going up the edge, so for each
+    level the index holds the cluster containing each node and the distance
+    from its parent to the farthest tip of that cluster which is not below
+    it. Classifying a batch of placements is then a few array operations per
+    level.
+
+    Levels are ordered from the largest threshold to the smallest, as in
+    the lineages written by TaxonomyWriter.'''
+
+    def __init__(self, tree, thresholds, level_names, heights, node_clusters,
+                 up_distances, cluster_names, lineage_parts):
+        self.tree = tree
+        self.thresholds = thresholds
+        self.level_names = level_names
+        self.heights = heights
+        self.node_clusters = node_clusters
+        self.up_distances = up_distances
+        self.cluster_names = cluster_names
+        self.lineage_parts = lineage_parts
+
+    @staticmethod
+    def build(threshold_and_clusters, level_names='K P C O F G S'.split()):
+        '''Build an index from the result of
+        Tree2Tax#named_clusters_for_several_thresholds.
+
+        Parameters
+        ----------
+        threshold_and_clusters: list of ThresholdAndClusters
+            the reference clustering
+        level_names: list of str
+            prefix of each level of the lineage, from the largest threshold
+            to the smallest
+        '''
+        levels = sorted(threshold_and_clusters, reverse=True, key=lambda tc: tc.threshold)
+        writer = TaxonomyWriter(level_names)
+        taxonomy_index = levels[0].taxonomy_index
+        tree = taxonomy_index.tree
+        heights = Tree2Tax()._heights_and_merge_heights(tree)[0]
+        sibling_distances = _sibling_distances(tree, heights)
+        depth_levels = tree.depth_levels()
+
+        node_clusters = []
+        up_distances = []
+        cluster_names = []
+        lineage_parts = []
+        for i, tc in enumerate(levels):
+            cluster_lcas = np.array([c.lca_id for c in tc.clusters], dtype=np.int64)
+            node_cluster = _node_clusters(tree, cluster_lcas)
+            node_clusters.append(node_cluster)
+            up_distances.append(_up_distances(tree, sibling_distances, node_cluster, cluster_lcas, depth_levels))
+            cluster_names.append([c.name() for c in tc.clusters])
+
+            # clusters nest, so each is within the cluster containing its
+            # LCA at the level above
+            if i == 0:
+                parents = [None]*len(tc.clusters)
+            else:
+                parents = [levels[i-1].clusters[j] for j in node_clusters[i-1][cluster_lcas].tolist()]
+            lineage_parts.append([writer.lineage_part(taxonomy_index, i, cluster, parent)
+                                  for cluster, parent in zip(tc.clusters, parents)])
+
+        # placements are on the edges of the tree multifurcations were
+        # resolved from, each of which is an edge of the resolved tree
+        if tree.resolved_from is not None:
+            node_ids = tree.resolved_node_ids
+            tree = tree.resolved_from
+            heights = heights[node_ids]
+            node_clusters = [node_cluster[node_ids] for node_cluster in node_clusters]
+            up_distances = [up[node_ids] for up in up_distances]
+        return PlacementIndex(tree, [tc.threshold for tc in levels], level_names[:len(levels)], heights,
+                              node_clusters, up_distances, cluster_names, lineage_parts)
+
+    def classify(self, edges, distal_lengths, pendant_lengths):
+        '''Return an int array of placements x levels, giving the index of
+        the cluster each placement joins at each level, or -1 where it joins
+        none.
+
+        Parameters
+        ----------
+        edges: array of int
+            id of the node below the edge of each placement
+        distal_lengths: array of float
+            distance along the edge from the node below to the placement,
+            clipped to the length of the edge
+        pendant_lengths: array of float
+            length of the branch from the edge to the query
+        '''
+        edges = np.asarray(edges, dtype=np.int64)
+        edge_lengths = self.tree.length[edges]
+        distal_lengths = np.clip(np.asarray(distal_lengths, dtype=np.float64), 0, edge_lengths)
+        pendant_lengths = np.asarray(pendant_lengths, dtype=np.float64)
+        below = pendant_lengths + distal_lengths + self.heights[edges]
+        above_base = pendant_lengths + edge_lengths - distal_lengths
+
+        assignments = np.empty((len(edges), len(self.thresholds)), dtype=np.int32)
+        for level, threshold in enumerate(self.thresholds):
+            farthest = np.maximum(below, above_base + self.up_distances[level][edges])
+            clusters = self.node_clusters[level][edges]
+            assignments[:, level] = np.where(farthest <= threshold, clusters, -1)
+        return assignments
+
+    def lineages(self, assignments):
+        '''Return the lineage string of each row of assignments made by
+        classify, down to the last level at which it joined a cluster
+        (stopping at the first level it did not)'''
+        to_return = []
+        for row in assignments.tolist():
+            parts = []
+            for level, cluster in enumerate(row):
+                if cluster < 0: break
+                parts.append(self.lineage_parts[level][cluster])
+            to_return.append('; '.join(parts))
+        return to_return
+
+    def save(self, path):
+        '''Save the index to path, in numpy's npz format'''
+        arrays = tree_arrays(self.tree)
+        level_names = StringTable.from_strings(self.level_names)
+        arrays.update({'thresholds': np.array(self.thresholds, dtype=np.float64),
+                       'level_name_offsets': level_names.offsets, 'level_name_data': level_names.data,
+                       'heights': self.heights})
+        for level in range(len(self.thresholds)):
+            names = StringTable.from_strings(self.cluster_names[level])
+            parts = StringTable.from_strings(self.lineage_parts[level])
+            arrays.update({'node_clusters_%i' % level: self.node_clusters[level],
+                           'up_distances_%i' % level: self.up_distances[level],
+                           'cluster_name_offsets_%i' % level: names.offsets,
+                           'cluster_name_data_%i' % level: names.data,
+                           'lineage_part_offsets_%i' % level: parts.offsets,
+                           'lineage_part_data_%i' % level: parts.data})
+        with open(path, 'wb') as f:
+            np.savez(f, **arrays)
+
+    @staticmethod
+    def load(path):
+        '''Load an index saved with save'''
+        arrays = np.load(path)
+        thresholds = arrays['thresholds'].tolist()
+        levels = range(len(thresholds))
+        return PlacementIndex(
+            tree_from_arrays(arrays), thresholds,
+            list(StringTable(arrays['level_name_offsets'], arrays['level_name_data'])),
+            arrays['heights'],
+            [arrays['node_clusters_%i' % level] for level in levels],
+            [arrays['up_distances_%i' % level] for level in levels],
+            [list(StringTable(arrays['cluster_name_offsets_%i' % level], arrays['cluster_name_data_%i' % level]))
+             for level in levels],
+            [list(StringTable(arrays['lineage_part_offsets_%i' % level], arrays['lineage_part_data_%i' % level]))
+             for level in levels])
+
+
+def _node_clusters(tree, cluster_lcas):
+    '''Return an array giving the index of the cluster containing each node,
+    or -1 for nodes above the clusters'''
+    containing = np.searchsorted(cluster_lcas, np.arange(len(tree)), side='right') - 1
+    inside = (containing >= 0)
+    inside[inside] = tree.subtree_end[cluster_lcas[containing[inside]]] > np.flatnonzero(inside)
+    return np.where(inside, containing, -1).astype(np.int32)
+
+def _sibling_distances(tree, heights):
+    '''Return an array giving, for each node, the distance from its parent
+    to the farthest tip below any of its siblings, or -inf for nodes without
+    siblings. The largest and second largest distance via each child of a
+    node are found once, so that each of its children takes the largest of
+    those not via itself.'''
+    via_child = tree.length + heights
+    via_child[0] = -np.inf
+    best = np.empty(len(tree), dtype=np.float64)
+    best.fill(-np.inf)
+    np.maximum.at(best, tree.parent[1:], via_child[1:])
+    # one child giving the largest distance of each node, then the largest
+    # distance via any other child
+    best_child = np.empty(len(tree), dtype=np.int64)
+    best_child.fill(-1)
+    is_best = np.flatnonzero(via_child[1:] == best[tree.parent[1:]]) + 1
+    best_child[tree.parent[is_best]] = is_best
+    excluded = via_child.copy()
+    excluded[best_child[best_child >= 0]] = -np.inf
+    second = np.empty(len(tree), dtype=np.float64)
+    second.fill(-np.inf)
+    np.maximum.at(second, tree.parent[1:], excluded[1:])
+
+    parents = tree.parent.copy()
+    parents[0] = 0
+    distances = np.where(best_child[parents] == np.arange(len(tree)), second[parents], best[parents])
+    distances[0] = -np.inf
+    return distances
+
+def _up_distances(tree, sibling_distances, node_clusters, cluster_lcas, depth_levels):
+    '''Return an array giving, for each node within a cluster, the distance
+    from its parent to the farthest tip of the cluster not below it, and
+    -inf for cluster LCAs and nodes above the clusters. These are calculated
+    from the root down, taking the larger of the distance via the siblings
+    (as given by _sibling_distances) and via the parent.'''
+    is_lca = np.zeros(len(tree), dtype=bool)
+    is_lca[cluster_lcas] = True
+    up = np.empty(len(tree), dtype=np.float64)
+    up.fill(-np.inf)
+    for nodes in depth_levels[1:]:
+        nodes = nodes[(node_clusters[nodes] >= 0) & ~is_lca[nodes]]
+        if len(nodes) == 0: continue
+        parents = tree.parent[nodes]
+        via_parent = np.where(is_lca[parents], -np.inf, tree.length[parents] + up[parents])
+        up[nodes] = np.maximum(sibling_distances[nodes], via_parent)
+    return up
+
+
+class JplaceReader:
+    '''Reads the placements of a jplace file (as written by pplacer or
+    EPA), keeping the placement with the highest like_weight_ratio of each
+    query, and maps its edge numbers onto the node ids of the reference
+    tree.'''
+
+    EDGE_NUMBER_REGEX = re.compile(r'\{(\d+)\}')
+
+    def read(self, path, tree):
+        '''Return the query names, and arrays of the node id below the edge,
+        distal length and pendant length of their placements. Queries
+        given several names (with 'n' or 'nm') are reported once per
+        name.
+
+        Parameters
+        ----------
+        path: str
+            the jplace file
+        tree: CompactTree
+            the reference tree, which must have the same topology and order
+            of tips as the tree in the jplace file
+        '''
+        with open(path) as f:
+            jplace = json.load(f)
+        names, edges, distal_lengths, pendant_lengths = self.parse(jplace, tree)
+        if logging.getLogger().isEnabledFor(logging.INFO): logging.info("Read %i placed queries from %s" % (len(names), path))
+        return names, edges, distal_lengths, pendant_lengths
+
+    def parse(self, jplace, tree):
+        '''As read, but given the jplace file already decoded from JSON'''
+        edge_nodes = self.edge_nodes(jplace['tree'].encode('utf-8'), tree)
+
+        fields = jplace['fields']
+        try:
+            edge_column = fields.index('edge_num')
+            distal_column = fields.index('distal_length')
+            pendant_column = fields.index('pendant_length')
+        except ValueError:
+            raise PlacementException("jplace file does not give edge_num, distal_length and pendant_length of each placement")
+        weight_column = fields.index('like_weight_ratio') if 'like_weight_ratio' in fields else None
+
+        names = []
+        best_rows = []
+        for placement in jplace['placements']:
+            rows = placement['p']
+            if weight_column is None:
+                best = rows[0]
+            else:
+                best = max(rows, key=lambda row: row[weight_column])
+            if 'n' in placement:
+                query_names = placement['n']
+                if isinstance(query_names, basestring): query_names = [query_names]
+            else:
+                query_names = [name_and_mass[0] for name_and_mass in placement['nm']]
+            for name in query_names:
+                names.append(name.encode('utf-8'))
+                best_rows.append(best)
+
+        rows = np.array(best_rows, dtype=np.float64).reshape(len(best_rows), len(fields))
+        return (names,
+                edge_nodes[rows[:, edge_column].astype(np.int64)],
+                rows[:, distal_column],
+                rows[:, pendant_column])
+
+    def edge_nodes(self, jplace_tree, tree):
+        '''Return an array mapping each edge number of the newick tree string
+        of a jplace file to the id of the node below it in tree. Edge numbers
+        follow the branch length of each node, so they are in the postorder
+        of the nodes.'''
+        edge_numbers = np.array([int(n) for n in self.EDGE_NUMBER_REGEX.findall(jplace_tree)], dtype=np.int64)
+        placement_tree = NewickReader().read(StringIO(self.EDGE_NUMBER_REGEX.sub('', jplace_tree)))
+        # the root may or may not be given an edge number
+        if len(placement_tree) != len(tree) or len(edge_numbers) not in (len(tree)-1, len(tree)) or \
+                list(placement_tree.names[i] for i in placement_tree.name_id[placement_tree.tip_ids]) != \
+                list(tree.name(i) for i in tree.tip_ids):
+            raise PlacementException("The tree of the jplace file does not match the reference tree")
+        node_at_postorder = np.empty(len(tree), dtype=np.int64)
+        node_at_postorder[tree.postorder_index()] = np.arange(len(tree))
+        edge_nodes = np.empty(edge_numbers.max()+1, dtype=np.int64)
+        edge_nodes.fill(-1)
+        edge_nodes[edge_numbers] = node_at_postorder[:len(edge_numbers)]
+        return edge_nodes
@@ -0,0 +1,306 @@
+import logging
+import errno
+import json
+import os
+import stat
+import threading
+import urlparse
+from collections import OrderedDict
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn, UnixStreamServer
+
+from .tree2tax import Tree2Tax, TaxonomyIndex, ThresholdAndClusters
+from .threshold_finder import ThresholdFinder, ThresholdInconsistencyException
+from .taxonomy_writer import TaxonomyWriter
+from .placement import PlacementIndex, JplaceReader, PlacementException
+
+class TreeServiceException(Exception): pass
+
+class TreeService:
+    '''A tree parsed and indexed once, answering repeated requests to
+    cluster it, find thresholds, look up lineages and classify placements,
+    so that each request does not pay for parsing the tree and calculating
+    merge heights again.
+
+    The clusters of each threshold, and the lineages and placement index of
+    each set of thresholds, are kept for the most recently used cache_size
+    thresholds and threshold sets, so repeated requests reuse them. Requests
+    may come from several threads, and are answered one at a time.'''
+
+    DEFAULT_LEVEL_NAMES = 'K P C O F G S'.split()
+
+    def __init__(self, tree, threads=1, cache_size=16, binary_only=False):
+        '''
+        Parameters
+        ----------
+        tree: CompactTree
+            the annotated tree
+        threads: int
+            number of processes to calculate merge heights and find
+            thresholds with
+        cache_size: int
+            number of thresholds, and of threshold sets, to keep results for
+        binary_only: bool
+            do not resolve multifurcations before clustering, as in Tree2Tax
+        '''
+        self.tree = tree
+        self.threads = threads
+        self.cache_size = cache_size
+        self._tree2tax = Tree2Tax(binary_only)
+        # clusters are of the tree with multifurcations resolved, while
+        # placements and thresholds are found on the tree as given
+        self.resolved_tree, _, _, self.merge_heights = self._tree2tax._resolve_and_merge_heights(tree, threads=threads)
+        self.taxonomy_index = TaxonomyIndex(self.resolved_tree)
+        self._tip_keys = self._tree2tax._tie_break_tip_keys(self.resolved_tree)
+        self._lock = threading.RLock()
+        self._threshold_cache = OrderedDict()
+        self._threshold_set_cache = OrderedDict()
+        self._found_thresholds = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _cached(self, cache, key, calculate):
+        with self._lock:
+            try:
+                value = cache.pop(key)
+                self.hits += 1
+            except KeyError:
+                value = calculate()
+                self.misses += 1
+                if len(cache) >= self.cache_size: cache.popitem(last=False)
+            # most recently used last
+            cache[key] = value
+            return value
+
+    def threshold_and_clusters(self, threshold):
+        '''return the ThresholdAndClusters of the given threshold'''
+        threshold = float(threshold)
+        def calculate():
+            tree = self.resolved_tree
+            cluster_lcas = self._tree2tax.cluster_lcas(tree, self.merge_heights, threshold)
+            clusters = self._tree2tax._named_clusters_from_lcas(tree, cluster_lcas, self.taxonomy_index, self._tip_keys)
+            return ThresholdAndClusters(threshold, clusters, self.taxonomy_index)
+        return self._cached(self._threshold_cache, threshold, calculate)
+
+    def _threshold_set(self, thresholds, level_names):
+        if len(thresholds) == 0:
+            raise TreeServiceException("No thresholds were given")
+        if level_names is None: level_names = self.DEFAULT_LEVEL_NAMES
+        if len(thresholds) > len(level_names):
+            raise TreeServiceException("Only %i level names were given, but there are %i thresholds" % (
+                len(level_names), len(thresholds)))
+        return tuple(sorted([float(t) for t in thresholds])), tuple(level_names)
+
+    def _clustered(self, thresholds, level_names):
+        key = self._threshold_set(thresholds, level_names)
+        return self._cached(self._threshold_set_cache, key, lambda: _ClusteredThresholds(self, *key))
+
+    def lineages(self, thresholds, tips=None, level_names=None):
+        '''Return a dict of tip name to lineage at the given thresholds, as
+        written by TaxonomyWriter, for all tips or just the given tip names.
+        Raises KeyError for an unknown tip name.'''
+        with self._lock:
+            tip_lineages = self._clustered(thresholds, level_names).tip_lineages()
+        if tips is None:
+            return dict(tip_lineages)
+        else:
+            return dict([(tip, tip_lineages[tip]) for tip in tips])
+
+    def lineage(self, tip, thresholds, level_names=None):
+        '''return the lineage of a single tip, raising KeyError if there is
+        no tip with that name'''
+        with self._lock:
+            return self._clustered(thresholds, level_names).tip_lineages()[tip]
+
+    def classify(self, jplace, thresholds, level_names=None):
+        '''Return a dict of query name to lineage of the best placement of
+        each query of a jplace file, given decoded from JSON'''
+        with self._lock:
+            placement_index = self._clustered(thresholds, level_names).placement_index()
+        names, edges, distal_lengths, pendant_lengths = JplaceReader().parse(jplace, self.tree)
+        lineages = placement_index.lineages(placement_index.classify(edges, distal_lengths, pendant_lengths))
+        return dict(zip(names, lineages))
+
+    def find_thresholds(self, prefixes, sketch_size=None):
+        '''return thresholds separating the given rank prefixes, as found by
+        ThresholdFinder'''
+        key = (tuple(prefixes), sketch_size)
+        return self._cached(self._found_thresholds, key, lambda: ThresholdFinder().find_thresholds(
+            self.tree, list(prefixes), sketch_size=sketch_size, threads=self.threads))
+
+
+class _ClusteredThresholds:
+    '''The clusters of a set of thresholds, with the lineage of each tip and
+    the index for classifying placements made when first asked for'''
+    def __init__(self, service, thresholds, level_names):
+        self.level_names = list(level_names)
+        self.threshold_and_clusters = [service.threshold_and_clusters(t) for t in thresholds]
+        self._tip_lineages = None
+        self._placement_index = None
+
+    def tip_lineages(self):
+        if self._tip_lineages is None:
+            tip_lineages = {}
+            for tip_names, lineage in TaxonomyWriter(self.level_names).each_lineage(self.threshold_and_clusters):
+                for name in tip_names: tip_lineages[name] = lineage
+            self._tip_lineages = tip_lineages
+        return self._tip_lineages
+
+    def placement_index(self):
+        if self._placement_index is None:
+            self._placement_index = PlacementIndex.build(self.threshold_and_clusters, self.level_names)
+        return self._placement_index
+
+
+class TreeServiceRequestHandler(BaseHTTPRequestHandler):
+    '''Answers JSON requests to a TreeService. Each is a POST of a JSON
+    object to one of
+
+    /cluster {"thresholds": [...], "tips": [...] (optional), "level_names": [...] (optional)}
+        -> {"lineages": {tip: lineage}}
+    /lineage {"tip": name, "thresholds": [...], "level_names": [...] (optional)}
+        -> {"tip": name, "lineage": lineage}
+    /classify {"jplace": {...}, "thresholds": [...], "level_names": [...] (optional)}
+        -> {"lineages": {query: lineage}}
+    /find_thresholds {"prefixes": [...], "sketch_size": n (optional)}
+        -> {"thresholds": [...]}
+
+    and GET /info gives the size of the tree and the cache statistics.
+    Failed requests are answered with {"error": message}, with status 400
+    for invalid requests and 500 for unexpected errors.'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path = urlparse.urlparse(self.path).path
+        if path == '/info':
+            service = self.server.service
+            self._respond(200, {'nodes': len(service.tree),
+                                'tips': service.tree.num_tips(),
+                                'cache_hits': service.hits,
+                                'cache_misses': service.misses})
+        else:
+            self._respond(404, {'error': "Unknown path %s" % path})
+
+    def do_POST(self):
+        path = urlparse.urlparse(self.path).path
+        # the body is always read, so that the connection can be reused
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        handler = {'/cluster': self._cluster,
+                   '/lineage': self._lineage,
+                   '/classify': self._classify,
+                   '/find_thresholds': self._find_thresholds}.get(path)
+        if handler is None:
+            self._respond(404, {'error': "Unknown path %s" % path})
+            return
+        try:
+            request = json.loads(body)
+            if not isinstance(request, dict):
+                raise ValueError("Expected a JSON object")
+            response = handler(request)
+        except KeyError as e:
+            self._respond(400, {'error': "Not found: %s" % e.args[0]})
+        except (ValueError, TypeError, TreeServiceException, PlacementException, ThresholdInconsistencyException) as e:
+            self._respond(400, {'error': str(e)})
+        except Exception as e:
+            logging.exception("Failed to answer request to %s" % path)
+            self._respond(500, {'error': str(e)})
+        else:
+            self._respond(200, response)
+
+    def _thresholds(self, request):
+        if 'thresholds' not in request:
+            raise TreeServiceException("No thresholds were given")
+        thresholds = request['thresholds']
+        if not isinstance(thresholds, list):
+            raise ValueError("Expected a list of thresholds")
+        return [float(t) for t in thresholds]
+
+    def _string(self, value):
+        if not isinstance(value, basestring):
+            raise ValueError("Expected a string, not %s" % json.dumps(value))
+        return value.encode('utf-8')
+
+    def _strings(self, values):
+        if values is None: return None
+        if not isinstance(values, list):
+            raise ValueError("Expected a list of strings, not %s" % json.dumps(values))
+        return [self._string(v) for v in values]
+
+    def _cluster(self, request):
+        return {'lineages': self.server.service.lineages(
+            self._thresholds(request), self._strings(request.get('tips')), self._strings(request.get('level_names')))}
+
+    def _lineage(self, request):
+        tip = self._string(request['tip'])
+        return {'tip': tip, 'lineage': self.server.service.lineage(
+            tip, self._thresholds(request), self._strings(request.get('level_names')))}
+
+    def _classify(self, request):
+        if not isinstance(request['jplace'], dict):
+            raise ValueError("Expected the jplace to be a JSON object")
+        return {'lineages': self.server.service.classify(
+            request['jplace'], self._thresholds(request), self._strings(request.get('level_names')))}
+
+    def _find_thresholds(self, request):
+        prefixes = request['prefixes']
+        if isinstance(prefixes, basestring): prefixes = prefixes.split()
+        sketch_size = request.get('sketch_size')
+        if sketch_size is not None and (not isinstance(sketch_size, int) or isinstance(sketch_size, bool)):
+            raise ValueError("Expected sketch_size to be an integer")
+        return {'thresholds': self.server.service.find_thresholds(self._strings(prefixes), sketch_size)}
+
+    def _respond(self, status, response):
+        body = json.dumps(response)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # clients of a Unix socket have no address
+        return str(self.client_address[0]) if self.client_address else 'unix socket'
+
+    def log_message(self, format, *args):
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("%s %s" % (self.address_string(), format % args))
+
+
+class TreeServiceHTTPServer(ThreadingMixIn, HTTPServer):
+    '''Serves a TreeService over HTTP, a thread per connection'''
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        HTTPServer.__init__(self, address, TreeServiceRequestHandler)
+        self.service = service
+
+
+class TreeServiceUnixServer(ThreadingMixIn, UnixStreamServer):
+    '''Serves a TreeService over HTTP on a Unix socket, a thread per
+    connection. A socket left at the path (e.g. by a server that was
+    killed) is removed first, but any other file there raises
+    TreeServiceException rather than being removed.'''
+    daemon_threads = True
+
+    def __init__(self, path, service):
+        _remove_socket(path)
+        UnixStreamServer.__init__(self, path, TreeServiceRequestHandler)
+        self.service = service
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        _remove_socket(self.server_address)
+
+
+def _remove_socket(path):
+    '''remove the socket at path if there is one, raising
+    TreeServiceException if something other than a socket is there'''
+    try:
+        mode = os.stat(path).st_mode
+    except OSError as e:
+        if e.errno == errno.ENOENT: return
+        raise
+    if not stat.S_ISSOCK(mode):
+        raise TreeServiceException("Not removing %s, which is not a socket" % path)
+    os.remove(path)
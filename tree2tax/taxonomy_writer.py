@@ -0,0 +1,108 @@
+import numpy as np
+
+class TaxonomyWriter:
+    '''Writes the tree2tax taxonomy of every tip, one tab separated line per
+    tip giving its name and lineage e.g.
+
+    tip1    K__kBacteria; P__pFirmicutes; C__cBacilli.1 ...
+
+    Clusters at smaller thresholds nest inside those of larger ones, so the
+    chain of clusters a tip belongs to, and hence its lineage, is
+    determined by its cluster at the smallest threshold. Each lineage is
+    therefore worked out once per smallest-threshold cluster and reused for
+    all its tips, and output is written in large blocks.'''
+
+    def __init__(self, level_names='K P C O F G S'.split(), buffer_size=1<<20):
+        '''
+        Parameters
+        ----------
+        level_names: list of str
+            prefix of each level of the lineage, from the largest threshold
+            to the smallest
+        buffer_size: int
+            approximate number of bytes to accumulate before each write
+        '''
+        self.level_names = level_names
+        self.buffer_size = buffer_size
+
+    def write(self, threshold_and_clusters, output):
+        '''Write the taxonomy of each tip to output, a path or open file.
+
+        Parameters
+        ----------
+        threshold_and_clusters: list of ThresholdAndClusters
+            as returned by Tree2Tax.named_clusters_for_several_thresholds
+        output: str or file
+            where to write the taxonomy
+        '''
+        if hasattr(output, 'write'):
+            self._write(threshold_and_clusters, output)
+        else:
+            with open(output, 'w') as f:
+                self._write(threshold_and_clusters, f)
+
+    def _write(self, threshold_and_clusters, f):
+        buf = []
+        buffered = 0
+        for tip_names, lineage in self.each_lineage(threshold_and_clusters):
+            suffix = "\t%s\n" % lineage
+            block = suffix.join(tip_names) + suffix
+            buf.append(block)
+            buffered += len(block)
+            if buffered >= self.buffer_size:
+                f.write(''.join(buf))
+                buf = []
+                buffered = 0
+        f.write(''.join(buf))
+
+    def each_lineage(self, threshold_and_clusters):
+        '''Iterate over the clusters of the smallest threshold from left to
+        right, yielding a list of the names of the tips in each, and their
+        lineage string.'''
+        levels = sorted(threshold_and_clusters, reverse=True, key=lambda tc: tc.threshold)
+        if len(levels) > len(self.level_names):
+            raise ValueError("Only %i level names were given, but there are %i thresholds" % (
+                len(self.level_names), len(levels)))
+        index = levels[0].taxonomy_index
+        tree = index.tree
+
+        # for each level, the index of the cluster containing each tip
+        tip_to_cluster_index = []
+        for tc in levels:
+            sizes = [c.num_tips() for c in tc.clusters]
+            tip_to_cluster_index.append(np.repeat(np.arange(len(sizes)), sizes))
+
+        finest = levels[-1]
+        tip_start = 0
+        for finest_cluster in finest.clusters:
+            parts = []
+            last_cluster = None
+            for i, tc in enumerate(levels):
+                cluster = tc.clusters[tip_to_cluster_index[i][tip_start]]
+                parts.append(self.lineage_part(index, i, cluster, last_cluster))
+                last_cluster = cluster
+
+            num_tips = finest_cluster.num_tips()
+            tip_ids = tree.tip_ids[tip_start:tip_start+num_tips]
+            yield [tree.name(t) for t in tip_ids], '; '.join(parts)
+            tip_start += num_tips
+
+    def lineage_part(self, index, level, cluster, last_cluster):
+        '''Return the part of a lineage for the given level e.g.
+        'C__cBacilli.1', given the TaxonomyIndex of the clustered tree, the
+        NamedCluster at that level and the cluster containing it at the level
+        above (None for the first level)'''
+        part = [self.level_names[level], '__']
+
+        if level != 0:
+            # Work out if there is any missing taxonomic info between this node and the last one
+            missings = index.missing_taxonomy(cluster.lca_id, last_cluster.lca_id)
+            # don't count the node that is already recorded in the other
+            # part of the taxonomy, if that is recorded
+            if index.taxonomy(cluster.lca_id) and len(missings) > 0:
+                part.append('%s..' % '.'.join(missings))
+            elif len(missings) > 1:
+                part.append('%s..' % '.'.join(missings[:-1]))
+
+        part.append(cluster.condensed_name())
+        return ''.join(part)
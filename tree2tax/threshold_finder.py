@@ -1,6 +1,13 @@
 import re
 import logging
-from sets import Set
+import multiprocessing
+from itertools import izip
+
+import numpy as np
+
+from .compact_tree import CompactTree, LCAIndex
+from .tree2tax import RankTable
+from .distance_statistics import DistanceStatistics
 
 
 
@@ -21,23 +28,28 @@ class CladeDistance:
         self.daughter_node2 = daughter_node2
         self.distance = distance
         
-class Stack:
-    def __init__(self):
-        self.__storage = []
-
-    def isEmpty(self):
-        return len(self.__storage) == 0
+class ThresholdInconsistencyException(Exception): pass
 
-    def push(self,p):
-        self.__storage.append(p)
+# The LCAIndex and list of upper clades shared with worker processes. They
+# are set before the pool is created, so forked workers inherit them without
+# them being copied or pickled.
+_shared_lca_index = None
+_shared_clades = None
 
-    def pop(self):
-        return self.__storage.pop()
-    
-class ThresholdInconsistencyException(Exception): pass
+def _clade_distances(blocks):
+    '''Return a list of the distances of each of the given blocks, each a
+    (clade index, row, end row) of the shared upper clades as given by
+    ThresholdFinder._each_upper_clade, using the shared LCAIndex'''
+    finder = ThresholdFinder()
+    to_return = []
+    for clade, row, end_row in blocks:
+        _, lower_nodes, lower_max_distances = _shared_clades[clade]
+        _, _, distances = finder._block_distances(_shared_lca_index, lower_nodes, lower_max_distances, row, end_row)
+        to_return.append(distances)
+    return to_return
 
 class ThresholdFinder:
-    def find_thresholds(self, annotated_tree, prefixes):
+    def find_thresholds(self, annotated_tree, prefixes, sketch_size=None, threads=1):
         '''Find tree distance thresholds that separate taxonomic ranks. Start
         by finding a list of examples of e.g. the distances between two genera
         in a family, and then return half-way between the medians of each 
@@ -45,30 +57,119 @@ class ThresholdFinder:
         
         Parameters
         ----------
-        annotated_tree: TreeNode
+        annotated_tree: TreeNode or CompactTree
             An tree with taxonomic annotation decorated on it, in the node
             names.
         prefixes: list of single characters strings
             A list of prefixes representing each taxonomic rank e.g.
             string.split('k p c o f g s')
+        sketch_size: int or None
+            if not None, estimate each median from a random sample of this
+            many distances, rather than keeping them all
+        threads: int
+            number of processes to calculate distances with
         '''
-        median_distances = []
-        for i, level_prefix in enumerate(prefixes):
-            if i==0: continue
-            examples = self.find_examples(annotated_tree, prefixes[i-1], level_prefix)
-            if len(examples) > 0:
-                median_distances.append(self._median([e.distance for e in examples]))
-                logging.info("Found distances for %i pairs for level prefix %s" % (len(examples), level_prefix))
+        statistics = self.rank_distance_statistics(annotated_tree, prefixes, sketch_size=sketch_size, threads=threads)
+        return self.thresholds_from_statistics(statistics)
+    
+    def thresholds_from_statistics(self, statistics):
+        '''Return thresholds half-way between the medians of a list of
+        DistanceStatistics, as returned by rank_distance_statistics'''
+        return self._find_thresholds_from_example_distances([s.median() for s in statistics])
+    
+    def rank_distance_statistics(self, annotated_tree, prefixes, sketch_size=None, bin_width=0.01, threads=1):
+        '''Return a list of DistanceStatistics, one for each prefix after the
+        first, of the distances between pairs of clades of that rank which
+        are sisters in the rank above. The distances are streamed into the
+        statistics a block at a time, without creating a CladeDistance
+        for each pair.
+        
+        With more than one thread, the upper rank clades of all levels are
+        split into tasks for a pool of worker processes, which share the
+        read-only tree indices with this process by being forked from it.
+        Results are added to the statistics in the same order as when run
+        serially, so are identical.
+        
+        Parameters
+        ----------
+        annotated_tree: TreeNode or CompactTree
+            as for find_thresholds
+        prefixes: list of single characters strings
+            as for find_thresholds
+        sketch_size: int or None
+            as for DistanceStatistics
+        bin_width: float
+            initial width of the histogram bins of the DistanceStatistics
+        threads: int
+            number of processes to calculate distances with
+        '''
+        compact, lca_index, rank_table = self._indexed_tree(annotated_tree)
+        statistics = [DistanceStatistics(sketch_size=sketch_size, bin_width=bin_width) for _ in prefixes[1:]]
+        
+        if threads > 1:
+            self._parallel_rank_distances(compact, lca_index, rank_table, prefixes, statistics, threads)
+        else:
+            for i, level_prefix in enumerate(prefixes[1:]):
+                for _, _, _, _, distances in self._each_distance_block(compact, lca_index, rank_table, prefixes[i], level_prefix):
+                    statistics[i].add(distances)
+                    
+        for level_prefix, s in zip(prefixes[1:], statistics):
+            if s.count > 0:
+                logging.info("Found distances for %i pairs for level prefix %s" % (s.count, level_prefix))
             else:
-                median_distances.append(None)
                 logging.warn("No pairs were found for level prefix %s" % level_prefix)
-        return self._find_thresholds_from_example_distances(median_distances)
-            
-    def _median(self, lst):
-        '''Return median of a list of floats'''
-        even = (0 if len(lst) % 2 else 1) + 1
-        half = (len(lst) - 1) / 2
-        return sum(sorted(lst)[half:half + even]) / float(even)
+        return statistics
+    
+    def _parallel_rank_distances(self, compact, lca_index, rank_table, prefixes, statistics, threads, max_pairs=1<<20):
+        clades, task_levels, tasks = self._parallel_tasks(compact, rank_table, prefixes, max_pairs)
+        logging.info("Calculating distances in %i tasks using %i processes" % (len(tasks), threads))
+        
+        global _shared_lca_index, _shared_clades
+        _shared_lca_index = lca_index
+        _shared_clades = clades
+        pool = multiprocessing.Pool(threads)
+        try:
+            # imap returns results in task order, and each block is added
+            # separately, in the same order as a serial run
+            for level, block_distances in izip(task_levels, pool.imap(_clade_distances, tasks)):
+                for distances in block_distances:
+                    statistics[level].add(distances)
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+            pool.join()
+        finally:
+            _shared_lca_index = None
+            _shared_clades = None
+    
+    def _parallel_tasks(self, compact, rank_table, prefixes, max_pairs=1<<20):
+        '''Return the list of upper clades of every level, as given by
+        _each_upper_clade, and the level and blocks of each task for
+        _clade_distances. Small clades are gathered and large ones split so
+        that each task has at most max_pairs pairs, as _clade_distance_blocks
+        splits them, unless a single row of a clade has more.'''
+        clades = []
+        task_levels = []
+        tasks = []
+        for i, level_prefix in enumerate(prefixes[1:]):
+            blocks = []
+            task_pairs = 0
+            for clade in self._each_upper_clade(compact, rank_table, prefixes[i], level_prefix):
+                clades.append(clade)
+                for row, end_row, pairs in self._block_rows(len(clade[1]), max_pairs):
+                    if blocks and task_pairs + pairs > max_pairs:
+                        task_levels.append(i)
+                        tasks.append(blocks)
+                        blocks = []
+                        task_pairs = 0
+                    blocks.append((len(clades)-1, row, end_row))
+                    task_pairs += pairs
+            if blocks:
+                task_levels.append(i)
+                tasks.append(blocks)
+        return clades, task_levels, tasks
     
     def _find_thresholds_from_example_distances(self, example_distances):
         '''Given a list of floats or Nones, return a list which is halfway
@@ -122,112 +223,148 @@ class ThresholdFinder:
         
         
     
+    def _indexed_tree(self, tree):
+        if isinstance(tree, CompactTree):
+            compact = tree
+        else:
+            compact = CompactTree.from_tree_node(tree)
+        return compact, LCAIndex(compact), RankTable(compact)
+    
     def find_examples(self, tree, upper_prefix, lower_prefix):
         '''return a CladeDistanceSet of pairs of clades from the lower_prefix
         rank that are sisters in the upper_prefix rank'''
+        compact, lca_index, rank_table = self._indexed_tree(tree)
+        return self._find_examples(compact, lca_index, rank_table, upper_prefix, lower_prefix)
+        
+    def _find_examples(self, compact, lca_index, rank_table, upper_prefix, lower_prefix):
         to_return = []
+        for unode, lower_nodes, i, j, distances in self._each_distance_block(
+                compact, lca_index, rank_table, upper_prefix, lower_prefix):
+            unode_node = compact.node(unode)
+            nodes = [compact.node(n) for n in lower_nodes]
+            for first, second, distance in zip(i, j, distances):
+                to_return.append(CladeDistance(unode_node, nodes[first], nodes[second], float(distance)))
+        return to_return
+    
+    def _each_distance_block(self, compact, lca_index, rank_table, upper_prefix, lower_prefix, max_pairs=1<<20):
+        '''Iterate over the pairs of lower_prefix clades within each
+        upper_prefix clade, yielding (upper node id, array of lower node ids,
+        i, j, distances) where i and j are arrays of indices into the lower
+        node ids giving each pair, and distances their distance apart. Large
+        upper clades are yielded in several blocks of at most about
+        max_pairs pairs, so memory use does not grow with the number of
+        pairs.'''
+        for unode, lower_nodes, lower_max_distances in self._each_upper_clade(
+                compact, rank_table, upper_prefix, lower_prefix):
+            for i, j, distances in self._clade_distance_blocks(
+                    lca_index, lower_nodes, lower_max_distances, max_pairs):
+                yield unode, lower_nodes, i, j, distances
+                
+    def _each_upper_clade(self, compact, rank_table, upper_prefix, lower_prefix):
+        '''Iterate over the upper_prefix clades containing more than one
+        lower_prefix clade, yielding (upper node id, array of lower node ids,
+        array of max distances from each lower node to its tips)'''
+        # nodes are considered in postorder, as TreeNode.non_tips iterates
+        postorder = np.argsort(compact.postorder_index())
         
-        # get a list of nodes that are at the upper threshold, by
-        # descending the tree
-        upper_prefix_regex = re.compile(r'(\d+:){0,1}.*(; ){0,1}%s__' % upper_prefix)
-        upper_nodes = []
-        for node in tree.non_tips():
-            if node.name: 
-                if upper_prefix_regex.match(node.name):
-                    upper_nodes.append(node)
-                else:
-                    pass
-                    #logging.debug("Node name does not match expected type: %s" % node.name)
+        # get a list of nodes that are annotated with the upper rank,
+        # excluding the root
+        is_upper = rank_table.has_rank(upper_prefix)
+        is_upper[0] = False
+        upper_nodes = postorder[is_upper[postorder]]
         logging.debug("Found %s upper nodes" % len(upper_nodes))
         
         # For each of these upper class prefixes    
         # find all the lower level nodes
-        lower_prefix_regex = re.compile(r'(\d+:){0,1}.*(; ){0,1}%s__' % lower_prefix)    
+        is_lower = rank_table.has_rank(lower_prefix)
+        # for each of the lower level nodes, find the maximal distance to the tips
+        # special cases - if one of the lower nodes is the LCA,
+        # then the max distance of that LCA cannot be derived from a 
+        # tip in the other
+        max_distances = self._unique_best_distances(compact, is_lower)
+        lower_postorder = postorder[is_lower[postorder]]
+        # position of each node's subtree within the postorder
+        postorder_index = compact.postorder_index()
+        lower_postorder_index = postorder_index[lower_postorder]
         for unode in upper_nodes:
-            lower_nodes = []
-            for node in unode.non_tips(True):
-                if node.name and lower_prefix_regex.match(node.name):
-                    lower_nodes.append(node)
-            logging.debug("Lower nodes: %s" % lower_nodes)
+            # the subtree of a node ends with it in postorder
+            first = np.searchsorted(lower_postorder_index,
+                postorder_index[unode] - (compact.subtree_end[unode] - unode) + 1)
+            last = np.searchsorted(lower_postorder_index, postorder_index[unode], side='right')
+            lower_nodes = lower_postorder[first:last]
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug("Lower nodes: %s" % [compact.name(n) for n in lower_nodes])
                 
             # if there is only 1, go to next upper because there are no pairs
             if len(lower_nodes) <= 1: continue
-        
-            # for each of the lower level nodes, find the maximal distance to the tips
-            # special cases - if one of the lower nodes is the LCA,
-            # then the max distance of that LCA cannot be derived from a 
-            # tip in the other
-            lower_max_distances = self.unique_best_distance(lower_nodes)
-                                   
-            # make/add to a list of all the pairwise distances,
-            for i, first in enumerate(lower_nodes):
-                for j, second in enumerate(lower_nodes):
-                    if i <= j: continue #upper right triangle of distance matrices only
-                    
-                    # by taking each pair of lower nodes, 
-                    # distance is distance of node1 to lca + distance of node2 to lca
-                    # + max distance underneath of each node
-                    
-                    # there is currently (v 0.2.2) a bug in scikit-bio's implementation
-                    # of distance - so workaround here
-                    # https://github.com/biocore/scikit-bio/issues/807
-                    lca = self.my_lca(tree, first, second)
-                    distance = first.accumulate_to_ancestor(lca) + \
-                        second.accumulate_to_ancestor(lca) + \
-                        lower_max_distances[i] + \
-                        lower_max_distances[j]
-                        
-                    to_return.append(CladeDistance(unode, first, second, distance))
-        
-        # return the list of distances
-        return to_return
-    
-    def unique_best_distance(self, nodes):
-        '''given a set of nodes, return an array of max distances to tips
-        that are descendants of each node. However, the 'max tip' cannot be a
-        descendant of any other node. Assumes no tips are counted as a clade'''
-        to_return = []
-        
-        annotated_nodes = Set(nodes)
             
-        for node in nodes:
-            # Make a set for fast membership querying
-
-            stack = Stack()
-            max_distance = 0.0
+            yield unode, lower_nodes, max_distances[lower_nodes]
             
-            # initialise stack with first descendents
-            for d in node.children:
-                stack.push(d) 
-                
-            while True:
-                try:
-                    d = stack.pop()
-                except IndexError:
-                    break #stack empty, we are done
-                
-                if d not in annotated_nodes: # don't descend when we run into a different clade
-                    if d.is_tip():
-                        distance = d.accumulate_to_ancestor(node)
-                        if distance > max_distance: 
-                            max_distance = distance
-                    else:
-                        [stack.push(desc) for desc in d.children]
-
-                
-            to_return.append(max_distance)
-        return to_return
+    def _clade_distance_blocks(self, lca_index, lower_nodes, lower_max_distances, max_pairs=1<<20):
+        '''Iterate over blocks of pairs of the given lower nodes, yielding
+        (i, j, distances) as described in _each_distance_block'''
+        for row, end_row, _ in self._block_rows(len(lower_nodes), max_pairs):
+            yield self._block_distances(lca_index, lower_nodes, lower_max_distances, row, end_row)
     
-    def my_lca(self, tree, first, second):
-        '''v0.2.2 of skbio is buggy, here's a quick fix'''
-        first_ancestors = Set([first] + first.ancestors())
-        curr = second
-        while curr:
-            if curr in first_ancestors:
-                return curr
-            else:
-                curr = curr.parent
-                
-        raise Exception("No common ancestors found, whack - are they from the same tree?") 
+    def _block_rows(self, num_lower_nodes, max_pairs):
+        '''Iterate over the blocks of pairs of num_lower_nodes lower nodes,
+        yielding (row, end row, number of pairs). Pairs are taken from the
+        lower left triangle of the distance matrix, as many rows at a time
+        as fit in a block.'''
+        row = 1
+        while row < num_lower_nodes:
+            # row r has r pairs
+            end_row = row + 1
+            pairs = row
+            while end_row < num_lower_nodes and pairs + end_row <= max_pairs:
+                pairs += end_row
+                end_row += 1
+            yield row, end_row, pairs
+            row = end_row
+    
+    def _block_distances(self, lca_index, lower_nodes, lower_max_distances, row, end_row):
+        '''Return (i, j, distances) for the pairs of the given rows'''
+        # By taking each pair of lower nodes, distance is distance of node1
+        # to lca + distance of node2 to lca + max distance underneath of
+        # each node
+        rows = np.arange(row, end_row)
+        i = np.repeat(rows, rows)
+        j = np.arange(len(i)) - np.repeat(np.cumsum(rows) - rows, rows)
+        distances = lca_index.distance(lower_nodes[i], lower_nodes[j]) + \
+            lower_max_distances[i] + lower_max_distances[j]
+        return i, j, distances
     
+    def unique_best_distance(self, nodes):
+        '''given a set of nodes, return a list of max distances to tips
+        that are descendants of each node. However, the 'max tip' cannot be a
+        descendant of any other node. Assumes no tips are counted as a clade.
+        
+        The nodes are TreeNodes of the same tree, and are looked up in a
+        CompactTree of it, as for _unique_best_distances.'''
+        nodes = list(nodes)
+        if len(nodes) == 0: return []
+        root = nodes[0].root()
+        compact = CompactTree.from_tree_node(root)
+        # CompactTree ids are in preorder
+        node_to_index = dict([(id(node), i) for i, node in enumerate(root.preorder(include_self=True))])
+        node_ids = np.array([node_to_index[id(node)] for node in nodes], dtype=np.int64)
+        annotated = np.zeros(len(compact), dtype=bool)
+        annotated[node_ids] = True
+        return self._unique_best_distances(compact, annotated)[node_ids].tolist()
     
+    def _unique_best_distances(self, compact, annotated):
+        '''given a CompactTree and a boolean array marking annotated nodes,
+        return an array giving for each annotated node the max distance to
+        tips that are descendants of it. However, the 'max tip' cannot be a
+        descendant of any other annotated node. Assumes no tips are counted
+        as a clade.
+        
+        Calculated in one pass up the tree, a depth at a time, keeping the
+        max distance of each node to the tips below it that are not
+        separated from it by an annotated node.'''
+        below = np.where(compact.is_tip, 0.0, -np.inf)
+        for nodes in reversed(compact.depth_levels()[1:]):
+            # don't ascend out of a different clade
+            reach = np.where(annotated[nodes], -np.inf, below[nodes] + compact.length[nodes])
+            np.maximum.at(below, compact.parent[nodes], reach)
+        return np.where(annotated, np.maximum(below, 0.0), 0.0)
@@ -0,0 +1,113 @@
+import numpy as np
+
+from .tree2tax import Tree2Tax, RankTable
+
+class ThresholdSweep:
+    '''Summarises the clustering of a tree at any number of thresholds at
+    once, for choosing thresholds.
+
+    Merge heights never decrease going up the tree, so each node is the LCA
+    of a cluster for exactly the thresholds from its own merge height up to
+    (but not including) that of its parent. The number of clusters at a
+    threshold is then the number of these intervals containing it, which
+    for many thresholds is counted by binary search over the sorted interval
+    ends, rather than by clustering at each. Likewise each annotated taxon
+    is recovered as a cluster within its interval, split into several
+    clusters below it, and lumped into a larger cluster above it.'''
+
+    def __init__(self, compact, merge_heights=None, rank_table=None, threads=1, binary_only=False):
+        '''
+        Parameters
+        ----------
+        compact: CompactTree
+            the tree to sweep
+        merge_heights: numpy array or None
+            as calculated by Tree2Tax#merge_heights, of a tree without
+            multifurcations or resolved by Tree2Tax#resolve_multifurcations.
+            Otherwise the tree is resolved and they are calculated with the
+            given number of threads, so that the tree swept is the resolved one
+        rank_table: RankTable or None
+            taxonomy of the tree, otherwise it is parsed from the node names
+        binary_only: bool
+            when calculating merge heights, do not resolve multifurcations,
+            as in Tree2Tax
+        '''
+        if merge_heights is None:
+            resolved, _, _, merge_heights = Tree2Tax(binary_only)._resolve_and_merge_heights(compact, threads=threads)
+            if resolved is not compact:
+                # the names are unchanged, so need not be parsed again
+                if rank_table is not None: rank_table = RankTable(resolved, rank_table)
+                compact = resolved
+        self.tree = compact
+        self.merge_heights = merge_heights
+        self.rank_table = rank_table
+        # the root never has a parent to collapse into
+        self.parent_merge_heights = np.empty(len(compact), dtype=np.float64)
+        self.parent_merge_heights[0] = np.inf
+        self.parent_merge_heights[1:] = merge_heights[compact.parent[1:]]
+        self._sorted_merge_heights = np.sort(merge_heights)
+        self._sorted_parent_merge_heights = np.sort(self.parent_merge_heights)
+
+    def breakpoints(self, minimum=-np.inf, maximum=np.inf):
+        '''return the sorted distinct thresholds within the given range at
+        which the clustering changes, i.e. the finite merge heights.
+        Clustering at any threshold gives the same clusters as at the
+        largest breakpoint at or below it.'''
+        heights = self._sorted_merge_heights
+        heights = heights[np.isfinite(heights) & (heights >= minimum) & (heights <= maximum)]
+        return np.unique(heights)
+
+    def num_clusters(self, thresholds):
+        '''return an array of the number of clusters at each threshold'''
+        return self._count_intervals(self._sorted_merge_heights, self._sorted_parent_merge_heights, thresholds)
+
+    def num_singletons(self, thresholds):
+        '''return an array of the number of clusters of a single tip at each
+        threshold'''
+        tip_parent_heights = np.sort(self.parent_merge_heights[self.tree.tip_ids])
+        thresholds = np.asarray(thresholds, dtype=np.float64)
+        return len(tip_parent_heights) - np.searchsorted(tip_parent_heights, thresholds, side='right')
+
+    def rank_agreement(self, rank, thresholds):
+        '''Return the number of nodes annotated with the given rank prefix,
+        and arrays of the number of them whose tips at each threshold are
+        exactly one cluster (recovered), are divided between several
+        clusters (split), or are part of a larger cluster (lumped). Each
+        annotated node is counted separately, even if several have the same
+        taxon name.'''
+        if self.rank_table is None: self.rank_table = RankTable(self.tree)
+        nodes = self.rank_table.nodes_with_rank(rank)
+        thresholds = np.asarray(thresholds, dtype=np.float64)
+        merge_heights = np.sort(self.merge_heights[nodes])
+        parent_merge_heights = np.sort(self.parent_merge_heights[nodes])
+        collapsed = np.searchsorted(merge_heights, thresholds, side='right')
+        lumped = np.searchsorted(parent_merge_heights, thresholds, side='right')
+        return len(nodes), collapsed - lumped, len(nodes) - collapsed, lumped
+
+    def _count_intervals(self, sorted_starts, sorted_ends, thresholds):
+        thresholds = np.asarray(thresholds, dtype=np.float64)
+        return np.searchsorted(sorted_starts, thresholds, side='right') - \
+            np.searchsorted(sorted_ends, thresholds, side='right')
+
+    def write(self, thresholds, ranks, f):
+        '''Write a tab separated table to the open file f, of the number of
+        clusters and singletons at each threshold, and the fraction of the
+        nodes annotated with each of the given rank prefixes that are
+        recovered, split and lumped'''
+        thresholds = np.asarray(thresholds, dtype=np.float64)
+        header = ['threshold', 'clusters', 'singletons']
+        columns = [thresholds, self.num_clusters(thresholds), self.num_singletons(thresholds)]
+        for rank in ranks:
+            num_taxa, recovered, split, lumped = self.rank_agreement(rank, thresholds)
+            header.extend(["%s_%s" % (rank, kind) for kind in ['recovered', 'split', 'lumped']])
+            denominator = float(max(num_taxa, 1))
+            columns.extend([recovered / denominator, split / denominator, lumped / denominator])
+        f.write("\t".join(header) + "\n")
+        formats = ['%r', '%i', '%i'] + ['%.4f']*(len(columns)-3)
+        line_format = "\t".join(formats) + "\n"
+        # write in blocks, so that sweeps over millions of breakpoints are
+        # not slowed by a write per line
+        block_size = 10000
+        rows = zip(*[c.tolist() for c in columns])
+        for start in range(0, len(rows), block_size):
+            f.write(''.join([line_format % row for row in rows[start:start+block_size]]))
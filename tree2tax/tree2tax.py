@@ -1,8 +1,28 @@
 from skbio.tree import TreeNode
 from sets import Set
 import logging
+import heapq
 import re
 import IPython
+import multiprocessing
+import numpy as np
+
+from .compact_tree import CompactTree
+from .metrics import Metrics
+from .clustering_state import ClusteringState, ClusterChange
+
+# Taxonomy prefixes e.g. 'f__', a bootstrap-only node name e.g. '0.97' (any
+# string float() accepts), and a bootstrap followed by taxonomy e.g.
+# '0.97:f__Fam', compiled once rather than on each call
+_RANK_PREFIX_REGEX = re.compile(r'^.__')
+_FLOAT_REGEX = re.compile(r'^\s*[-+]?(((\d+\.?\d*|\.\d+)(e[-+]?\d+)?)|inf|infinity|nan)\s*$', re.IGNORECASE)
+_BOOTSTRAP_REGEX = re.compile(r'([\d\.]+):(.*)')
+
+# Condensed forms of recently condensed taxonomy strings, cleared when it
+# grows past _CONDENSE_CACHE_SIZE so that it stays bounded however many
+# distinct taxonomies are condensed
+_condense_cache = {}
+_CONDENSE_CACHE_SIZE = 100000
 
 class TaxonomyFunctions:
     @staticmethod
@@ -13,19 +33,25 @@ class TaxonomyFunctions:
         in some rare cases two taxonomic levels have the same name except for their
         level e.g. c__Gemmatimonadetes; o__Gemmatimonadetes in GreenGenes 
         2013_08'''
+        try:
+            return _condense_cache[taxonomy_string]
+        except KeyError:
+            pass
         splits = taxonomy_string.split('; ')
         
         # get rid of f__ prefixes etc.
-        regex = re.compile(r'^.__')
         splits2 = []
         for s in splits:
-            reg = regex.match(s)
+            reg = _RANK_PREFIX_REGEX.match(s)
             if reg:
                 splits2.append(s[0]+s[reg.end():])
             else:
                 logging.debug("Found unexpected form for taxonomy in %s", str(s))
                 splits2.append(s)
-        return '.'.join(splits2)
+        condensed = '.'.join(splits2)
+        if len(_condense_cache) >= _CONDENSE_CACHE_SIZE: _condense_cache.clear()
+        _condense_cache[taxonomy_string] = condensed
+        return condensed
     
     @staticmethod
     def missing_taxonomy(tree, descendent_node, ancestral_node):
@@ -54,37 +80,324 @@ class TaxonomyFunctions:
     def taxonomy_from_node_name(node_name):
         '''return the taxonomy incorporated at a particular node, or None
         if it does not encode any taxonomy'''
-        
-        def isFloat(s):
-            try:
-                float(s)
-                return True
-            except ValueError:
-                return False
-        
+        return TaxonomyFunctions.parse_node_name(node_name)[1]
+    
+    @staticmethod
+    def parse_node_name(node_name):
+        '''return (bootstrap, taxonomy) encoded in a node name, either of
+        which may be None e.g. '0.97:f__Fam' gives (0.97, 'f__Fam'), '0.97'
+        gives (0.97, None) and 'f__Fam' gives (None, 'f__Fam')'''
         if node_name is None:
-            return None
-        elif isFloat(node_name):
+            return None, None
+        elif _FLOAT_REGEX.match(node_name):
             # no name, just a bootstrap
-            return None
+            return float(node_name), None
         else:
-            bootstrap_regex = re.compile(r'[\d\.]+:(.*)')
-            reg = bootstrap_regex.match(node_name)
+            reg = _BOOTSTRAP_REGEX.match(node_name)
             if reg:
                 # bootstrap in name
-                return reg.groups(0)[0]
+                try:
+                    bootstrap = float(reg.group(1))
+                except ValueError:
+                    bootstrap = None
+                return bootstrap, reg.group(2)
             else:
                 # bootstrap not in name
-                return node_name
+                return None, node_name
+    
+
+class RankTable:
+    '''The taxonomy encoded in the node names of a CompactTree, parsed in a
+    single pass over its distinct names. Each name is split into a record of
+    taxonomic rank prefix to interned taxon name e.g. 'f__Halomonadaceae;
+    g__Halomonas' becomes {'f': 'Halomonadaceae', 'g': 'Halomonas'}, and the
+    non-tip nodes annotated with each rank are indexed, so that finding the
+    nodes of a rank does not require matching the names again.'''
+    
+    RANK_SEPARATOR_REGEX = re.compile(r';\s*')
+    
+    def __init__(self, compact, previous=None):
+        '''
+        Parameters
+        ----------
+        compact: CompactTree
+            the tree to index
+        previous: RankTable or None
+            the table of a tree whose names are the first names of this one,
+            e.g. the tree before tips were grafted into it (see
+            CompactTree#graft), so that only the names added since need to
+            be parsed
+        '''
+        self.tree = compact
+        
+        # per name id: bootstrap (or None), taxonomy string (or None), its
+        # condensed form, the dict of rank to taxon name, and the id of the
+        # taxonomy among the distinct taxonomies (or -1). Each distinct
+        # taxonomy and its condensed form is held once, with 'Root' always
+        # among them, for naming clusters with no named node above them.
+        if previous is None:
+            self.bootstraps = []
+            self.taxonomies = []
+            self.condensed_taxonomies = []
+            self.name_ranks = []
+            name_taxonomy_ids = []
+            self.distinct_taxonomies = []
+            self.distinct_condensed_taxonomies = []
+            self._taxonomy_to_id = {}
+        else:
+            self.bootstraps = list(previous.bootstraps)
+            self.taxonomies = list(previous.taxonomies)
+            self.condensed_taxonomies = list(previous.condensed_taxonomies)
+            self.name_ranks = list(previous.name_ranks)
+            name_taxonomy_ids = previous.name_taxonomy_ids[:-1].tolist()
+            self.distinct_taxonomies = list(previous.distinct_taxonomies)
+            self.distinct_condensed_taxonomies = list(previous.distinct_condensed_taxonomies)
+            self._taxonomy_to_id = dict(previous._taxonomy_to_id)
+        for name_index in range(len(self.taxonomies), len(compact.names)):
+            name = compact.names[name_index]
+            bootstrap, taxonomy = TaxonomyFunctions.parse_node_name(name)
+            self.bootstraps.append(bootstrap)
+            self.taxonomies.append(taxonomy)
+            ranks = {}
+            if taxonomy is None:
+                self.condensed_taxonomies.append(None)
+                name_taxonomy_ids.append(-1)
+            else:
+                taxonomy_id = self.taxonomy_id(taxonomy)
+                self.condensed_taxonomies.append(self.distinct_condensed_taxonomies[taxonomy_id])
+                name_taxonomy_ids.append(taxonomy_id)
+                for part in self.RANK_SEPARATOR_REGEX.split(taxonomy):
+                    if part[1:3] == '__':
+                        ranks[intern(part[0])] = intern(part[3:])
+            self.name_ranks.append(ranks)
+        self.root_taxonomy_id = self.taxonomy_id('Root')
+        # name_id is -1 for unnamed nodes, which indexes the trailing -1
+        self.name_taxonomy_ids = np.array(name_taxonomy_ids + [-1], dtype=np.int64)
+        
+        # name ids annotated with each rank, then the nodes which have them
+        rank_name_ids = {}
+        for name_id, ranks in enumerate(self.name_ranks):
+            for rank in ranks:
+                try:
+                    rank_name_ids[rank].append(name_id)
+                except KeyError:
+                    rank_name_ids[rank] = [name_id]
+        self._rank_nodes = {}
+        for rank, name_ids in rank_name_ids.items():
+            # name_id is -1 for unnamed nodes, which indexes the trailing False
+            name_has_rank = np.zeros(len(self.name_ranks)+1, dtype=bool)
+            name_has_rank[name_ids] = True
+            self._rank_nodes[rank] = name_has_rank[compact.name_id] & ~compact.is_tip
+            
+    def taxonomy_id(self, taxonomy):
+        '''return the id of the given taxonomy string among the distinct
+        taxonomies, adding it if it is not yet among them'''
+        try:
+            return self._taxonomy_to_id[taxonomy]
+        except KeyError:
+            taxonomy_id = len(self.distinct_taxonomies)
+            self._taxonomy_to_id[taxonomy] = taxonomy_id
+            self.distinct_taxonomies.append(taxonomy)
+            self.distinct_condensed_taxonomies.append(TaxonomyFunctions.condense(taxonomy))
+            return taxonomy_id
+        
+    def ranks(self):
+        '''return the list of rank prefixes found in the tree'''
+        return sorted(self._rank_nodes.keys())
+            
+    def has_rank(self, rank):
+        '''return a boolean array, true for each non-tip node annotated with
+        the given rank prefix'''
+        try:
+            return self._rank_nodes[rank].copy()
+        except KeyError:
+            return np.zeros(len(self.tree), dtype=bool)
+            
+    def nodes_with_rank(self, rank):
+        '''return the ids of non-tip nodes annotated with the given rank
+        prefix, in preorder'''
+        return np.flatnonzero(self.has_rank(rank))
+    
+    def rank_name(self, node_id, rank):
+        '''return the name of the taxon of the given rank encoded in the name
+        of the given node, or None'''
+        name_id = self.tree.name_id[node_id]
+        if name_id < 0:
+            return None
+        else:
+            return self.name_ranks[name_id].get(rank)
+        
+    def taxonomy(self, node_id):
+        '''return the taxonomy encoded in the name of the given node, or None'''
+        name_id = self.tree.name_id[node_id]
+        if name_id < 0:
+            return None
+        else:
+            return self.taxonomies[name_id]
+        
+    def condensed_taxonomy(self, node_id):
+        '''return the condensed taxonomy of the given node, or None'''
+        name_id = self.tree.name_id[node_id]
+        if name_id < 0:
+            return None
+        else:
+            return self.condensed_taxonomies[name_id]
+        
+
+class TaxonomyIndex:
+    '''For each node of a CompactTree, the nearest node at or above it that is
+    annotated with taxonomy. Built in a single pass, so that naming a cluster
+    takes constant time and listing the taxonomy between two nodes takes time
+    proportional to the length of the list.'''
+    def __init__(self, compact, rank_table=None):
+        self.tree = compact
+        
+        # Each distinct name is only parsed once
+        if rank_table is None: rank_table = RankTable(compact)
+        self.rank_table = rank_table
+        has_taxonomy = rank_table.name_taxonomy_ids[compact.name_id] >= 0
+        
+        # The root is never counted as named, clusters whose search reaches
+        # it are called 'Root'. Jump up the tree, doubling the distance
+        # jumped each time, until each node points to a named node or the root.
+        nearest = np.arange(len(compact), dtype=np.int64)
+        unresolved = ~has_taxonomy
+        unresolved[0] = False
+        nearest[unresolved] = compact.parent[unresolved]
+        while True:
+            unresolved = unresolved & ~has_taxonomy[nearest] & (nearest != 0)
+            if not unresolved.any(): break
+            nearest[unresolved] = nearest[nearest[unresolved]]
+        self.nearest_named = nearest
+        
+    def taxonomy(self, node_id):
+        '''return the taxonomy encoded in the name of the given node, or None'''
+        return self.rank_table.taxonomy(node_id)
+        
+    def cluster_taxonomy(self, lca):
+        '''return the taxonomy of the closest named node at or above the given
+        cluster LCA, or 'Root' if there is none. Tips are not counted as
+        named since in a greengenes file their names are not taxonomy but
+        rather prokMSA IDs.'''
+        if self.tree.is_tip[lca]: lca = self.tree.parent[lca]
+        named = self.nearest_named[lca]
+        if named == 0:
+            return 'Root'
+        else:
+            return self.taxonomy(named)
+        
+    def cluster_taxonomy_ids(self, lcas):
+        '''As cluster_taxonomy, but for an array of cluster LCAs at once,
+        returning the id of the taxonomy of each among the distinct
+        taxonomies of the RankTable'''
+        tree = self.tree
+        lcas = np.asarray(lcas, dtype=np.int64)
+        nodes = np.where(tree.is_tip[lcas] & (lcas > 0), tree.parent[lcas], lcas)
+        named = self.nearest_named[nodes]
+        taxonomy_ids = self.rank_table.name_taxonomy_ids[tree.name_id[named]]
+        taxonomy_ids[named == 0] = self.rank_table.root_taxonomy_id
+        return taxonomy_ids
+        
+    def condensed_taxonomy(self, node_id):
+        return self.rank_table.condensed_taxonomy(node_id)
+        
+    def missing_taxonomy(self, descendent_node, ancestral_node):
+        '''As TaxonomyFunctions.missing_taxonomy, but given node ids of the
+        CompactTree: return a condensed taxonomy list representing the 
+        taxonomic information that is contained in nodes between the descendent 
+        and ancestral nodes (exclusive), in descending order.'''
+        tree = self.tree
+        if not (ancestral_node <= descendent_node < tree.subtree_end[ancestral_node]):
+            raise Exception("descendent and ancestral nodes do not appear to be related as expected in #missing_taxonomy")
+        
+        to_return = []
+        if descendent_node == ancestral_node: return to_return
+        
+        current = self.nearest_named[tree.parent[descendent_node]]
+        # the root (0) is returned when there are no more named nodes
+        while current > ancestral_node:
+            to_return.append(self.condensed_taxonomy(current))
+            current = self.nearest_named[tree.parent[current]]
+        return [r for r in reversed(to_return)]
     
 
-class NamedCluster:
-    def __init__(self, taxonomy, tips, lca_node):
+class NamedCluster(object):
+    '''A named cluster of tips. A cluster of a CompactTree is held as just
+    the range of its tips in CompactTree#tip_ids, which is contiguous since
+    tips are numbered in preorder, so its size and whether it contains a tip
+    are found in constant time, and its tips and LCA node are only made when
+    asked for.'''
+    
+    # many clusters are made for each threshold, so avoid a dict for each
+    __slots__ = ['taxonomy', '_tips', '_lca_node', 'lca_id', 'tree',
+                 'tip_start', 'tip_end', 'cluster_number']
+    
+    def __init__(self, taxonomy, tips=None, lca_node=None, lca_id=None, tree=None):
+        '''
+        Parameters
+        ----------
+        taxonomy: str
+            taxonomy the cluster is named after
+        tips, lca_node: list of nodes, node or None
+            tips and LCA of the cluster, required unless tree is given
+        lca_id: int or None
+            id of the LCA in the CompactTree which was clustered
+        tree: CompactTree or None
+            the tree which was clustered, from which the tips and LCA node
+            are made when needed
+        '''
         self.taxonomy = taxonomy
-        self.tips = tips
-        self.lca_node = lca_node
+        self._tips = tips
+        self._lca_node = lca_node
+        self.lca_id = lca_id
+        self.tree = tree
+        if tree is None:
+            self.tip_start = self.tip_end = None
+        else:
+            self.tip_start, self.tip_end = tree.tip_range(lca_id)
         self.cluster_number = None
         
+    @property
+    def tips(self):
+        '''list of the tip nodes of the cluster, left to right. For a
+        cluster of a CompactTree, a new list is made each time.'''
+        if self.tree is None:
+            return self._tips
+        else:
+            tree = self.tree
+            return [tree.node(i) for i in tree.tip_ids[self.tip_start:self.tip_end]]
+        
+    @property
+    def lca_node(self):
+        if self.tree is None:
+            return self._lca_node
+        else:
+            return self.tree.node(self.lca_id)
+        
+    def num_tips(self):
+        if self.tree is None:
+            return len(self._tips)
+        else:
+            return self.tip_end - self.tip_start
+        
+    def tip_ids(self):
+        '''return an array of the node ids of the tips of a cluster of a
+        CompactTree, left to right'''
+        return self.tree.tip_ids[self.tip_start:self.tip_end]
+        
+    def tip_names(self):
+        '''return a list of the names of the tips, left to right'''
+        if self.tree is None:
+            return [t.name for t in self._tips]
+        else:
+            return [self.tree.name(i) for i in self.tip_ids()]
+        
+    def contains(self, node_id):
+        '''return True if the given node of the clustered CompactTree is a
+        tip of this cluster'''
+        tree = self.tree
+        return bool(tree.is_tip[node_id]) and self.tip_start <= tree._tips_before[node_id] < self.tip_end
+        
     def name(self):
         if self.cluster_number:
             return "%s.%s" % (self.taxonomy, self.cluster_number)
@@ -109,25 +422,26 @@ class NamedCluster:
         
         
 class ThresholdAndClusters:
-    def __init__(self, threshold, clusters):
+    def __init__(self, threshold, clusters, taxonomy_index=None):
         self.threshold = threshold
         self.clusters = clusters
+        # TaxonomyIndex of the tree which was clustered
+        self.taxonomy_index = taxonomy_index
         
     def tip_name_to_cluster(self, tip_name):
-        key = tip_name
         try:
             # cached already?
-            return self._tip_to_cluster[key]
+            return self._tip_to_cluster[tip_name]
         except AttributeError:
             # no dice. Have to create the hash
             self._tip_to_cluster = {}
             for cluster in self.clusters:
-                for datip in cluster.tips:
-                    if self._tip_to_cluster.has_key(datip.name):
-                        logging.warn("Unexpectedly found multiple leaf nodes with the same name, undefined behaviour possibly imminent: %s" % tip_name)
+                for name in cluster.tip_names():
+                    if name in self._tip_to_cluster:
+                        logging.warn("Unexpectedly found multiple leaf nodes with the same name, undefined behaviour possibly imminent: %s" % name)
                     else:
-                        self._tip_to_cluster[datip.name] = cluster
-        return self._tip_to_cluster[key]
+                        self._tip_to_cluster[name] = cluster
+        return self._tip_to_cluster[tip_name]
         
     def tip_to_cluster(self, tip):
         '''return the NamedCluster to which the specified tip belongs'''
@@ -141,111 +455,608 @@ class ThresholdAndClusters:
                 yield tip
             
 
+def _merge_nodes(first_children, next_siblings, lengths, nodes, heights, merge_heights, merges=None):
+    '''Calculate the heights (farthest distance to a tip below) and merge
+    heights of the given internal nodes, in order, in place. A node with
+    two children merges once both have, at the distance between their
+    farthest tips. Nodes with one child never merge, and neither do those
+    with more than two unless a dict of merges is given. Then the children
+    of each such node are merged greedily as _greedy_merges describes,
+    merges[node] being set to the list of those merges, and the node
+    merges once all its children have.'''
+    inf = float('inf')
+    for node in nodes:
+        first = first_children[node]
+        second = next_siblings[first]
+        if second >= 0 and next_siblings[second] < 0:
+            heights[node] = max(heights[first] + lengths[first], heights[second] + lengths[second])
+            # summed in the order destructively_cluster_tree does, so that
+            # distances exactly at a threshold round the same way
+            merge_heights[node] = max(merge_heights[first],
+                                      merge_heights[second],
+                                      lengths[first] + lengths[second] + heights[first] + heights[second])
+            continue
+        
+        # one child, or more than two
+        children = []
+        child = first
+        while child >= 0:
+            children.append(child)
+            child = next_siblings[child]
+        heights[node] = max([heights[c] + lengths[c] for c in children])
+        merge_heights[node] = inf
+        if merges is not None and len(children) > 2:
+            node_merges = _greedy_merges([lengths[c] for c in children],
+                                         [heights[c] for c in children],
+                                         [merge_heights[c] for c in children])
+            merges[node] = node_merges
+            if len(node_merges) == len(children)-1:
+                merge_heights[node] = node_merges[-1][2]
+
+def _greedy_merges(lengths, heights, merge_heights):
+    '''Merge the children of a node by complete linkage, greedily in
+    increasing order of the distance at which each merge happens. Given the
+    branch length, height and merge height of each child, return a list of
+    (first, second, merge height) merges, children being numbered from 0 in
+    order and the result of the ith merge being numbered len(lengths)+i.
+    
+    A child can merge with others once it has itself merged, and two groups
+    of children merge when the sum of their farthest distances is within
+    the threshold. Every group that can merge has done so by the height
+    reached, so the next merge is of the two groups with the smallest
+    farthest distances, unless another child can merge first. Groups are
+    kept in a heap, alongside a queue of children in order of their merge
+    height, so a node of k children is merged in O(k log k). Children which
+    never merge are left alone, and the others are still merged. A group
+    of several children is treated as a node joining them with a branch of
+    length zero, and two groups are taken in the order CompactTree.resolve
+    puts them, so distances are summed exactly as _merge_nodes sums them
+    for the nodes resolve_multifurcations adds.'''
+    inf = float('inf')
+    num_children = len(lengths)
+    pending = sorted(range(num_children), key=lambda i: merge_heights[i])
+    next_pending = 0
+    groups = []
+    merges = []
+    height = -inf
+    while True:
+        if next_pending < num_children:
+            join_at = merge_heights[pending[next_pending]]
+        else:
+            join_at = inf
+        if len(groups) >= 2:
+            first = groups[0]
+            second = min(groups[1:3])
+            if first[2] > second[2]: first, second = second, first
+            _, _, _, first_length, first_height = first
+            _, _, _, second_length, second_height = second
+            merge_at = first_length + second_length + first_height + second_height
+        else:
+            merge_at = inf
+        if join_at == inf and merge_at == inf:
+            return merges
+        if join_at <= merge_at:
+            # the child can now merge with others
+            child = pending[next_pending]
+            next_pending += 1
+            height = max(height, join_at)
+            # each group is (farthest distance, id, position of its first
+            # child, branch length, height)
+            heapq.heappush(groups, (heights[child] + lengths[child], child, child, lengths[child], heights[child]))
+        else:
+            height = max(height, merge_at)
+            first_group = heapq.heappop(groups)
+            second_group = heapq.heappop(groups)
+            merges.append((first_group[1], second_group[1], height))
+            distance = max(first_group[0], second_group[0])
+            position = min(first_group[2], second_group[2])
+            heapq.heappush(groups, (distance, num_children+len(merges)-1, position, 0.0, distance))
+
+# The CompactTree shared with worker processes. It is set before the pool is
+# created, so forked workers inherit it without it being copied or pickled.
+_shared_tree = None
+
+def _subtree_merge_heights(task):
+    '''Return ((start, end), heights, merge heights, merges) for each of
+    the subtrees of the shared tree given as (subtrees, resolve), each
+    subtree a range of preorder node ids. merges is as given by
+    _merge_nodes when resolve is True, with node ids of the whole tree, and
+    otherwise None.'''
+    subtrees, resolve = task
+    tree = _shared_tree
+    to_return = []
+    for start, end in subtrees:
+        # renumber the subtree from 0, so it can be worked on as lists
+        first_children = (tree.first_child[start:end] - start).tolist()
+        next_siblings = (tree.next_sibling[start:end] - start).tolist()
+        heights = [0.0]*(end-start)
+        merge_heights = np.where(tree.is_tip[start:end], -np.inf, np.inf).tolist()
+        nodes = np.flatnonzero(~tree.is_tip[start:end])[::-1].tolist()
+        merges = {} if resolve else None
+        _merge_nodes(first_children, next_siblings, tree.length[start:end].tolist(),
+                     nodes, heights, merge_heights, merges)
+        if resolve:
+            merges = dict([(node+start, node_merges) for node, node_merges in merges.items()])
+        to_return.append(((start, end), np.array(heights), np.array(merge_heights), merges))
+    return to_return
+    
+
+def _number_clusters(taxonomy_ids, sizes, min_tip_keys):
+    '''Return the cluster number of each cluster, given the taxonomy it is
+    named after, its number of tips and the smallest tie break key of its
+    tips. For each taxonomy shared by more than one cluster, the cluster with
+    the most tips is numbered 1, the second most 2, etc., clusters of the
+    same size being ordered by their key. Clusters with a taxonomy of their
+    own are numbered 0, meaning they have no number.'''
+    numbers = np.zeros(len(taxonomy_ids), dtype=np.int64)
+    if len(taxonomy_ids) == 0: return numbers
+    order = np.lexsort((min_tip_keys, -sizes, taxonomy_ids))
+    sorted_ids = taxonomy_ids[order]
+    group_starts = np.flatnonzero(np.append(True, sorted_ids[1:] != sorted_ids[:-1]))
+    group_sizes = np.diff(np.append(group_starts, len(order)))
+    ranks = np.arange(len(order)) - np.repeat(group_starts, group_sizes)
+    numbers[order] = np.where(np.repeat(group_sizes, group_sizes) > 1, ranks+1, 0)
+    return numbers
+
+
 class Tree2Tax:
-    def named_clusters_for_several_thresholds(self, original_tree, thresholds):
+    def __init__(self, binary_only=False):
+        '''
+        Parameters
+        ----------
+        binary_only: bool
+            only collapse nodes with exactly two children, as
+            destructively_cluster_tree does, rather than first resolving
+            multifurcating nodes with resolve_multifurcations
+        '''
+        self.binary_only = binary_only
+    
+    def resolve_multifurcations(self, compact, threads=1):
+        '''Return a tree in which the children of each node with more than
+        two of them are joined two at a time under new nodes, in the order
+        they merge when clustered, and an array giving the id in it of each
+        node of the given CompactTree. The children are merged greedily by
+        complete linkage, the closest first (see _greedy_merges), so as the
+        threshold grows a multifurcating clade collapses a group of its
+        children at a time rather than all at once. Each new node is unnamed
+        and has a branch of length zero, so distances between tips are
+        unchanged, and the children of new nodes are reordered so that each
+        group of children is a contiguous range of tips.
+        
+        The tree itself is returned when it has no multifurcations, or with
+        binary_only. Clustering the returned tree with merge_heights and
+        cluster_lcas gives the clusters of the given one.'''
+        return self._resolve_and_merge_heights(compact, threads)[:2]
+    
+    def _resolve_and_merge_heights(self, compact, threads=1):
+        '''Return the tree and array of ids given by resolve_multifurcations,
+        and the heights and merge heights of the tree, calculated in the same
+        pass that merges the children of multifurcations (and in parallel
+        with threads, as in merge_heights)'''
+        num_multifurcations = int(np.count_nonzero(compact.num_children > 2))
+        if self.binary_only or num_multifurcations == 0:
+            heights, merge_heights = self._heights_and_merge_heights(compact, threads)
+            return compact, np.arange(len(compact)), heights, merge_heights
+        
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info("Resolving %i multifurcating nodes.." % num_multifurcations)
+        merges = {}
+        heights, merge_heights = self._heights_and_merge_heights(compact, threads, merges)
+        resolved, old_to_new = compact.resolve(dict([(node, [(first, second) for first, second, _ in node_merges])
+                                                     for node, node_merges in merges.items()]))
+        
+        # the nodes of the given tree keep their heights and merge heights,
+        # so only the new nodes need calculating, children first
+        resolved_heights = np.zeros(len(resolved), dtype=np.float64)
+        resolved_heights[old_to_new] = heights
+        resolved_merge_heights = np.zeros(len(resolved), dtype=np.float64)
+        resolved_merge_heights[old_to_new] = merge_heights
+        is_new = np.ones(len(resolved), dtype=bool)
+        is_new[old_to_new] = False
+        resolved_heights = resolved_heights.tolist()
+        resolved_merge_heights = resolved_merge_heights.tolist()
+        _merge_nodes(resolved.first_child.tolist(),
+                     resolved.next_sibling.tolist(),
+                     resolved.length.tolist(),
+                     np.flatnonzero(is_new)[::-1].tolist(),
+                     resolved_heights, resolved_merge_heights)
+        return resolved, old_to_new, np.array(resolved_heights), np.array(resolved_merge_heights)
+    
+    def named_clusters_for_several_thresholds(self, original_tree, thresholds, threads=1, metrics=None):
         '''Given a list of thresholds, return a iterable of ThresholdAndClusters
         where the clustering has been done iteratively, providing a consistent
-        taxonomic annotation scheme'''
-        original_tree.assign_ids()
-        tree = original_tree.copy() #this copy gets destructively pruned as part of the algorithm
+        taxonomic annotation scheme. The tree may be a TreeNode or a
+        CompactTree, and is not modified. threads is the number of processes
+        to calculate merge heights with. If a Metrics object is given, the
+        time taken by each stage and the numbers of merges and clusters at
+        each threshold are recorded in it.'''
+        if metrics is None: metrics = Metrics()
+        if isinstance(original_tree, CompactTree):
+            compact = original_tree
+        else:
+            with metrics.stage('convert_tree'):
+                compact = CompactTree.from_tree_node(original_tree)
         
-        # sort from smallest to largest because smaller distance thresholds
-        # need to be applied before larger thresholds
+        # sort from smallest to largest, since the clusters of smaller
+        # thresholds nest inside those of larger ones
         sorted_thresholds = sorted(thresholds)
         if logging.getLogger().isEnabledFor(logging.DEBUG): logging.debug("Found thresholds %s", str(sorted_thresholds))
         
+        # All the clustering work is done once up front, so that each
+        # threshold is just a cut through the tree, any multifurcations
+        # being resolved in the same pass
+        with metrics.stage('merge_heights', threads=threads, nodes=len(compact)) as stage:
+            stage.count('multifurcations', int(np.count_nonzero(compact.num_children > 2)))
+            compact, _, _, merge_heights = self._resolve_and_merge_heights(compact, threads)
+            stage.count('binary_nodes', int(np.count_nonzero(compact.num_children == 2)))
+        with metrics.stage('index_taxonomy'):
+            taxonomy_index = TaxonomyIndex(compact)
+            tip_keys = self._tie_break_tip_keys(compact)
+        
         to_return = []
-
-        # skbio seems to be quite slow running repeated find_by_id. Do some caching 
-        # to speed things up
-        id_to_node = {}
-        for node in original_tree.postorder(include_self=True):
-            id_to_node[node.id] = node
-            
-        clades_to_distances = {}
         for threshold in sorted_thresholds:
             if logging.getLogger().isEnabledFor(logging.INFO): logging.info("Clustering on threshold %s.." % str(threshold))
-            
-            clades_to_distances = self.destructively_cluster_tree(tree, threshold, clades_to_distances)
-            
-            clusters = []
-            if logging.getLogger().isEnabledFor(logging.DEBUG): logging.debug(tree.ascii_art())
-            cluster_lcas = tree.tips()
-            
-            # So that several clades don't get named the same thing
-            # it get a bit complex when several nodes are annotated as having the sam
-            # taxonomy (it happens..., in gg at least). So group by taxonomy
-            # rather than node ID
-            taxonomy_to_named_nodes = {} 
-            
-            # when everything is in 1 cluster (doesn't happen in practice I suspect)
-            # but there is a unit test..
-            if len(tree) == 0:
-                cl = NamedCluster('Root', original_tree.tips(), original_tree)
-                cl.cluster_number = ''
-                clusters = [cl]
-    
-            else:
-                for lca in cluster_lcas:
-                    orig = id_to_node[lca.id]
-                    
-                    # Find the closest ancestral named node (where ancestral does not include self)
-                    current = orig
-                    
-                    #in a greengenes file, tips have names, but don't count these 
-                    #because they are not taxonomy but rather prokMSA IDs
-                    if current.is_tip(): current = current.parent
-                    
-                    # Keep proceeding up the tree until a node with taxonomy is found.
-                    # If the tree has bootstraps, then current.name is a float (in string form)
-                    # Ignore these floats because they aren't named taxonomy
-                    while current.parent and (current.name is None or 
-                         TaxonomyFunctions.taxonomy_from_node_name(current.name) is None):
-                        current = current.parent
-                        
-                    if current.parent is None:
-                        taxonomy = 'Root'
-                    else:
-                        taxonomy = TaxonomyFunctions.taxonomy_from_node_name(current.name)
-                        
-                    if orig.is_tip():
-                        named_cluster = NamedCluster(taxonomy, [orig], orig)
-                    else:
-                        named_cluster = NamedCluster(taxonomy, list(orig.tips()), orig)
-                        
-                    clusters.append(named_cluster)
-                    
-                    try:
-                        taxonomy_to_named_nodes[taxonomy].append(named_cluster)
-                    except KeyError:
-                        taxonomy_to_named_nodes[taxonomy] = [named_cluster]
-                
-                if logging.getLogger().isEnabledFor(logging.DEBUG): logging.debug(taxonomy_to_named_nodes)
-                # Assign cluster numbers by decreasing numbers of tips i.e. for each
-                # taxonomy, the cluster with the most sequences is given the number 1,
-                # second most abundant is number 2, etc.
-                for taxonomy, named_clusters in taxonomy_to_named_nodes.items():
-                    if len(named_clusters) > 1:
-                        number = 1
-                        # sort twice (stupid python). Consider number of tips
-                        # to be more important than the minimum node ID. Need
-                        # to sort repeatably for the purposes of testing
-                        sorts1 = sorted(named_clusters, key = lambda c: min([tip.id for tip in c.tips]))
-                        for clade in sorted(sorts1, reverse = True, key = lambda c: len(c.tips)):
-                            clade.cluster_number = number
-                            number += 1
-                            
-            threshold_and_clusters = ThresholdAndClusters(threshold, clusters) 
-            to_return.append(threshold_and_clusters)
+            with metrics.stage('cluster', threshold=threshold) as stage:
+                cluster_lcas = self.cluster_lcas(compact, merge_heights, threshold)
+                stage.count('merges', int(np.count_nonzero(merge_heights[~compact.is_tip] <= threshold)))
+                stage.count('clusters', len(cluster_lcas))
+                stage.count('singletons', int(np.count_nonzero(compact.is_tip[cluster_lcas])))
+            with metrics.stage('name', threshold=threshold):
+                clusters = self._named_clusters_from_lcas(compact, cluster_lcas, taxonomy_index, tip_keys)
+            to_return.append(ThresholdAndClusters(threshold, clusters, taxonomy_index))
             
         return to_return
+    
+    def _tie_break_tip_keys(self, compact):
+        '''Clusters of the same size have always been ordered by their
+        smallest tip id as given by TreeNode.assign_ids, which numbers the
+        children of each node in postorder. Return an array of keys, one per
+        tip in left to right order, that sort the same way.'''
+        postorder = compact.postorder_index()
+        return postorder[compact.parent[compact.tip_ids]] * len(compact) + compact.tip_ids
+    
+    def _named_clusters_from_lcas(self, compact, cluster_lcas, taxonomy_index, tip_keys):
+        '''Return a list of NamedCluster objects, one for each of the given
+        cluster LCA node ids of a CompactTree'''
+        clusters = []
+        
+        # when everything is in 1 cluster (doesn't happen in practice I suspect)
+        # but there is a unit test..
+        if len(cluster_lcas) == 1 and cluster_lcas[0] == 0:
+            cl = NamedCluster('Root', lca_id=0, tree=compact)
+            cl.cluster_number = ''
+            return [cl]
         
+        # So that several clades don't get named the same thing
+        # it get a bit complex when several nodes are annotated as having the sam
+        # taxonomy (it happens..., in gg at least). So group by taxonomy
+        # rather than node ID
+        taxonomy_ids = taxonomy_index.cluster_taxonomy_ids(cluster_lcas)
+        distinct_taxonomies = taxonomy_index.rank_table.distinct_taxonomies
+        
+        for cluster_index, lca in enumerate(cluster_lcas.tolist()):
+            # Name after the closest ancestral named node
+            clusters.append(NamedCluster(distinct_taxonomies[taxonomy_ids[cluster_index]],
+                                         lca_id=lca, tree=compact))
+        
+        sizes, min_tip_keys = self._cluster_sizes_and_keys(compact, cluster_lcas, tip_keys)
+        numbers = _number_clusters(taxonomy_ids, sizes, min_tip_keys)
+        for cluster, number in zip(clusters, numbers.tolist()):
+            if number > 0: cluster.cluster_number = number
+                    
+        return clusters
+    
+    def _cluster_taxonomy_ids(self, taxonomy_index, cluster_lcas, taxonomies, taxonomy_to_id):
+        '''Return an array giving the taxonomy of each cluster as an index
+        into the list taxonomies, which is extended with any taxonomy not yet
+        in it, as recorded in the dict taxonomy_to_id'''
+        # look up the taxonomies of all clusters at once, so that only each
+        # distinct taxonomy is looked up in taxonomy_to_id
+        table_ids, inverse = np.unique(taxonomy_index.cluster_taxonomy_ids(cluster_lcas), return_inverse=True)
+        distinct_taxonomies = taxonomy_index.rank_table.distinct_taxonomies
+        taxonomy_ids = np.empty(len(table_ids), dtype=np.int64)
+        for i, table_id in enumerate(table_ids.tolist()):
+            taxonomy = distinct_taxonomies[table_id]
+            try:
+                taxonomy_ids[i] = taxonomy_to_id[taxonomy]
+            except KeyError:
+                taxonomy_to_id[taxonomy] = len(taxonomies)
+                taxonomy_ids[i] = len(taxonomies)
+                taxonomies.append(taxonomy)
+        return taxonomy_ids[inverse]
+    
+    def _cluster_sizes_and_keys(self, compact, cluster_lcas, tip_keys):
+        '''Return the number of tips in each of the clusters with the given
+        LCAs, which must partition the tips of the tree, and the smallest tie
+        break key of their tips'''
+        # The cluster tips partition the tips of the tree left to right, so
+        # the smallest key of each can be found together
+        cluster_tip_starts = compact._tips_before[cluster_lcas]
+        sizes = np.diff(np.append(cluster_tip_starts, compact.num_tips()))
+        return sizes, np.minimum.reduceat(tip_keys, cluster_tip_starts)
         
     def named_clusters(self, original_tree, threshold):
         '''cluster a tree given a threshold tree_distance'''
         array = self.named_clusters_for_several_thresholds(original_tree, [threshold])
         return array[0].clusters
     
+    def clustering_state(self, original_tree, thresholds, threads=1):
+        '''Cluster the tree at each of the thresholds as
+        named_clusters_for_several_thresholds does, returning a
+        ClusteringState which can be saved, and later given to
+        recluster_with_grafts. The tree of the state is that returned by
+        resolve_multifurcations.'''
+        if isinstance(original_tree, CompactTree):
+            compact = original_tree
+        else:
+            compact = CompactTree.from_tree_node(original_tree)
+        compact, _, heights, merge_heights = self._resolve_and_merge_heights(compact, threads)
+        sorted_thresholds = sorted(thresholds)
+        rank_table = RankTable(compact)
+        taxonomy_index = TaxonomyIndex(compact, rank_table)
+        tip_keys = self._tie_break_tip_keys(compact)
+        
+        taxonomies = []
+        taxonomy_to_id = {}
+        all_lcas = []
+        all_taxonomy_ids = []
+        all_numbers = []
+        for threshold in sorted_thresholds:
+            cluster_lcas = self.cluster_lcas(compact, merge_heights, threshold)
+            taxonomy_ids = self._cluster_taxonomy_ids(taxonomy_index, cluster_lcas, taxonomies, taxonomy_to_id)
+            sizes, min_tip_keys = self._cluster_sizes_and_keys(compact, cluster_lcas, tip_keys)
+            all_lcas.append(cluster_lcas)
+            all_taxonomy_ids.append(taxonomy_ids)
+            all_numbers.append(_number_clusters(taxonomy_ids, sizes, min_tip_keys))
+        state = ClusteringState(compact, sorted_thresholds, heights, merge_heights,
+                                all_lcas, all_taxonomy_ids, all_numbers, taxonomies)
+        state.rank_table = rank_table
+        return state
+    
+    def cluster_assignments(self, original_tree, thresholds, threads=1):
+        '''Cluster the tree at each of the thresholds, returning a
+        ClusterAssignments matrix of the cluster of each tip rather than
+        lists of NamedCluster objects'''
+        return self.clustering_state(original_tree, thresholds, threads).cluster_assignments()
+    
+    def recluster_with_grafts(self, state, tip_names, edges, distal_lengths, pendant_lengths):
+        '''Graft new tips into the tree of a ClusteringState and recluster
+        it, giving the same clusters and names as clustering the grafted tree
+        from scratch. Only the nodes on the paths from the grafts to the root
+        are recalculated, and only the clusters named after a taxonomy which
+        gained, lost or changed a cluster are renumbered. Edges are node ids
+        of the tree of the state, whose multifurcations were resolved when it
+        was made, so grafts do not change the order in which the children of
+        a multifurcating node merge.
+        
+        Return the new ClusteringState and a list of ClusterChange objects,
+        one for each cluster, at each threshold, whose name changed or which
+        gained new tips.
+        
+        Parameters
+        ----------
+        state: ClusteringState
+            the clustering to update
+        tip_names: list of str
+            names of the new tips
+        edges, distal_lengths, pendant_lengths: arrays
+            where each tip is grafted, as described in CompactTree#graft
+        '''
+        old_tree = state.tree
+        compact, old_to_new = old_tree.graft(edges, distal_lengths, pendant_lengths, tip_names)
+        num_nodes = len(compact)
+        is_new = np.ones(num_nodes, dtype=bool)
+        is_new[old_to_new] = False
+        new_nodes = np.flatnonzero(is_new)
+        
+        heights = np.zeros(num_nodes, dtype=np.float64)
+        heights[old_to_new] = state.heights
+        merge_heights = np.where(compact.is_tip, -np.inf, np.inf)
+        merge_heights[old_to_new] = state.merge_heights
+        
+        # Only the new internal nodes and their ancestors have new tips below
+        # them. The tips of a cluster can only have changed if its LCA is one
+        # of those, and the tie break keys of a cluster only if one of its
+        # tips is now the child of a new node.
+        on_path = np.zeros(num_nodes, dtype=bool)
+        parents = compact.parent
+        for node in new_nodes[~compact.is_tip[new_nodes]].tolist():
+            while node >= 0 and not on_path[node]:
+                on_path[node] = True
+                node = parents[node]
+        path_nodes = np.flatnonzero(on_path & ~compact.is_tip)[::-1]
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info("Recalculating merge heights of %i nodes above %i grafted tips" % (len(path_nodes), len(tip_names)))
+        _merge_nodes(compact.first_child, compact.next_sibling, compact.length,
+                     path_nodes.tolist(), heights, merge_heights)
+        changed = on_path | is_new
+        changed[old_to_new[np.asarray(edges, dtype=np.int64)]] = True
+        
+        if state.rank_table is None: state.rank_table = RankTable(old_tree)
+        rank_table = RankTable(compact, state.rank_table)
+        taxonomy_index = TaxonomyIndex(compact, rank_table)
+        tip_keys = self._tie_break_tip_keys(compact)
+        new_tips_before = np.zeros(num_nodes+1, dtype=np.int64)
+        np.cumsum(is_new & compact.is_tip, out=new_tips_before[1:])
+        taxonomies = list(state.taxonomies)
+        taxonomy_to_id = dict([(taxonomy, i) for i, taxonomy in enumerate(taxonomies)])
+        
+        all_lcas = []
+        all_taxonomy_ids = []
+        all_numbers = []
+        changes = []
+        for threshold_index, threshold in enumerate(state.thresholds):
+            cluster_lcas = self.cluster_lcas(compact, merge_heights, threshold)
+            old_lcas = old_to_new[state.cluster_lcas[threshold_index]]
+            old_taxonomy_ids = state.cluster_taxonomy_ids[threshold_index]
+            old_numbers = state.cluster_numbers[threshold_index]
+            
+            # clusters with the same LCA and tips as before keep their taxonomy
+            old_index = np.minimum(np.searchsorted(old_lcas, cluster_lcas), len(old_lcas)-1)
+            kept = (old_lcas[old_index] == cluster_lcas) & ~changed[cluster_lcas]
+            taxonomy_ids = np.empty(len(cluster_lcas), dtype=np.int64)
+            taxonomy_ids[kept] = old_taxonomy_ids[old_index[kept]]
+            taxonomy_ids[~kept] = self._cluster_taxonomy_ids(
+                taxonomy_index, cluster_lcas[~kept], taxonomies, taxonomy_to_id)
+            
+            # renumber the taxonomies that gained or lost a cluster
+            old_kept = np.zeros(len(old_lcas), dtype=bool)
+            old_kept[old_index[kept]] = True
+            renumber_taxonomy = np.zeros(len(taxonomies), dtype=bool)
+            renumber_taxonomy[taxonomy_ids[~kept]] = True
+            renumber_taxonomy[old_taxonomy_ids[~old_kept]] = True
+            renumber = renumber_taxonomy[taxonomy_ids]
+            numbers = np.zeros(len(cluster_lcas), dtype=np.int64)
+            numbers[kept] = old_numbers[old_index[kept]]
+            sizes, min_tip_keys = self._cluster_sizes_and_keys(compact, cluster_lcas, tip_keys)
+            numbers[renumber] = _number_clusters(taxonomy_ids[renumber], sizes[renumber], min_tip_keys[renumber])
+            
+            all_lcas.append(cluster_lcas)
+            all_taxonomy_ids.append(taxonomy_ids)
+            all_numbers.append(numbers)
+            changes.extend(self._cluster_changes(state, threshold_index, compact, old_lcas,
+                                                 cluster_lcas, kept, renumber,
+                                                 taxonomies, taxonomy_ids, numbers, new_tips_before))
+        
+        new_state = ClusteringState(compact, state.thresholds, heights, merge_heights,
+                                    all_lcas, all_taxonomy_ids, all_numbers, taxonomies)
+        new_state.rank_table = rank_table
+        return new_state, changes
+    
+    def _cluster_changes(self, state, threshold_index, compact, old_lcas, cluster_lcas, kept,
+                         renumbered, taxonomies, taxonomy_ids, numbers, new_tips_before):
+        '''Return a ClusterChange for each cluster of a reclustered threshold
+        whose name or tips changed'''
+        threshold = state.thresholds[threshold_index]
+        changes = []
+        for cluster_index in np.flatnonzero(renumbered | ~kept).tolist():
+            lca = cluster_lcas[cluster_index]
+            end = compact.subtree_end[lca]
+            # old clusters are either nested within the new one or, if it
+            # was split, the one old cluster containing it
+            first = np.searchsorted(old_lcas, lca)
+            last = np.searchsorted(old_lcas, end)
+            old_indices = range(first, last)
+            if first == last or old_lcas[first] != lca:
+                if first > 0 and compact.subtree_end[old_lcas[first-1]] > lca:
+                    old_indices = [first-1] + old_indices
+            old_names = [state.cluster_name(threshold_index, i) for i in old_indices]
+            
+            taxonomy = taxonomies[taxonomy_ids[cluster_index]]
+            if numbers[cluster_index] > 0:
+                new_name = "%s.%s" % (taxonomy, numbers[cluster_index])
+            else:
+                new_name = taxonomy
+            new_tips = int(new_tips_before[end] - new_tips_before[lca])
+            if new_tips > 0 or old_names != [new_name]:
+                changes.append(ClusterChange(threshold, new_name, old_names, new_tips, int(lca)))
+        return changes
+    
+    def merge_heights(self, compact, threads=1):
+        '''Return a numpy array giving, for each node of a CompactTree, the
+        smallest threshold at which the clade below it is collapsed into a
+        single cluster. Clustering is complete linkage, as in 
+        destructively_cluster_tree: a node with exactly two children
+        collapses when both children have collapsed, and the farthest tip
+        below the first child is within the threshold of the farthest tip
+        below the second. Tips are given -inf and nodes which can never
+        collapse (those without exactly two children) inf, so a tree with
+        multifurcations is first given to resolve_multifurcations.
+        
+        Since each node depends only on the nodes below it, disjoint
+        subtrees are independent. With more than one thread, the tree is
+        split into many subtrees which are calculated by a pool of worker
+        processes, and then the nodes above them are calculated from their
+        results. The result is identical to that of a single thread.'''
+        return self._heights_and_merge_heights(compact, threads)[1]
+    
+    def _heights_and_merge_heights(self, compact, threads=1, merges=None):
+        '''Return arrays of the farthest distance from each node to a tip
+        below it, and of merge heights. If a dict of merges is given, the
+        children of multifurcating nodes are merged as _merge_nodes
+        describes, in the same pass.'''
+        if threads > 1:
+            return self._parallel_merge_heights(compact, threads, merges=merges)
+        
+        heights = [0.0]*len(compact)
+        merge_heights = np.where(compact.is_tip, -np.inf, np.inf).tolist()
+        # children have higher preorder indices than their parents, so
+        # visiting in reverse preorder evaluates children first
+        _merge_nodes(compact.first_child.tolist(),
+                     compact.next_sibling.tolist(),
+                     compact.length.tolist(),
+                     np.flatnonzero(~compact.is_tip)[::-1].tolist(),
+                     heights, merge_heights, merges)
+        return np.array(heights, dtype=np.float64), np.array(merge_heights, dtype=np.float64)
+    
+    def _parallel_merge_heights(self, compact, threads, tasks_per_thread=4, merges=None):
+        num_nodes = len(compact)
+        subtree_sizes = compact.subtree_end - np.arange(num_nodes)
+        
+        # split into the largest subtrees of at most target_size nodes, and
+        # pack runs of them that are adjacent in preorder into tasks of
+        # about target_size nodes
+        target_size = max(num_nodes / (threads*tasks_per_thread), 1)
+        small = subtree_sizes <= target_size
+        subtree_roots = np.flatnonzero(small & ~small[compact.parent])
+        if small[0]: subtree_roots = np.zeros(1, dtype=np.int64)
+        subtree_roots = subtree_roots[subtree_sizes[subtree_roots] > 1]
+        tasks = []
+        task = []
+        task_size = 0
+        for root in subtree_roots.tolist():
+            task.append((root, int(compact.subtree_end[root])))
+            task_size += subtree_sizes[root]
+            if task_size >= target_size:
+                tasks.append((task, merges is not None))
+                task = []
+                task_size = 0
+        if task: tasks.append((task, merges is not None))
+        logging.info("Calculating merge heights of %i subtrees in %i tasks using %i processes" % (
+            len(subtree_roots), len(tasks), threads))
+        
+        heights = np.zeros(num_nodes, dtype=np.float64)
+        merge_heights = np.where(compact.is_tip, -np.inf, np.inf)
+        global _shared_tree
+        _shared_tree = compact
+        pool = multiprocessing.Pool(threads)
+        try:
+            for results in pool.imap_unordered(_subtree_merge_heights, tasks):
+                for (start, end), subtree_heights, subtree_merge_heights, subtree_merges in results:
+                    heights[start:end] = subtree_heights
+                    merge_heights[start:end] = subtree_merge_heights
+                    if merges is not None: merges.update(subtree_merges)
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+            pool.join()
+        finally:
+            _shared_tree = None
+            
+        # then the nodes above the subtrees
+        in_subtree = np.zeros(num_nodes+1, dtype=np.int64)
+        np.add.at(in_subtree, subtree_roots, 1)
+        np.add.at(in_subtree, compact.subtree_end[subtree_roots], -1)
+        above = np.cumsum(in_subtree[:-1]) == 0
+        nodes = np.flatnonzero(above & ~compact.is_tip)[::-1].tolist()
+        _merge_nodes(compact.first_child, compact.next_sibling, compact.length,
+                     nodes, heights, merge_heights, merges)
+        return heights, merge_heights
+    
+    def cluster_lcas(self, compact, merge_heights, threshold):
+        '''Return the ids of the nodes at the top of each cluster when the
+        CompactTree is clustered at the given threshold, in preorder (i.e.
+        left to right), given the result of merge_heights'''
+        collapsed = merge_heights <= threshold
+        if collapsed[0]:
+            return np.zeros(1, dtype=np.int64)
+        # the cluster LCAs are the collapsed nodes whose parent is not collapsed
+        lca_mask = collapsed.copy()
+        lca_mask[1:] &= ~collapsed[compact.parent[1:]]
+        return np.flatnonzero(lca_mask)
+    
     def destructively_cluster_tree(self, tree, threshold, clades_to_distances = {}):
         '''Given a tree, collapse tips using complete linkage such that 
         all sequences within the collapsed clade have at most the threshold 
@@ -0,0 +1,255 @@
+import os
+import struct
+import hashlib
+import logging
+import tempfile
+
+import numpy as np
+
+from .compact_tree import CompactTree
+
+class TreeCacheException(Exception): pass
+
+class StringTable:
+    '''A read-only list of strings, stored as one block of bytes and the
+    offsets of each string within it. Strings are only created when they are
+    accessed, so a memory mapped table can be opened without reading it.'''
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    @staticmethod
+    def from_strings(strings):
+        offsets = np.zeros(len(strings)+1, dtype=np.int64)
+        np.cumsum([len(s) for s in strings], out=offsets[1:])
+        data = np.frombuffer(''.join(strings), dtype=np.uint8)
+        return StringTable(offsets, data)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i+1]].tostring()
+
+    def __iter__(self):
+        # slicing one string is much faster than creating each from the array
+        data = self.data.tostring()
+        offsets = self.offsets.tolist()
+        for i in range(len(self)):
+            yield data[offsets[i]:offsets[i+1]]
+
+
+class TreeCache:
+    '''Caches parsed trees in a binary file which can be memory mapped, so
+    that a tree used repeatedly only needs to be parsed once. Each cache file
+    is keyed by the content of the tree file and the options it was parsed
+    with, and is stored either next to the tree file or in a cache
+    directory.
+
+    The size and modification time of the tree file are recorded too, and
+    while they are unchanged the cache is used without reading the tree
+    file. Only when they differ is its content hashed and compared with the
+    key, so a tree file replaced by another of the same size and
+    modification time needs rebuild to be parsed again.
+
+    The file is a header followed by the CompactTree arrays and a
+    StringTable of node names, each aligned to 8 bytes.'''
+
+    MAGIC = 'T2TCACHE'
+    VERSION = 2
+    # magic, version, options key, key, tree file size, tree file
+    # modification time, num nodes, num names, num bytes of names
+    HEADER = struct.Struct('<8sI40s40sqdqqq')
+    # the offset of the tree file size and modification time
+    SOURCE_OFFSET = struct.calcsize('<8sI40s40s')
+    SOURCE = struct.Struct('<qd')
+    ARRAYS = [('parent', np.int32), ('first_child', np.int32), ('next_sibling', np.int32),
+              ('length', np.float64), ('name_id', np.int32),
+              ('subtree_end', np.int64), ('depth', np.int32)]
+
+    def __init__(self, cache_directory=None, rebuild=False):
+        '''
+        Parameters
+        ----------
+        cache_directory: str or None
+            directory to store cache files in. If None, the cache is
+            written alongside the tree file, with a suffix of the parse
+            options and .t2t
+        rebuild: boolean
+            ignore any existing cache file and parse the tree again
+        '''
+        self.cache_directory = cache_directory
+        self.rebuild = rebuild
+
+    def read(self, tree_path, newick_reader):
+        '''Return a CompactTree of the tree at tree_path, loading it from the
+        cache if possible, and otherwise parsing it with the given
+        NewickReader and then caching it. Trees read from stdin are not
+        cached.'''
+        if tree_path == '-' or not isinstance(tree_path, basestring):
+            return newick_reader.read(tree_path)
+
+        source = os.stat(tree_path)
+        source = (source.st_size, source.st_mtime)
+        options_key = self.options_key(newick_reader)
+        cache_path = self.cache_path(tree_path, options_key)
+
+        key = None
+        if not self.rebuild and os.path.exists(cache_path):
+            try:
+                header = self.header(cache_path)
+                if header[2] == options_key and header[4:6] == source:
+                    tree = self.load(cache_path)
+                else:
+                    # changed, or at least touched, since it was cached
+                    key = self.key(tree_path, newick_reader)
+                    tree = self.load(cache_path, key)
+                    self._update_source(cache_path, source)
+                logging.info("Loaded tree from cache file %s" % cache_path)
+                return tree
+            except TreeCacheException as e:
+                logging.info("Not using cache file %s: %s" % (cache_path, e))
+
+        if key is None: key = self.key(tree_path, newick_reader)
+        tree = newick_reader.read(tree_path)
+        try:
+            self.write(tree, cache_path, key, options_key, source)
+            logging.info("Wrote tree cache file %s" % cache_path)
+        except (IOError, OSError) as e:
+            logging.warn("Unable to write tree cache file %s: %s" % (cache_path, e))
+        return tree
+
+    def _options(self, newick_reader):
+        return "version=%i;replace_spaces_with_underscores=%s;convert_underscores=%s;" % (
+            self.VERSION,
+            newick_reader.replace_spaces_with_underscores,
+            newick_reader.convert_underscores)
+
+    def options_key(self, newick_reader):
+        '''Return a hex digest of the parse options of the reader'''
+        return hashlib.sha1(self._options(newick_reader)).hexdigest()
+
+    def key(self, tree_path, newick_reader):
+        '''Return a hex digest of the tree file's content together with the
+        parse options of the reader'''
+        sha1 = hashlib.sha1()
+        sha1.update(self._options(newick_reader))
+        with open(tree_path, 'rb') as f:
+            while True:
+                chunk = f.read(1<<20)
+                if not chunk: break
+                sha1.update(chunk)
+        return sha1.hexdigest()
+
+    def cache_path(self, tree_path, options_key):
+        '''Return the path of the cache file of a tree file parsed with the
+        options of the given options_key. Alongside the tree file, it is
+        named by the tree file and the start of the options key, and in a
+        cache directory by the path of the tree file and the options, so
+        that trees parsed with different options are cached separately and
+        can be found without reading the tree file.'''
+        if self.cache_directory is None:
+            return "%s.%s.t2t" % (tree_path, options_key[:12])
+        else:
+            name = hashlib.sha1(options_key + os.path.abspath(tree_path)).hexdigest()
+            return os.path.join(self.cache_directory, name + '.t2t')
+
+    def write(self, tree, path, key, options_key='', source=(-1, 0.0)):
+        '''Write a CompactTree to path, first writing to a temporary file
+        and then renaming it so that readers never see a partial cache.
+        options_key and source, the size and modification time of the tree
+        file, are recorded so that read can tell that it is unchanged.'''
+        names = StringTable.from_strings(list(tree.names))
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory): os.makedirs(directory)
+        handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                f.write(self.HEADER.pack(self.MAGIC, self.VERSION, options_key, key, source[0], source[1],
+                                         len(tree), len(names), len(names.data)))
+                for name, dtype in self.ARRAYS:
+                    self._write_aligned(f, np.asarray(getattr(tree, name), dtype=dtype))
+                self._write_aligned(f, names.offsets)
+                self._write_aligned(f, names.data)
+            os.rename(temp_path, path)
+        except:
+            os.remove(temp_path)
+            raise
+
+    def _write_aligned(self, f, array):
+        padding = -f.tell() % 8
+        f.write('\0' * padding)
+        f.write(array.tostring())
+
+    def header(self, path):
+        '''Return the fields of the header of a cache file, as in HEADER,
+        raising TreeCacheException if it is not a cache file of this
+        version'''
+        with open(path, 'rb') as f:
+            header = f.read(self.HEADER.size)
+        if len(header) != self.HEADER.size:
+            raise TreeCacheException("Truncated cache file")
+        header = self.HEADER.unpack(header)
+        if header[0] != self.MAGIC or header[1] != self.VERSION:
+            raise TreeCacheException("Not a tree cache file of version %i" % self.VERSION)
+        return header
+
+    def _update_source(self, path, source):
+        '''Record a new size and modification time of the tree file of a
+        cache file whose content is unchanged, so it is not hashed again'''
+        try:
+            with open(path, 'r+b') as f:
+                f.seek(self.SOURCE_OFFSET)
+                f.write(self.SOURCE.pack(*source))
+        except (IOError, OSError) as e:
+            logging.warn("Unable to update tree cache file %s: %s" % (path, e))
+
+    def load(self, path, key=None):
+        '''Memory map a cache file written by write and return it as a
+        CompactTree. If key is given, it must match the key of the file.'''
+        _, _, _, file_key, _, _, num_nodes, num_names, num_name_bytes = self.header(path)
+        if key is not None and file_key != key:
+            raise TreeCacheException("Cache file was made from a different tree or parse options")
+
+        sections = [(name, dtype, num_nodes) for name, dtype in self.ARRAYS]
+        sections.append(('name_offsets', np.int64, num_names+1))
+        sections.append(('name_data', np.uint8, num_name_bytes))
+
+        expected_size = self.HEADER.size
+        for _, dtype, count in sections:
+            expected_size += -expected_size % 8
+            expected_size += np.dtype(dtype).itemsize * count
+        if os.path.getsize(path) != expected_size:
+            raise TreeCacheException("Cache file is not of the expected size")
+
+        arrays = {}
+        offset = self.HEADER.size
+        for name, dtype, count in sections:
+            offset += -offset % 8
+            if count == 0:
+                arrays[name] = np.zeros(0, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+            offset += np.dtype(dtype).itemsize * count
+
+        return CompactTree(arrays['parent'], arrays['first_child'], arrays['next_sibling'],
+                           arrays['length'], arrays['name_id'],
+                           StringTable(arrays['name_offsets'], arrays['name_data']),
+                           subtree_end=arrays['subtree_end'], depth=arrays['depth'])
+
+
+def tree_arrays(tree):
+    '''Return a dict of numpy arrays holding a CompactTree, e.g. for saving
+    alongside other arrays with numpy.savez'''
+    names = StringTable.from_strings(list(tree.names))
+    arrays = {'name_offsets': names.offsets, 'name_data': names.data}
+    for name, dtype in TreeCache.ARRAYS:
+        arrays[name] = np.asarray(getattr(tree, name), dtype=dtype)
+    return arrays
+
+def tree_from_arrays(arrays):
+    '''Return the CompactTree held in a dict of arrays made by tree_arrays'''
+    return CompactTree(arrays['parent'], arrays['first_child'], arrays['next_sibling'],
+                       arrays['length'], arrays['name_id'],
+                       list(StringTable(arrays['name_offsets'], arrays['name_data'])),
+                       subtree_end=arrays['subtree_end'], depth=arrays['depth'])